@@ -1,4 +1,6 @@
+import collections
 import math
+import time
 
 metadata = {
     'protocolName': 'Standard ampure/PEG clean ',
@@ -7,6 +9,333 @@ metadata = {
     'apiLevel': '2.9'
 }
 
+# names of the timed steps, in the order a column goes through them
+TIMED_STEPS = {'binding': 'beads', 'settling': 'magnet', 'supernatant': 'cleared', 'etoh': 'ethanol', 'drying': 'dry',
+               'buffer': 'buffer', 'elution': 'elution', 'clearing': 'final magnet'}
+
+
+class BeadMixer:
+    # beads settle in the reservoir, so they are mixed before an aspirate, but only if mix_interval seconds have
+    # passed since the last mix or the level has dropped drop_height (mm) since then (the first aspirate from each
+    # well is always mixed). Time comes from the column timers
+    def __init__(self, protocol, pipette, timers, mix_interval, drop_height):
+        self.protocol = protocol
+        self.pipette = pipette
+        self.timers = timers
+        self.mix_interval = mix_interval
+        self.drop_height = drop_height
+        self.well = None
+        self.last_mix = None
+        self.taken = 0.0
+        self.mixes = 0
+        self.skipped = 0
+
+    def before_aspirate(self, well, vol):
+        # mix well if due before the pipette takes vol (ul per channel) from it
+        vol = vol * self.pipette.channels
+        if well is not self.well or self.timers.now() - self.last_mix >= self.mix_interval \
+                or (self.taken + vol) / well_area(well) >= self.drop_height:
+            self.pipette.mix(2, 150, well.bottom(1))
+            self.well = well
+            self.last_mix = self.timers.now()
+            self.taken = 0.0
+            self.mixes += 1
+        else:
+            self.skipped += 1
+        self.taken += vol
+
+    def report(self):
+        if self.mixes:
+            self.protocol.comment("Mixed the beads " + str(self.mixes) + " times, skipped " + str(self.skipped)
+                                  + " mixes.")
+
+
+class TipLedger:
+    # every tip column in the racks is fresh, in use (on the pipette), parked (put back in its rack to be used again
+    # for a purpose and sample column) or discarded. Fresh tips are taken in rack order and parked tips are looked up
+    # by (purpose, column), so no rack is scanned to find a tip
+    # tips used are counted per phase of the protocol (fresh and reused)
+    def __init__(self, protocol, pipette, racks):
+        self.protocol = protocol
+        self.pipette = pipette
+        self.fresh = collections.deque(column[0] for rack in racks for column in rack.columns())
+        self.total = len(self.fresh)
+        self.state = {tip: 'fresh' for tip in self.fresh}
+        self.parked = {}
+        self.current = None
+        self.used = collections.OrderedDict()
+
+    def pick_up(self, phase, purpose=None, col=None):
+        # pick up the tip parked for purpose and col, or a fresh tip if no purpose is given
+        counts = self.used.setdefault(phase, {'fresh': 0, 'reused': 0})
+        if purpose is None:
+            if not self.fresh:
+                raise Exception("Out of tips. Add another tip rack and try again.")
+            tip = self.fresh.popleft()
+            counts['fresh'] += 1
+        else:
+            if (purpose, col) not in self.parked:
+                raise Exception("No tip parked for " + purpose + (" column " + str(col + 1) if col is not None else ""))
+            tip = self.parked.pop((purpose, col))
+            counts['reused'] += 1
+        self.pipette.pick_up_tip(tip)
+        self.state[tip] = 'in use'
+        self.current = tip
+
+    def park(self, purpose, col=None):
+        # put the tip back in its rack to be picked up again for purpose and col
+        self.pipette.return_tip()
+        self.state[self.current] = 'parked'
+        self.parked[(purpose, col)] = self.current
+        self.current = None
+
+    def discard(self):
+        self.pipette.drop_tip()
+        self.state[self.current] = 'discarded'
+        self.current = None
+
+    def report(self):
+        for phase, counts in self.used.items():
+            self.protocol.comment("Tips for " + phase + ": " + str(counts['fresh']) + " new, " + str(counts['reused'])
+                                  + " reused.")
+        self.protocol.comment("Used " + str(self.total - len(self.fresh)) + " of " + str(self.total) + " tip columns.")
+
+
+def well_area(well):
+    # cross section (mm2) of a round or rectangular well
+    if well.diameter is not None:
+        return math.pi * (well.diameter / 2) ** 2
+    return well.length * well.width
+
+
+def well_height(well, vol):
+    # height (mm) of vol (ul) of liquid above the bottom of a well
+    # the well is taken as a straight well with a cone at the bottom, with the cone sized so the well holds its rated
+    # volume at its full depth (from the labware definition)
+    if vol <= 0:
+        return 0.0
+    area = well_area(well)
+    cone_height = min(well.depth, max(0.0, 1.5 * (well.depth - well.max_volume / area)))
+    cone_vol = area * cone_height / 3
+    if vol < cone_vol:
+        return cone_height * (vol / cone_vol) ** (1 / 3)
+    return min(well.depth, cone_height + (vol - cone_vol) / area)
+
+
+# measured magnet settling times (mins), keyed by (plate labware, engage height in mm above the bottom of the plate
+# or None for the labware's default, bead volume in ul, total volume in ul)
+# add a line for each new measurement
+SETTLING_CALIBRATION = {
+    ('biorad_96_wellplate_200ul_pcr', None, 62, 150): 12,
+}
+
+
+def predicted_settling_time(well, labware, engage_height, bead_volume, total_volume):
+    # minutes for the beads to settle, from the calibration entry for the same labware and engage height with the
+    # closest fraction of beads, scaled by the height of the liquid (the beads furthest from the bottom have to be
+    # pulled down the whole height)
+    # None if there is no calibration entry for the labware and engage height
+    entries = [(abs(beads / total - bead_volume / total_volume), beads, total, minutes)
+               for (name, height, beads, total), minutes in SETTLING_CALIBRATION.items()
+               if name == labware and height == engage_height]
+    if not entries:
+        return None
+    fraction_diff, beads, total, minutes = min(entries)
+    return minutes * well_height(well, total_volume) / well_height(well, total)
+
+
+class ReagentLedger:
+    # volume (ul) in every well used for one reagent, or for waste, in the order the wells are used
+    # reagent is drawn from the first well with enough left above its dead volume and waste goes into the first well
+    # with room left below its fill limit, so the run moves on to the next well by itself instead of running a well
+    # dry or over filling it. Aspirates are made from just under where the surface will be after the aspirate
+    def __init__(self, protocol, name, wells, start_vol, dead_vol=0, fill_limit=None, submerge=2):
+        self.protocol = protocol
+        self.name = name
+        self.wells = wells
+        self.start_vol = start_vol
+        self.vols = [start_vol for well in wells]
+        self.dead_vol = dead_vol
+        self.fill_limit = [fill_limit or well.max_volume for well in wells]
+        self.submerge = submerge
+        self.current = 0
+        for well, limit in zip(wells, self.fill_limit):
+            if start_vol < 0 or start_vol > limit:
+                raise Exception("Invalid " + name + " volume. Must be 0-" + str(limit) + " ul")
+
+    def check(self, draw_vol=0, add_vol=0):
+        # stop before the run starts if the wells can't supply draw_vol or hold add_vol (ul, all channels)
+        available = sum(max(0, vol - self.dead_vol) for vol in self.vols)
+        room = sum(limit - vol for vol, limit in zip(self.vols, self.fill_limit))
+        if draw_vol > available:
+            raise Exception("The run needs " + str(round(draw_vol)) + " ul of " + self.name + " but the "
+                            + str(len(self.wells)) + " well(s) only have " + str(round(available)) + " ul above "
+                            "the dead volume. Add another well or fill them higher.")
+        if add_vol > room:
+            raise Exception("The run puts " + str(round(add_vol)) + " ul into the " + self.name + " but the "
+                            + str(len(self.wells)) + " well(s) only have room for " + str(round(room))
+                            + " ul. Add another well or empty them.")
+
+    def switch(self, ok, msg):
+        # move on to the first well from the current one where ok(index) is true
+        # if there isn't one (check() wasn't used or the volumes were off) pause with msg for the wells to be reset
+        start = self.current
+        while self.current < len(self.wells) and not ok(self.current):
+            self.current += 1
+        if self.current == len(self.wells):
+            self.protocol.pause(msg)
+            self.vols = [self.start_vol for well in self.wells]
+            self.current = 0
+            return
+        if self.current != start:
+            self.protocol.comment("Switching " + self.name + " to well " + self.wells[self.current].well_name + ".")
+
+    def well_for(self, vol, channels=1):
+        # the well the next aspirate of vol (ul per channel) will come from
+        self.switch(lambda index: self.vols[index] - vol * channels >= self.dead_vol,
+                    "The " + self.name + " wells are almost empty. Refill them to " + str(self.start_vol)
+                    + " ul and resume.")
+        return self.wells[self.current]
+
+    def aspirate_from(self, vol, channels=1):
+        # where to aspirate vol (ul per channel) from
+        well = self.well_for(vol, channels)
+        self.vols[self.current] = max(0, self.vols[self.current] - vol * channels)
+        return well.bottom(max(1.0, well_height(well, self.vols[self.current]) - self.submerge))
+
+    def put_back(self, vol, channels=1):
+        # liquid blown back into the well it came from, returns where to blow it out
+        self.vols[self.current] = min(self.vols[self.current] + vol * channels, self.fill_limit[self.current])
+        return self.wells[self.current].top()
+
+    def dispense_to(self, vol, channels=1):
+        # where to dispense vol (ul per channel) of waste
+        self.switch(lambda index: self.vols[index] + vol * channels <= self.fill_limit[index],
+                    "The " + self.name + " wells are almost full. Empty them and resume.")
+        self.vols[self.current] += vol * channels
+        return self.wells[self.current].top()
+
+
+def two_stage_draw(protocol, pipette, well, vol, bulk_rate, final_rate, final_vol, bulk_margin):
+    # take vol (ul) off the beads in two stages: most of it quickly from bulk_margin (mm) below where the surface will
+    # be once only final_vol is left (so the tip is still in the liquid at the end of the draw and stays above the
+    # pellet), then the last final_vol slowly from 1 mm off the bottom
+    # up/down movement is slowed while the tip is in the well
+    final_vol = min(final_vol, vol)
+    protocol.max_speeds['Z'] = 10
+    if vol > final_vol:
+        pipette.flow_rate.aspirate = bulk_rate
+        pipette.aspirate(vol - final_vol, well.bottom(max(1.0, well_height(well, final_vol) - bulk_margin)))
+    pipette.flow_rate.aspirate = final_rate
+    pipette.aspirate(final_vol, well.bottom(1))
+    pipette.move_to(well.top())
+    protocol.max_speeds['Z'] = None
+
+
+def wash_group_size(contact_time, max_exposure, add_time, removal_time, cols_left, buffer_due=()):
+    # columns in the next ethanol wash group, the smallest group that covers the contact time (seconds) without
+    # waiting when each column takes the longer of adding and removing its ethanol. The first column of a group keeps
+    # its ethanol until the last add, the last column until every column before it has been emptied, so the group is
+    # then made smaller until no column is expected to keep its ethanol (removal included) longer than max_exposure
+    # (seconds)
+    # add_time and removal_time are the times (seconds) to add ethanol to and remove it from one column, None if they
+    # haven't been measured. buffer_due are the times (seconds from now) the columns waiting for elution buffer finish
+    # drying, each one that comes up before the group is emptied holds it up for another column of pipetting
+    add_time = add_time or 0.0
+    removal_time = removal_time or 0.0
+    col_time = max(add_time, removal_time)
+    if col_time <= 0:
+        return cols_left
+
+    def exposure(size):
+        # column j has its ethanol from the end of add j + 1 to the end of removal j + 1, and the first removal starts
+        # once every column is in and the first one has had the contact time
+        first_out = max(size * add_time, add_time + contact_time)
+        buffer_cols = len([due for due in buffer_due if due <= first_out + size * removal_time])
+        return first_out + max(removal_time - add_time, size * (removal_time - add_time)) + buffer_cols * col_time
+
+    size = max(1, min(cols_left, math.ceil(contact_time / col_time) + 1))
+    while size > 1 and exposure(size) > max_exposure:
+        size -= 1
+    return size
+
+
+def clock_text(seconds):
+    # run time as m:ss
+    seconds = int(round(seconds))
+    return str(seconds // 60) + ':' + str(seconds % 60).zfill(2)
+
+
+class ColumnTimers:
+    # when each column started each timed step, so the protocol only waits for what the column it is about to work
+    # on still needs instead of a fixed delay for the whole plate
+    # on the robot this is the real clock. When simulating nothing takes real time, so the clock is modelled:
+    # each column of pipetting takes col_pipetting_time seconds and waits take their full length
+    def __init__(self, protocol, col_pipetting_time):
+        self.protocol = protocol
+        self.simulating = protocol.is_simulating()
+        self.col_pipetting_time = col_pipetting_time
+        self.start_clock = time.monotonic()
+        self.model_clock = 0.0
+        self.started = {}
+        self.waited = 0.0
+
+    def now(self):
+        # seconds since the start of the run
+        if self.simulating:
+            return self.model_clock
+        return time.monotonic() - self.start_clock
+
+    def start(self, step, cols, pipetting=True):
+        # step starts now for cols, pipetting is False if the step starts without pipetting (the magnet engaging)
+        if self.simulating and pipetting:
+            self.model_clock += self.col_pipetting_time * len(cols)
+        for col in cols:
+            self.started[(step, col)] = self.now()
+
+    def column_time(self, step, cols):
+        # average time (seconds) between cols starting step, None if fewer than 2 of them have started it
+        starts = sorted(self.started[(step, col)] for col in cols if (step, col) in self.started)
+        if len(starts) < 2:
+            return None
+        return (starts[-1] - starts[0]) / (len(starts) - 1)
+
+    def in_start_order(self, step, cols):
+        # the cols that have started step, in the order they started it
+        return sorted((col for col in cols if (step, col) in self.started), key=lambda col: self.started[(step, col)])
+
+    def ready(self, step, cols, seconds):
+        # the cols that have had at least seconds of step, in the order they started it
+        return [col for col in self.in_start_order(step, cols) if self.started[(step, col)] + seconds <= self.now()]
+
+    def remaining(self, step, cols, seconds):
+        # seconds until every column in cols has had at least seconds of step (0 if they all have)
+        return max(0.0, max(self.started[(step, col)] for col in cols) + seconds - self.now())
+
+    def wait_for(self, step, cols, seconds):
+        # wait until every column in cols has had at least seconds of step
+        remaining = self.remaining(step, cols, seconds)
+        if remaining > 0.5:
+            self.protocol.comment("Waiting " + clock_text(remaining) + " for " + TIMED_STEPS[step] + " on column "
+                                  + ', '.join(str(col + 1) for col in cols) + ". Protocol will resume automatically.")
+            self.protocol.delay(seconds=remaining)
+            if self.simulating:
+                self.model_clock += remaining
+            self.waited += remaining
+
+    def report(self, fixed_wait):
+        # timeline of each column and the waiting saved against the fixed sequence (fixed_wait seconds of delays)
+        cols = sorted({col for step, col in self.started})
+        for col in cols:
+            steps = sorted((self.started[(step, col)], step) for step in TIMED_STEPS if (step, col) in self.started)
+            self.protocol.comment("Column " + str(col + 1) + ": " + ', '.join(
+                TIMED_STEPS[step] + ' ' + clock_text(start) for start, step in steps))
+        saved = max(0.0, fixed_wait - self.waited)
+        self.protocol.comment("Waited " + clock_text(self.waited) + " in total, fixed delays for the whole plate would "
+                              "wait " + clock_text(fixed_wait) + " (about " + clock_text(saved) + " saved). Run time "
+                              + clock_text(self.now()) + ".")
+
+
 def run(protocol):
 
 ########## EDIT THESE RUN OPTIONS AS NEEDED ##########
@@ -22,13 +351,32 @@ def run(protocol):
     # on the bottom of the reservoir
     beads_peg = 'peg'
 
+    # reagent reservoir wells (slot 7) for each reagent, in the order they are used (well names in single quotes and in
+    # brackets, ex: ['A4', 'A5']). When a well runs low the next one is used, and the protocol stops before starting
+    # if the wells can't hold enough for the run
+    bead_wells = ['A1']
+    etoh_wells = ['A4']
+    water_wells = ['A6']
+
+    # volume (ul) in each reagent well at the start
+    bead_start_vol = 8000
+    etoh_start_vol = 15000
+    water_start_vol = 12000
+
+    # waste reservoir wells (slot 11), in the order they are filled
+    waste_wells = ['A1']
+
+    # beads are only mixed again once this many seconds have passed since the last mix, or once the level in the
+    # reservoir has dropped this many mm since the last mix (only used if beads_peg = 'beads')
+    bead_mix_interval = 120
+    bead_mix_drop = 2
+
     # volume of product that is being cleaned (ul)
     PCR_volume = 88
 
     # volume of ethanol to use for washes (ul) Max: 190
     # recommend 100 ul
-    # if doing a full plate, can't go above 140 because the reservoir won't hold enough etoh
-    # you can pause the protocol and refill reservoirs if necessary
+    # if doing a full plate above 140 ul one reservoir well won't hold enough etoh, add a second well to etoh_wells
     etoh_volume = 100
 
     # volume of ampure/PEG (ul)
@@ -41,23 +389,72 @@ def run(protocol):
     elution_buffer_volume = 100
 
     # ampure/elution buffer incubation time (mins)
+    # each column is timed from when it gets beads or is mixed with elution buffer
     incubation_time = 10
 
-    # time for beads to settle on magnet (mins)
+    # plate on the magnetic module ('biorad_96_wellplate_200ul_pcr' or 'vwr_96_wellplate_200ul_magnet',
+    # in single quotes)
+    mag_plate_type = 'biorad_96_wellplate_200ul_pcr'
+
+    # height (mm above the bottom of the plate) to engage the magnet to, None to use the plate's default
+    engage_height = None
+
+    # the time for beads to settle on the magnet is predicted from the measured times in SETTLING_CALIBRATION (top
+    # of this file) for the same plate and engage height, scaled by the volume in the wells
+    # extra time (mins) added to the predicted time to be safe
+    # the biorad entry is the 12 minutes this protocol has always used, which already has room to spare, so no margin
+    # is added by default. Add one for entries measured right at the point the beads cleared
+    settling_margin = 0
+
+    # time for beads to settle on magnet (mins) if there is no calibration for the plate and engage height
     # magnet is weaker than the usual one, beads will need longer to settle
     # time will depend on volume of beads
     # recommend 10-12 mins for 62 ul ampure
     settling_time = 12
 
     # time to let beads dry after ethanol washes (mins)
-    # recommend 0 minute if doing whole plate
-    # first columns will have been drying for awhile (~10 mins) by the time final column is done
-    # and final column will be done drying by the time its eluted
-    drying_time = 0
+    # each column is timed from when its ethanol is removed, so the first columns don't hold up the run
+    # while the later ones are still being washed
+    drying_time = 2
+
+    # time (seconds) each column keeps its ethanol, from when it is added to when it is removed
+    # if the other columns in the wash group take longer than this to pipette there is no extra wait
+    etoh_contact_time = 30
+
+    # longest time (seconds) a column should keep its ethanol, removal included. The wash groups are made smaller to
+    # stay under it, and elution buffer only goes on in the middle of a group if the group still finishes in time
+    # (must be at least etoh_contact_time)
+    etoh_max_exposure = 60
+
+    # supernatant and ethanol removal: a fast bulk draw from above the pellet, then a slow final draw of the last
+    # few ul from 1 mm off the bottom of the well so beads aren't pulled off
+    # aspirate rates are in ul/s, the bulk draw height is worked out from the volume and the well shape
+    bulk_aspirate_rate = 50
+    final_aspirate_rate = 5
+    # ethanol doesn't hold beads the way the supernatant does, so its final draw can be faster
+    etoh_final_aspirate_rate = 40
+    final_draw_volume = 20
+    # how far (mm) below the surface left for the final draw the bulk draw is taken from, so the tip doesn't reach
+    # air at the end of it (never lower than 1 mm off the bottom)
+    bulk_draw_margin = 2
+
+    # estimated time (seconds) to pipette one column, only used for the timeline when simulating
+    col_pipetting_time = 20
 
     # engage magnet at end of protocol to clear beads after elution (True or False, make sure first letter capitalized)
     final_clear = False
 
+    # double sided size selection in one run ('yes' or 'no', all lowercase and in single quotes)
+    # bead_volume is the first cut. Its supernatant is moved onto the second cut's beads in the same rows of the
+    # columns after the samples (so at most 48 samples), and those columns are washed and eluted
+    double_sided = 'no'
+
+    # volume of ampure/PEG (ul) for the second cut (only used if double_sided = 'yes')
+    second_bead_volume = 20
+
+    # when adding ethanol, fill the tip for as many columns as fit instead of going back to the reservoir for each
+    # column ('yes' or 'no', all lowercase and in single quotes)
+    etoh_multi_dispense = 'no'
 
 ########## DO NOT EDIT BELOW THIS LINE ##########
 
@@ -74,6 +471,30 @@ def run(protocol):
         raise Exception('Elution buffer volume too high. Wells can hold maximum 200 uL. Reduce volume and try again.')
     if etoh_volume > 190:
         raise Exception('Volume of ethanol too high. Reduce volume and try again.')
+    if beads_peg not in ['beads', 'peg']:
+        raise Exception("Beads or PEG not indicated. Must be 'beads' or 'peg'.")
+    if double_sided not in ['yes', 'no']:
+        raise Exception("Double sided size selection not indicated. Must be 'yes' or 'no'.")
+    # volume and beads in the wells that are washed and eluted (the second cut if double sided)
+    if double_sided == 'yes':
+        if sample_count > 48:
+            raise Exception('Double sided size selection puts the second cut in the columns after the samples, so '
+                            'it can do at most 48 samples.')
+        clean_vol = total_vol + second_bead_volume
+        clean_beads = second_bead_volume
+    else:
+        clean_vol = total_vol
+        clean_beads = bead_volume
+    if clean_vol > 200:
+        raise Exception('Volume too high for the second cut. Wells can hold maximum 200 uL. Reduce volume of DNA '
+                        'to be cleaned or volume of ampure/PEG')
+    if etoh_multi_dispense not in ['yes', 'no']:
+        raise Exception("Ethanol multi-dispense not indicated. Must be 'yes' or 'no'.")
+    if etoh_max_exposure < etoh_contact_time:
+        raise Exception('Maximum ethanol exposure is shorter than the ethanol contact time. Increase it and try again.')
+    if bulk_draw_margin < 0:
+        raise Exception('Invalid bulk draw margin. Must be 0 mm or more.')
+    timers = ColumnTimers(protocol, col_pipetting_time)
 
     # Define hardware, pipettes/tips, plates
     # specify tips and slots
@@ -86,130 +507,225 @@ def run(protocol):
     # load magnetic module and specify slot
     mag_deck = protocol.load_module('magnetic module gen2', '1')
     # specify labware palced in magnetic module
-    mag_plate = mag_deck.load_labware('biorad_96_wellplate_200ul_pcr')
+    if mag_plate_type not in ['biorad_96_wellplate_200ul_pcr', 'vwr_96_wellplate_200ul_magnet']:
+        raise Exception("Invalid magnet plate type. Must be 'biorad_96_wellplate_200ul_pcr' or "
+                        "'vwr_96_wellplate_200ul_magnet'")
+    mag_plate = mag_deck.load_labware(mag_plate_type)
+
+    # settling times (mins) for the beads in the sample, in the second cut and, for the final clear, in the elution
+    # buffer
+    def settling_minutes(volume, bead_vol):
+        predicted = predicted_settling_time(mag_plate.wells()[0], mag_plate_type, engage_height, bead_vol, volume)
+        if predicted is None:
+            protocol.comment("No settling calibration for " + mag_plate_type + " at this engage height, using "
+                             + str(settling_time) + " minutes.")
+            return settling_time
+        protocol.comment("Predicted settling time for " + str(volume) + " ul is " + str(round(predicted, 1))
+                         + " minutes, using " + str(round(predicted + settling_margin, 1)) + " minutes instead of "
+                         + str(settling_time) + ".")
+        return predicted + settling_margin
+    sample_settling = settling_minutes(total_vol, bead_volume)
+    clean_settling = settling_minutes(clean_vol, clean_beads) if double_sided == 'yes' else sample_settling
+    elution_settling = settling_minutes(elution_buffer_volume, clean_beads) if final_clear is True else 0
     # specify waste labware and slot
     waste_reservoir = protocol.load_labware('liquid_waste_reservoir', '11')
     # specify reagent labware, reagents in each well, and slot on deck
     reagent_reservoir = protocol.load_labware(
         'nest_12_reservoir_15ml', '7')
-    [beads, etoh_1, etoh_2, water] = [
-        reagent_reservoir.wells_by_name()[well] for well in [
-        'A1', 'A3', 'A4', 'A6']]
-
-    # helper functions for tip parking
-    named_tips = {}
-    def name_the_tips(tip_box, name_list, well_list):
-        for name in name_list:
-            if name != 'current_tip':
-                if name not in named_tips.keys():
-                    named_tips[name] = []
-        for name, well in zip(name_list, well_list):
-            if name != 'current_tip':
-                named_tips[name].append(tip_box[well])
-            else:
-                named_tips[name] = tip_box[well]
-    def capture_current_starting_tip():
-        for index, box in enumerate(tips300):
-            if box.next_tip() is not None:
-                current_starting_tip = box.next_tip()
-                name_the_tips(tips300[index], ['current_tip'], [
-                 current_starting_tip.well_name])
-                return (tips300[index], current_starting_tip.well_name)
+    # volume (ul) left in the bottom of a reservoir well that the pipette can't reach
+    reservoir_dead_vol = 500
+    beads = ReagentLedger(protocol, 'beads', [reagent_reservoir.wells_by_name()[well] for well in bead_wells],
+                          bead_start_vol, reservoir_dead_vol)
+    etoh = ReagentLedger(protocol, 'ethanol', [reagent_reservoir.wells_by_name()[well] for well in etoh_wells],
+                         etoh_start_vol, reservoir_dead_vol)
+    water = ReagentLedger(protocol, 'elution buffer', [reagent_reservoir.wells_by_name()[well] for well in water_wells],
+                          water_start_vol, reservoir_dead_vol)
+    waste = ReagentLedger(protocol, 'waste', [waste_reservoir.wells_by_name()[well] for well in waste_wells], 0)
+
+    # tip parking
+    # the tip that adds beads to a column is parked as its 'sup' tip and used again to take off the supernatant and
+    # the ethanol, then parked as its 'mix' tip for the elution mix
+    # the ethanol adds only touch the tops of the wells, so one tip does all of them
+    tips = TipLedger(protocol, p300m, tips300)
 
 
     # number of sample columns
     num_cols = math.ceil(sample_count / 8)
-    # number of groups for ethanol washes
-    num_groups = math.ceil(num_cols/3)
-    if num_groups == 1:
-        grps = [[0, num_cols]]
-    elif num_groups == 2:
-        grps = [[0, 3], [3, num_cols]]
-    elif num_groups == 3:
-        grps = [[0, 3], [3, 6], [6, num_cols]]
-    elif num_groups == 4:
-        grps = [[0, 3], [3, 6], [6, 9], [9, num_cols]]
-    else:
-        raise Exception("Invalid number of groups")
-
-    # If doing half a plate just elute as normal but if doing a full plate
-    # need to add water halfway through the 2nd ethanol wash so beads aren't overdried
-    if num_groups == 1 or num_groups == 2:
-        elute_groups = 1
-        elute_cols = [[0, num_cols]]
-    elif num_groups == 3 or num_groups == 4:
-        elute_groups = 2
-        elute_cols = [[0, 6], [6, num_cols]]
-    else:
-        raise Exception("Invalid number of groups")
+    # columns that are washed and eluted
+    clean_cols = range(num_cols, 2 * num_cols) if double_sided == 'yes' else range(num_cols)
+
+    # elution buffer goes on each column as soon as it has dried for drying_time, while the other columns are still
+    # being washed, so no column over dries waiting for the rest of the plate
+    # it is added from the top of the wells on the magnet, so one tip does all of them, and the columns are mixed
+    # in the same order once the magnet is off
+    # once the tip is on, it carries on with any other columns that finish drying within lookahead seconds
+    # until is the run time (seconds) the buffer has to be finished by, columns that don't fit are left for later
+    eluted = []
+    def buffer_fits(index, until):
+        # the column's buffer, after waiting for it to finish drying, can go on by until
+        return until is None or timers.now() + timers.remaining('drying', [index], drying_time * 60) + col_step <= until
+
+    def add_elution_buffer(cols, lookahead=0, until=None):
+        cols = [index for index in cols if index not in eluted]
+        if not cols or not buffer_fits(cols[0], until):
+            return
+        p300m.flow_rate.aspirate = 50
+        p300m.flow_rate.dispense = 50
+        if eluted:
+            tips.pick_up('elution', 'water')
+        else:
+            tips.pick_up('elution')
+        while cols and buffer_fits(cols[0], until):
+            index = cols.pop(0)
+            timers.wait_for('drying', [index], drying_time * 60)
+            p300m.transfer(
+                elution_buffer_volume, water.aspirate_from(elution_buffer_volume, p300m.channels),
+                mag_plate.columns()[index][0].top(), new_tip='never')
+            timers.start('buffer', [index])
+            eluted.append(index)
+            if not cols:
+                cols = [index for index in timers.ready('drying', clean_cols, drying_time * 60 - lookahead)
+                        if index not in eluted]
+        tips.park('water')
+
+    def add_due_elution_buffer(lookahead, holding=None, until=None):
+        # columns that finish drying within lookahead seconds get their elution buffer now, instead of waiting for the
+        # pipetting in between. The tip on the pipette, parked as holding, is put back while the buffer goes on, and
+        # the buffer tip carries on with columns that dry within one more column of pipetting (col_step, set once the
+        # supernatant is off)
+        due = [index for index in timers.ready('drying', clean_cols, drying_time * 60 - lookahead)
+               if index not in eluted]
+        if not due or not buffer_fits(due[0], until):
+            return
+        if holding is not None:
+            tips.park(holding)
+        add_elution_buffer(due, col_step, until)
+        if holding is not None:
+            tips.pick_up('ethanol', holding)
+
+    # the reagents and waste the whole run needs, all 8 channels
+    beads.check(draw_vol=(bead_volume + (second_bead_volume if double_sided == 'yes' else 0)) * 8 * num_cols)
+    etoh.check(draw_vol=etoh_volume * 8 * num_cols)
+    water.check(draw_vol=elution_buffer_volume * 8 * num_cols)
+    waste.check(add_vol=(clean_vol + etoh_volume) * 8 * num_cols)
 
     # Add ampure/PEG
+    bead_mixer = BeadMixer(protocol, p300m, timers, bead_mix_interval, bead_mix_drop)
     for index, column in enumerate(mag_plate.columns()[:num_cols]):
-        ccst = capture_current_starting_tip()
-        name_the_tips(ccst[0], ['sup_tips'], [
-            named_tips['current_tip'].well_name])
-        p300m.pick_up_tip()
-        # if adding beads, mix 2 times before pipetting
+        tips.pick_up('beads')
+        # if adding beads, mix 2 times before pipetting if they have had time to settle
         p300m.flow_rate.aspirate = 100
         p300m.flow_rate.dispense = 100
         if beads_peg == 'beads':
-            p300m.mix(2, 150, beads.bottom(1))
+            bead_mixer.before_aspirate(beads.well_for(bead_volume, p300m.channels), bead_volume)
         p300m.flow_rate.aspirate = 50
         p300m.flow_rate.dispense = 50
         # add specified volume of beads/PEG to samples
         p300m.transfer(
-         bead_volume, beads.bottom(1), column[0].bottom(3), new_tip='never')
+         bead_volume, beads.aspirate_from(bead_volume, p300m.channels), column[0].bottom(3), new_tip='never')
         # pipette up and down 5 times
         p300m.mix(5, (bead_volume + PCR_volume), column[0].bottom(2))
         p300m.move_to(column[0].top())
         p300m.blow_out()
         # touch pipette tip to side of wells to knock off any remaining liquid
         p300m.touch_tip()
-        p300m.return_tip()
+        tips.park('sup', index)
+        timers.start('binding', [index])
+
+    # Double sided size selection
+    if double_sided == 'yes':
+        # while the first cut binds, put the second cut's beads in the empty columns
+        # nothing is in the wells yet, so one tip does all of them
+        tips.pick_up('beads')
+        for index in clean_cols:
+            p300m.flow_rate.aspirate = 100
+            p300m.flow_rate.dispense = 100
+            if beads_peg == 'beads':
+                bead_mixer.before_aspirate(beads.well_for(second_bead_volume, p300m.channels), second_bead_volume)
+            p300m.flow_rate.aspirate = 50
+            p300m.flow_rate.dispense = 50
+            p300m.transfer(second_bead_volume, beads.aspirate_from(second_bead_volume, p300m.channels),
+                           mag_plate.columns()[index][0].bottom(1), new_tip='never')
+            p300m.blow_out(mag_plate.columns()[index][0].top())
+        tips.discard()
+
+        timers.wait_for('binding', range(num_cols), incubation_time * 60)
+        mag_deck.engage(height_from_base=engage_height)
+        timers.start('settling', range(num_cols), pipetting=False)
+
+        # move each first cut supernatant onto the second cut's beads with the column's parked tip, the tip and the
+        # sample stay together from here on
+        for index, column in enumerate(mag_plate.columns()[:num_cols]):
+            timers.wait_for('settling', [index], sample_settling * 60)
+            tips.pick_up('beads', 'sup', index)
+            p300m.move_to(column[0].top())
+            p300m.flow_rate.dispense = 100
+            two_stage_draw(protocol, p300m, column[0], total_vol, bulk_aspirate_rate, final_aspirate_rate,
+                           final_draw_volume, bulk_draw_margin)
+            protocol.delay(seconds=1)
+            p300m.dispense(total_vol, mag_plate.columns()[index + num_cols][0].bottom(3))
+            p300m.blow_out(mag_plate.columns()[index + num_cols][0].top())
+            tips.park('sup', index + num_cols)
+            timers.start('supernatant', [index])
+
+        # mix the second cut off the magnet, it binds from when it is mixed
+        mag_deck.disengage()
+        p300m.flow_rate.aspirate = 50
+        p300m.flow_rate.dispense = 50
+        for index in clean_cols:
+            column = mag_plate.columns()[index]
+            tips.pick_up('beads', 'sup', index)
+            # pipette up and down 5 times
+            p300m.mix(5, clean_vol, column[0].bottom(2))
+            p300m.move_to(column[0].top())
+            p300m.blow_out()
+            p300m.touch_tip()
+            tips.park('sup', index)
+            timers.start('binding', [index])
 
     # Incubate beads and DNA at RT
-    msg = "Incubating the beads for "+str(incubation_time)+" minutes. \
-    Protocol will resume automatically."
-    protocol.delay(minutes=incubation_time, msg=msg)
+    # the magnet is shared by the whole plate, so it waits for the last column to finish binding
+    timers.wait_for('binding', clean_cols, incubation_time * 60)
 
     # Engage magdeck
-    mag_deck.engage()
-    protocol.comment("Delaying for "+str(settling_time)+" minutes for \
-beads to settle. Protocol will resume automatically.")
-    protocol.delay(minutes=settling_time)
+    mag_deck.engage(height_from_base=engage_height)
+    timers.start('settling', clean_cols, pipetting=False)
 
     # Aspirate supernatant
-    for index, column in enumerate(mag_plate.columns()[:num_cols]):
-        p300m.pick_up_tip(named_tips['sup_tips'][index])
+    for index in clean_cols:
+        column = mag_plate.columns()[index]
+        timers.wait_for('settling', [index], clean_settling * 60)
+        tips.pick_up('supernatant', 'sup', index)
         p300m.move_to(column[0].top())
-        # aspirate really slowly to limit amount of beads
-        p300m.flow_rate.aspirate = 5
         p300m.flow_rate.dispense = 100
-        # limits up/down movement speed of pipette
-        protocol.max_speeds['Z'] = 10
-        p300m.aspirate(total_vol, column[0].bottom(1))
-        p300m.move_to(column[0].top())
-        protocol.max_speeds['Z'] = None
+        # only the last few ul are aspirated really slowly to limit amount of beads
+        two_stage_draw(protocol, p300m, column[0], clean_vol, bulk_aspirate_rate, final_aspirate_rate,
+                       final_draw_volume, bulk_draw_margin)
         protocol.delay(seconds=1)
         # dispense in waste reservoir
-        p300m.dispense(total_vol, waste_reservoir.wells()[0].top())
-        p300m.blow_out(waste_reservoir.wells()[0].top())
-        p300m.return_tip()
+        waste_top = waste.dispense_to(clean_vol, p300m.channels)
+        p300m.dispense(clean_vol, waste_top)
+        p300m.blow_out(waste_top)
+        tips.park('sup', index)
+        timers.start('supernatant', [index])
     '''
     # EtOH wash 1
-    # loop through groups
+    # not used, one wash is enough. To use it take out the quotes, and fill the ethanol wells for two washes
+    # loop through groups of up to 3 columns
+    num_groups = math.ceil(len(clean_cols) / 3)
+    grps = [[clean_cols.start + 3 * g, min(clean_cols.start + 3 * (g + 1), clean_cols.stop)] for g in range(num_groups)]
     for g in range(0, num_groups):
         p300m.flow_rate.aspirate = 100
         p300m.flow_rate.dispense = 150
-        p300m.pick_up_tip()
+        tips.pick_up('ethanol')
         # add ethanol to each column in current group
         for index, column in enumerate(mag_plate.columns()[grps[g][0]:grps[g][1]], grps[g][0]):
             p300m.transfer(
-                etoh_volume, etoh_1.bottom(1), column[0].top(-1), new_tip='never')
+                etoh_volume, etoh.aspirate_from(etoh_volume, p300m.channels), column[0].top(-1), new_tip='never')
             p300m.move_to(column[0].top())
             p300m.blow_out()
             protocol.delay(seconds=1)
-        p300m.drop_tip()
+        tips.discard()
 
         # Incubate etoh
         # if 3 columns in group, go straight to aspirate
@@ -227,150 +743,145 @@ beads to settle. Protocol will resume automatically.")
 
         # Aspirate etoh using parked tips
         for index, column in enumerate(mag_plate.columns()[grps[g][0]:grps[g][1]], grps[g][0]):
-            p300m.flow_rate.aspirate = 40
             p300m.flow_rate.dispense = 150
-            p300m.pick_up_tip(named_tips['sup_tips'][index])
-            p300m.move_to(column[0].top())
-            protocol.max_speeds['Z'] = 10
-            p300m.aspirate(etoh_volume, column[0].bottom(1))
+            tips.pick_up('ethanol', 'sup', index)
             p300m.move_to(column[0].top())
-            protocol.max_speeds['Z'] = None
+            two_stage_draw(protocol, p300m, column[0], etoh_volume, bulk_aspirate_rate, etoh_final_aspirate_rate,
+                           final_draw_volume, bulk_draw_margin)
             protocol.delay(seconds=1)
             p300m.air_gap(10)
-            p300m.dispense(etoh_volume + 10, waste_reservoir.wells()[0].top())
-            p300m.blow_out(waste_reservoir.wells()[0].top())
-            p300m.return_tip()
+            waste_top = waste.dispense_to(etoh_volume, p300m.channels)
+            p300m.dispense(etoh_volume + 10, waste_top)
+            p300m.blow_out(waste_top)
+            tips.park('sup', index)
     '''
+
     # EtOH wash 2
-    for g in range(0, num_groups):
+    # groups are sized one at a time from the add and removal times per column measured so far (the supernatant
+    # removal stands in for the ethanol removal in the first group, then the group before is used)
+    grps = []
+    add_time = None
+    removal_time = timers.column_time('supernatant', clean_cols)
+    # time (seconds) for one column of pipetting, how far ahead the columns that are drying are checked
+    col_step = removal_time or col_pipetting_time
+
+    def etoh_deadline(cols, steps_first):
+        # run time (seconds) any elution buffer has to be done by so cols, which have their ethanol and are emptied in
+        # this order after steps_first more columns of pipetting, all come out before etoh_max_exposure
+        if not cols:
+            return None
+        return timers.now() + min(timers.remaining('etoh', [col], etoh_max_exposure)
+                                  - (steps_first + pos + 1) * col_step for pos, col in enumerate(cols))
+
+    while not grps or grps[-1][1] < clean_cols.stop:
+        first_col = grps[-1][1] if grps else clean_cols.start
+        buffer_due = [timers.remaining('drying', [index], drying_time * 60)
+                      for index in timers.in_start_order('drying', clean_cols) if index not in eluted]
+        grps.append([first_col, first_col + wash_group_size(etoh_contact_time, etoh_max_exposure, add_time,
+                                                            removal_time, clean_cols.stop - first_col, buffer_due)])
+        g = len(grps) - 1
         p300m.flow_rate.aspirate = 100
         p300m.flow_rate.dispense = 150
-        p300m.pick_up_tip()
+        if g == 0:
+            tips.pick_up('ethanol')
+        else:
+            tips.pick_up('ethanol', 'etoh add')
         # Add etoh
+        if etoh_multi_dispense == 'yes':
+            # dispensing from the top of the well doesn't touch the samples, so one fill can go to several columns
+            group_cols = list(enumerate(mag_plate.columns()[grps[g][0]:grps[g][1]], grps[g][0]))
+            cols_per_fill = max(1, int(min(p300m.max_volume, tips300[0].wells()[0].max_volume) // etoh_volume))
+            for start in range(0, len(group_cols), cols_per_fill):
+                fill = group_cols[start:start + cols_per_fill]
+                fills_left = math.ceil((len(group_cols) - start) / cols_per_fill)
+                add_due_elution_buffer(col_step * (len(fill) - 1), 'etoh add',
+                                       etoh_deadline(list(range(grps[g][0], fill[0][0])), fills_left))
+                p300m.aspirate(etoh_volume * len(fill), etoh.aspirate_from(etoh_volume * len(fill), p300m.channels))
+                for index, column in fill:
+                    p300m.dispense(etoh_volume, column[0].top(-1))
+                    # only the first column of a fill goes to the reservoir, the rest is a quick dispense
+                    timers.start('etoh', [index], pipetting=index == fill[0][0])
+                p300m.move_to(column[0].top())
+                p300m.blow_out()
+                protocol.delay(seconds=1)
+        else:
+            for index, column in enumerate(mag_plate.columns()[grps[g][0]:grps[g][1]], grps[g][0]):
+                add_due_elution_buffer(0, 'etoh add', etoh_deadline(list(range(grps[g][0], index)), grps[g][1] - index))
+                p300m.transfer(
+                    etoh_volume, etoh.aspirate_from(etoh_volume, p300m.channels), column[0].top(-1), new_tip='never')
+                p300m.move_to(column[0].top())
+                p300m.blow_out()
+                protocol.delay(seconds=1)
+                timers.start('etoh', [index])
+        if grps[g][1] < clean_cols.stop:
+            tips.park('etoh add')
+        else:
+            tips.discard()
+        if timers.column_time('etoh', range(*grps[g])) is not None:
+            add_time = timers.column_time('etoh', range(*grps[g]))
+
+        # Aspirate etoh, each column once it has had its contact time
+        # columns that dry before this one's contact time is up and it is pipetted get their elution buffer first, as
+        # long as the columns still to be emptied in the group can all be done before they reach etoh_max_exposure
         for index, column in enumerate(mag_plate.columns()[grps[g][0]:grps[g][1]], grps[g][0]):
-            p300m.transfer(
-                etoh_volume, etoh_2.bottom(1), column[0].top(-1), new_tip='never')
-            p300m.move_to(column[0].top())
-            p300m.blow_out()
-            protocol.delay(seconds=1)
-        p300m.drop_tip()
-
-        # Incubate etoh
-        # if 3 columns in group, go straight to aspirate
-        if grps[g][1]-grps[g][0] == 3:
-            pass
-        # if 1-2 columns, delay for appropriate amount of time
-        elif grps[g][1] - grps[g][0] == 2:
-            etoh_time = 5
-            protocol.comment("Let ethanol sit for " + str(etoh_time) + " seconds. Protocol will resume automatically.")
-            protocol.delay(seconds=etoh_time)
-        elif grps[g][1] - grps[g][0] == 1:
-            etoh_time = 8
-            protocol.comment("Let ethanol sit for " + str(etoh_time) + " seconds. Protocol will resume automatically.")
-            protocol.delay(seconds=etoh_time)
-
-        # Aspirate etoh
-        for index, column in enumerate(mag_plate.columns()[grps[g][0]:grps[g][1]], grps[g][0]):
-            p300m.flow_rate.aspirate = 40
+            add_due_elution_buffer(timers.remaining('etoh', [index], etoh_contact_time),
+                                   until=etoh_deadline(list(range(index, grps[g][1])), 0))
+            timers.wait_for('etoh', [index], etoh_contact_time)
             p300m.flow_rate.dispense = 150
-            p300m.pick_up_tip(named_tips['sup_tips'][index])
-            p300m.move_to(column[0].top())
-            protocol.max_speeds['Z'] = 10
-            p300m.aspirate(etoh_volume, column[0].bottom(1))
+            tips.pick_up('ethanol', 'sup', index)
             p300m.move_to(column[0].top())
-            protocol.max_speeds['Z'] = None
+            two_stage_draw(protocol, p300m, column[0], etoh_volume, bulk_aspirate_rate, etoh_final_aspirate_rate,
+                           final_draw_volume, bulk_draw_margin)
             protocol.delay(seconds=1)
             p300m.air_gap(10)
-            p300m.dispense(etoh_volume+10, waste_reservoir.wells()[0].top())
-            p300m.blow_out(waste_reservoir.wells()[0].top())
-            # if group 2 return tips so we can use them again later for mixing
-            if elute_groups == 2:
-                if g == 0 or g == 1:
-                    p300m.return_tip()
-                # all other tips can go to trash
-                else:
-                    p300m.drop_tip()
-
-        # add water to the first 6 columns if doing a full plate so beads don't over dry
-        # they will be mixed later
-        if elute_groups == 2:
-            # add water after doing 2nd group of columns
-            # zero based indexing so g = 1 is group 2
-            if g == 1:
-                p300m.pick_up_tip()
-                # add counter
-                col_count = 1
-                # add water/elution buffer to samples
-                for index, column in enumerate(mag_plate.columns()[elute_cols[0][0]:elute_cols[0][1]], elute_cols[0][0]):
-                    # if on the 4th column (2nd group) add a delay to let the beads dry a little
-                    if col_count == 4:
-                        msg = "Drying the beads for 2 minutes. Protocol \
-                                        will resume automatically."
-                        protocol.delay(minutes=2, msg=msg)
-                    p300m.transfer(
-                        elution_buffer_volume, water.bottom(1), column[0].top(), new_tip='never')
-                    col_count += 1
-                p300m.drop_tip()
-
-    # Dry at RT
-    # Only needed if doing an odd number of groups
-    if num_groups == 1 or num_groups == 3:
-        msg = "Drying the beads for 2 minutes. Protocol \
-            will resume automatically."
-        protocol.delay(minutes=2, msg=msg)
+            waste_top = waste.dispense_to(etoh_volume, p300m.channels)
+            p300m.dispense(etoh_volume+10, waste_top)
+            p300m.blow_out(waste_top)
+            timers.start('drying', [index])
+            # park the tip to mix the column when it is eluted
+            tips.park('mix', index)
+        if timers.column_time('drying', range(*grps[g])) is not None:
+            removal_time = timers.column_time('drying', range(*grps[g]))
+
+    # the rest of the columns get their elution buffer as each one finishes drying
+    add_elution_buffer(timers.in_start_order('drying', clean_cols))
 
     # Disengage MagDeck
     mag_deck.disengage()
 
-    # Elute DNA
+    # Elute DNA, mixing the columns in the order they got elution buffer
     p300m.flow_rate.aspirate = 50
     p300m.flow_rate.dispense = 50
-    # if one elution group just add water/mix as normal
-    if elute_groups == 1:
-        for index, column in enumerate(mag_plate.columns()[:num_cols]):
-            p300m.pick_up_tip()
-            # add water/elution buffer to samples
-            p300m.transfer(
-                elution_buffer_volume, water.bottom(1), column[0].bottom(3), new_tip='never')
-            # pipette up and down 5 times
-            p300m.mix(5, elution_buffer_volume, column[0].bottom(2))
-            p300m.move_to(column[0].top())
-            p300m.blow_out()
-            p300m.touch_tip()
-            p300m.drop_tip()
-    # if 2 elution groups need to go back and mix water/beads from first group
-    if elute_groups == 2:
-        for index, column in enumerate(mag_plate.columns()[elute_cols[0][0]:elute_cols[0][1]], elute_cols[0][0]):
-            p300m.pick_up_tip(named_tips['sup_tips'][index])
-            p300m.mix(5, elution_buffer_volume, column[0].bottom(2))
-            p300m.move_to(column[0].top())
-            p300m.blow_out()
-            p300m.touch_tip()
-            p300m.drop_tip()
-        # then add water/mix rest of samples
-        for index, column in enumerate(mag_plate.columns()[elute_cols[1][0]:elute_cols[1][1]], elute_cols[1][0]):
-            p300m.pick_up_tip()
-            # add water/elution buffer to samples
-            p300m.transfer(
-                elution_buffer_volume, water.bottom(1), column[0].bottom(3), new_tip='never')
-            # pipette up and down 5 times
-            p300m.mix(5, elution_buffer_volume, column[0].bottom(2))
-            p300m.move_to(column[0].top())
-            p300m.blow_out()
-            p300m.touch_tip()
-            p300m.drop_tip()
+    for index in eluted:
+        column = mag_plate.columns()[index]
+        tips.pick_up('elution', 'mix', index)
+        # pipette up and down 5 times
+        p300m.mix(5, elution_buffer_volume, column[0].bottom(2))
+        p300m.move_to(column[0].top())
+        p300m.blow_out()
+        p300m.touch_tip()
+        tips.discard()
+        timers.start('elution', [index])
 
 # Incubate at RT
-    protocol.comment("Incubating the beads for "+str(settling_time)+" minutes. \
-    Protocol will resume automatically.")
-    protocol.delay(minutes=incubation_time)
+    timers.wait_for('elution', clean_cols, incubation_time * 60)
 
     # engage magnet to clear beads after final elution
     if final_clear is True:
-        mag_deck.engage()
-        protocol.comment("Delaying for "+str(settling_time)+" minutes for \
-            beads to settle.")
-        protocol.delay(minutes=settling_time)
+        mag_deck.engage(height_from_base=engage_height)
+        timers.start('clearing', clean_cols, pipetting=False)
+        timers.wait_for('clearing', clean_cols, elution_settling * 60)
+
+    # the same minimum times as fixed delays for the whole plate: bead incubation, settling, the full ethanol contact
+    # time after each wash group, drying after the last wash, elution incubation and final clear (and the second cut's
+    # incubation and settling if double sided)
+    fixed_wait = (2 * incubation_time + sample_settling + elution_settling + drying_time) * 60 \
+        + etoh_contact_time * len(grps)
+    if double_sided == 'yes':
+        fixed_wait += (incubation_time + clean_settling) * 60
+    timers.report(fixed_wait)
+    bead_mixer.report()
+    tips.report()
 
     # turn off lights
     protocol.set_rail_lights(False)
@@ -0,0 +1,291 @@
+# Work out which deck slot each piece of labware should go in so the gantry travels as little as possible
+# run on a computer, not the robot:
+#   python deck_layout.py standardize input_data.csv --extra-rack none --source-plates 3 --dest-plates 2
+#   python deck_layout.py gtseq input_data.csv --plates 3
+#   python deck_layout.py mm --samples 96,96,48 --racks 3 --change-tip yes --mm-block yes
+#   python deck_layout.py mm --samples 96,96 --racks 2 --strip-stamp yes --mm-vol 5
+#
+# every move the protocol makes (tip rack -> source -> destination -> trash ...) is counted between pairs of
+# labware, and labware that is visited one after the other a lot is put in slots close to each other
+# labware is named by its standard slot (the one used in the protocol's input data), the output is a slot_layout
+# line to paste into the protocol's run options, plus the estimated travel with the standard and the new layout
+# OT-2 slot rules: the trash is always in 12 and the temperature module can only go in 1, 3, 4, 6, 7, 9 or 10
+
+import argparse
+import csv
+
+import numpy as np
+
+DECK_SLOTS = list(range(1, 12))
+TRASH_SLOT = 12
+
+# slots the temperature module gen2 fits in
+TEMP_MODULE_SLOTS = [1, 3, 4, 6, 7, 9, 10]
+
+# distance (mm) between the centres of neighbouring slots
+SLOT_PITCH_X = 132.5
+SLOT_PITCH_Y = 90.5
+
+# tips in one rack
+RACK_SIZE = 96
+
+
+def slot_xy(slots):
+    # deck x/y (mm) of the centre of each slot, slot 1 is front left and slots go left to right, front to back
+    slots = np.asarray(slots) - 1
+    return np.stack([(slots % 3) * SLOT_PITCH_X, (slots // 3) * SLOT_PITCH_Y], axis=-1)
+
+
+def slot_distances():
+    # distance (mm) between every pair of slots 1-12, indexed by slot number
+    xy = slot_xy(np.arange(1, 13))
+    dist = np.zeros((13, 13))
+    dist[1:, 1:] = np.sqrt(((xy[:, None, :] - xy[None, :, :]) ** 2).sum(axis=-1))
+    return dist
+
+
+def read_rows(path, columns):
+    # read the protocol's input data csv, keeping only the named columns
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = [[val.strip() for val in row] for row in csv.reader(f) if row and row[0].strip()]
+    header = [name.lower() for name in rows[0]]
+    for name in columns:
+        if name not in header:
+            raise Exception("Input data is missing the " + name + " column")
+    return [[row[header.index(name)] for name in columns] for row in rows[1:]]
+
+
+class Moves:
+    # how many times the gantry goes from one piece of labware to another, keyed by standard slot
+    def __init__(self):
+        self.counts = {}
+        self.current = None
+
+    def go(self, slot):
+        if self.current is not None and self.current != slot:
+            pair = (self.current, slot)
+            self.counts[pair] = self.counts.get(pair, 0) + 1
+        self.current = slot
+
+
+class TipRacks:
+    # the rack each tip comes from, tips are used up rack by rack in the order the protocol loads them
+    def __init__(self, slots):
+        self.slots = slots
+        self.used = 0
+
+    def next_rack(self):
+        rack = self.slots[min(self.used // RACK_SIZE, len(self.slots) - 1)]
+        self.used += 1
+        return rack
+
+
+def standardize_moves(args):
+    # standard slots: sources 1-3, water 4, destinations 5-6, p20 tips 8-9 and p300 tips 10-11 (7 is the extra rack)
+    rows = read_rows(args.input, ['source_slot', 'dest_slot', 'vol_dna', 'vol_water'])
+    racks = {20: TipRacks([7, 8, 9] if args.extra_rack == '20' else [8, 9]),
+             300: TipRacks([7, 10, 11] if args.extra_rack == '300' else [10, 11])}
+    moves = Moves()
+    # water, one tip on each pipette unless the p20 has to change tips for small volumes on used plates
+    for size in [20, 300]:
+        water = [row for row in rows if 0 < float(row[3]) and (float(row[3]) <= 20) == (size == 20)]
+        if not water:
+            continue
+        moves.go(racks[size].next_rack())
+        for source, dest, vol_dna, vol_water in water:
+            moves.go(4)
+            moves.go(int(dest))
+            if args.status == 'used' and size == 20 and float(vol_water) < 10:
+                moves.go(TRASH_SLOT)
+                moves.go(racks[size].next_rack())
+        moves.go(TRASH_SLOT)
+    # dna, a new tip for every row
+    for source, dest, vol_dna, vol_water in rows:
+        moves.go(racks[20 if float(vol_dna) <= 20 else 300].next_rack())
+        moves.go(int(source))
+        moves.go(int(dest))
+        moves.go(TRASH_SLOT)
+    # every plate standardize.py loads gets a slot, even one no row uses, so no two plates share a deck slot
+    used = set(range(1, 1 + args.source_plates)) | {4} | set(range(5, 5 + args.dest_plates)) \
+        | {slot for tips in racks.values() for slot in tips.slots}
+    if any(int(row[0]) not in range(1, 1 + args.source_plates) or int(row[1]) not in range(5, 5 + args.dest_plates)
+           for row in rows):
+        raise Exception("Input data uses a plate that isn't loaded. Check --source-plates and --dest-plates.")
+    return moves.counts, used, {}
+
+
+def gtseq_moves(args):
+    # standard slots: tube rack 1, tips 2, sample plates 3 on
+    rows = read_rows(args.input, ['source_slot', 'tube_well'])
+    moves = Moves()
+    current_tube = None
+    for source, tube in rows:
+        if tube != current_tube:
+            if current_tube is not None:
+                moves.go(TRASH_SLOT)
+            moves.go(2)
+            current_tube = tube
+        moves.go(int(source))
+        moves.go(1)
+    moves.go(TRASH_SLOT)
+    used = {1, 2} | set(range(3, 3 + args.plates))
+    return moves.counts, used, {}
+
+
+def mm_moves(args):
+    # standard slots: master mix tube 1 (on the temperature module if used), sample plates 2-6, tips 7 on
+    # with strip stamping the strip tube block goes in the slot after the last plate and the multichannel's tip rack
+    # in the slot after the last p20 rack, same as mm_distribute.py
+    samples = [int(val) for val in args.samples.split(',')]
+    racks = TipRacks(list(range(7, 7 + args.racks)))
+    moves = Moves()
+    used = {1} | set(range(2, 2 + len(samples))) | set(racks.slots)
+    if args.strip_stamp == 'yes':
+        if len(samples) > 4 or args.racks > 4:
+            raise Exception("Strip stamping needs an empty plate slot and tip rack slot. Max 4 plates and 4 tip racks.")
+        strip_slot = 2 + len(samples)
+        multi_rack = 7 + args.racks
+        used |= {strip_slot, multi_rack}
+        # samples go by rows, so a column is full once row H reaches it
+        stamped = [(plate, col) for plate, num_samples in enumerate(samples)
+                   for col in range(max(0, min(12, num_samples - 84)))]
+        cols_per_strip = int((200 - args.strip_extra_vol) // args.mm_vol)
+        groups = [stamped[start:start + cols_per_strip] for start in range(0, len(stamped), cols_per_strip)]
+        # fill the strip tubes with one p20 tip
+        if groups:
+            moves.go(racks.next_rack())
+        for group in groups:
+            trips = int(-(-(len(group) * args.mm_vol + args.strip_extra_vol) // 20))
+            for trip in range(8 * trips):
+                moves.go(1)
+                moves.go(strip_slot)
+        if groups:
+            moves.go(TRASH_SLOT)
+            # stamp each full column from its strip column
+            moves.go(multi_rack)
+            for plate, col in stamped:
+                moves.go(strip_slot)
+                moves.go(2 + plate)
+                if args.change_tip == 'yes':
+                    moves.go(TRASH_SLOT)
+                    moves.go(multi_rack)
+            moves.go(TRASH_SLOT)
+        samples = [num_samples - 8 * max(0, min(12, num_samples - 84)) for num_samples in samples]
+    if args.change_tip == 'no':
+        moves.go(racks.next_rack())
+    for plate, num_samples in enumerate(samples):
+        for sample in range(num_samples):
+            if args.change_tip == 'yes':
+                moves.go(racks.next_rack())
+            moves.go(1)
+            moves.go(2 + plate)
+            if args.change_tip == 'yes':
+                moves.go(TRASH_SLOT)
+    moves.go(TRASH_SLOT)
+    allowed = {1: TEMP_MODULE_SLOTS} if args.mm_block == 'yes' else {}
+    return moves.counts, used, allowed
+
+
+def travel(layout, counts, dist):
+    # total travel (mm) for a layout {standard slot: deck slot}, the trash never moves
+    return sum(num * dist[layout.get(a, a), layout.get(b, b)] for (a, b), num in counts.items())
+
+
+def plan_layout(counts, used, allowed):
+    # greedy placement, busiest labware first, then swap pairs and move labware to empty slots until nothing helps
+    dist = slot_distances()
+    labware = sorted(used)
+    weight = {slot: 0 for slot in labware}
+    for (a, b), num in counts.items():
+        for slot in (a, b):
+            if slot in weight:
+                weight[slot] += num
+    layout = {}
+    for slot in sorted(labware, key=lambda slot: (-weight[slot], slot)):
+        options = [deck for deck in allowed.get(slot, DECK_SLOTS) if deck not in layout.values()]
+        if not options:
+            raise Exception("No free slot left for the labware in standard slot " + str(slot))
+        # cost of each option against what is already placed and the trash
+        costs = []
+        for deck in options:
+            cost = 0
+            for (a, b), num in counts.items():
+                if slot not in (a, b):
+                    continue
+                other = b if a == slot else a
+                if other == TRASH_SLOT:
+                    cost += num * dist[deck, TRASH_SLOT]
+                elif other in layout:
+                    cost += num * dist[deck, layout[other]]
+            costs.append(cost)
+        layout[slot] = options[int(np.argmin(costs))]
+
+    best = travel(layout, counts, dist)
+    improved = True
+    while improved:
+        improved = False
+        for slot in labware:
+            free = [deck for deck in allowed.get(slot, DECK_SLOTS) if deck not in layout.values()]
+            swaps = [other for other in labware if other != slot
+                     and layout[other] in allowed.get(slot, DECK_SLOTS)
+                     and layout[slot] in allowed.get(other, DECK_SLOTS)]
+            for deck in free:
+                trial = dict(layout)
+                trial[slot] = deck
+                cost = travel(trial, counts, dist)
+                if cost < best - 1e-6:
+                    layout, best, improved = trial, cost, True
+            for other in swaps:
+                trial = dict(layout)
+                trial[slot], trial[other] = layout[other], layout[slot]
+                cost = travel(trial, counts, dist)
+                if cost < best - 1e-6:
+                    layout, best, improved = trial, cost, True
+    return layout, travel({}, counts, dist), best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find the deck layout with the least gantry travel for a protocol.')
+    protocols = parser.add_subparsers(dest='protocol', required=True)
+    standardize = protocols.add_parser('standardize', help='standardize.py')
+    standardize.add_argument('input', help='csv with the standardize.py input data')
+    standardize.add_argument('--extra-rack', choices=['20', '300', 'none'], default='none',
+                             help='extra_rack_type set in standardize.py (default none)')
+    standardize.add_argument('--source-plates', type=int, choices=[1, 2, 3], default=3,
+                             help='number of source plates loaded in standardize.py (slots 1 on, default 3)')
+    standardize.add_argument('--dest-plates', type=int, choices=[1, 2], default=2,
+                             help='number of destination plates loaded in standardize.py (slots 5 on, default 2)')
+    standardize.add_argument('--status', choices=['clean', 'used'], default='clean',
+                             help='destination_plate_status set in standardize.py (default clean)')
+    gtseq = protocols.add_parser('gtseq', help='gtseq_pool.py')
+    gtseq.add_argument('input', help='csv with the gtseq_pool.py input data')
+    gtseq.add_argument('--plates', type=int, required=True, help='num_plates set in gtseq_pool.py')
+    mm = protocols.add_parser('mm', help='mm_distribute.py')
+    mm.add_argument('--samples', required=True, help='num_samples_each_plate, separated by commas (ex: 96,96,48)')
+    mm.add_argument('--racks', type=int, default=1, help='num_racks set in mm_distribute.py (default 1)')
+    mm.add_argument('--change-tip', choices=['yes', 'no'], default='no',
+                    help='change_tip set in mm_distribute.py (default no)')
+    mm.add_argument('--mm-block', choices=['yes', 'no'], default='no',
+                    help='mm_block set in mm_distribute.py (default no)')
+    mm.add_argument('--strip-stamp', choices=['yes', 'no'], default='no',
+                    help='strip_stamp set in mm_distribute.py (default no)')
+    mm.add_argument('--mm-vol', type=float, default=5, help='mm_vol set in mm_distribute.py (default 5)')
+    mm.add_argument('--strip-extra-vol', type=float, default=5,
+                    help='strip_extra_vol set in mm_distribute.py (default 5)')
+    args = parser.parse_args(argv)
+
+    protocol_moves = {'standardize': standardize_moves, 'gtseq': gtseq_moves, 'mm': mm_moves}
+    counts, used, allowed = protocol_moves[args.protocol](args)
+    layout, before, after = plan_layout(counts, used, allowed)
+
+    for slot in sorted(layout):
+        print("standard slot " + str(slot) + " -> deck slot " + str(layout[slot]))
+    print("Estimated gantry travel: " + str(round(before / 1000, 1)) + " m with the standard slots, "
+          + str(round(after / 1000, 1)) + " m with this layout (" + str(round((before - after) / 1000, 1))
+          + " m saved)")
+    print("Paste this into the protocol's run options:")
+    print("    slot_layout = {" + ', '.join(str(slot) + ': ' + str(layout[slot]) for slot in sorted(layout)) + "}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
 # one pcr plate worth of samples half skirt inserted into alumninum block or green skirt plate
 # into 1.5 ml tube
 
+import collections
+
+import numpy as np
+
 metadata = {
     'protocolName': 'GTSeq pool ',
     'author': 'AMB, last updated 4/18/22',
@@ -8,6 +12,118 @@ metadata = {
     'apiLevel': '2.11'
 }
 
+# one row of the pasted csv once it has been checked
+Pool = collections.namedtuple('Pool', ['source_slot', 'source_well', 'tube_well', 'vol_dna'])
+
+# a well and the locations used for it, looked up once instead of on every row
+WellRef = collections.namedtuple('WellRef', ['well', 'top'])
+
+# well names on a 96 well plate and in a 24 tube rack
+WELL_NAMES_96 = [row + str(col) for row in 'ABCDEFGH' for col in range(1, 13)]
+TUBE_NAMES_24 = [row + str(col) for row in 'ABCD' for col in range(1, 7)]
+
+# volume (ul) each 1.5 ml tube can hold
+TUBE_CAPACITY = 1500
+
+
+def parse_table(text, columns):
+    # parse a pasted csv block (first line is the header) into a table of columns {name: numpy array}
+    # columns is a list of (name, type) in csv order, where type is int, float, or str
+    # returns the table, the rows as text (for messages) and a list of problems found
+    rows = [[val.strip() for val in line.split(',')]
+            for line in text.splitlines()
+            if line.split(',')[0].strip()][1:]
+    errors = []
+    values = {name: [] for name, kind in columns}
+    for row in rows:
+        if len(row) != len(columns):
+            errors.append("Row " + ','.join(row) + ": expected " + str(len(columns)) + " values")
+        for index, (name, kind) in enumerate(columns):
+            try:
+                values[name].append(kind(row[index]))
+            except (IndexError, ValueError):
+                errors.append("Row " + ','.join(row) + ": invalid " + name)
+                values[name].append(kind())
+    table = {name: np.array(values[name], dtype=kind) for name, kind in columns}
+    return table, [','.join(row) for row in rows], errors
+
+
+def compile_plan(input_data, plate_slots):
+    # check every row of the pasted csv in one pass, before anything moves, and turn it into a fixed list of pools
+    # plate_slots is the list of slots with sample plates loaded
+    table, rows, errors = parse_table(input_data, [('source_slot', int), ('source_well', str), ('tube_well', str),
+                                                   ('vol_dna', float)])
+    vol_dna = np.round(table['vol_dna'], 2)
+    # total volume going into each tube
+    unique_tubes, tube_index = np.unique(table['tube_well'], return_inverse=True)
+    tube_totals = np.bincount(tube_index.reshape(-1), weights=vol_dna, minlength=len(unique_tubes))
+    checks = [
+        (~np.isin(table['source_slot'], plate_slots), "Invalid source slot. Must be one of " + str(plate_slots)),
+        (~np.isin(table['source_well'], WELL_NAMES_96), "Invalid source well"),
+        (~np.isin(table['tube_well'], TUBE_NAMES_24), "Invalid tube well"),
+        ((vol_dna < 1.0) | (vol_dna > 20.0), "Invalid volume of dna. Must be between 1.0-20.0"),
+        (tube_totals[tube_index.reshape(-1)] > TUBE_CAPACITY, "Tube would be overfilled"),
+    ]
+    for failed, message in checks:
+        errors += ["Row " + rows[index] + ": " + message for index in np.flatnonzero(failed)]
+    if errors:
+        raise Exception("Problems found in input data:\n" + '\n'.join(errors))
+    return tuple(Pool(int(table['source_slot'][index]), str(table['source_well'][index]),
+                      str(table['tube_well'][index]), float(vol_dna[index])) for index in range(len(rows)))
+
+
+def build_well_index(labwares):
+    # map (slot, well name) to the well and its top location for every plate and tube rack in labwares
+    # ({slot: labware}, e.g. protocol.loaded_labwares). Build it once, after all labware is loaded
+    index = {}
+    for slot, labware in labwares.items():
+        if labware.is_tiprack:
+            continue
+        for well in labware.wells():
+            index[(slot, well.well_name)] = WellRef(well, well.top())
+    return index
+
+
+def diff_plan(previous_plan, plan):
+    # compare the plan with one that has already been run and keep only what still has to be added
+    # rows are matched on source well and tube, volumes can only go up since nothing can be taken back out
+    # returns the new plan, the number of added and changed rows, and the rows that are no longer in the input
+    def totals(pools):
+        sums = {}
+        for pool in pools:
+            key = (pool.source_slot, pool.source_well, pool.tube_well)
+            if key in sums:
+                sums[key] = sums[key]._replace(vol_dna=round(sums[key].vol_dna + pool.vol_dna, 2))
+            else:
+                sums[key] = pool
+        return sums
+
+    old = totals(previous_plan)
+    new = totals(plan)
+    errors = []
+    delta_plan = []
+    added = 0
+    changed = 0
+    for key, pool in new.items():
+        name = ','.join(str(val) for val in key)
+        if key not in old:
+            delta_plan.append(pool)
+            added += 1
+            continue
+        extra_dna = round(pool.vol_dna - old[key].vol_dna, 2)
+        if extra_dna < 0:
+            errors.append("Row " + name + ": volume is lower than what was already added")
+        elif 0 < extra_dna < 1.0:
+            errors.append("Row " + name + ": extra dna (" + str(extra_dna) + " ul) is too small to pipette")
+        elif extra_dna > 0:
+            delta_plan.append(pool._replace(vol_dna=extra_dna))
+            changed += 1
+    if errors:
+        raise Exception("Problems found comparing with the previous input data:\n" + '\n'.join(errors))
+    removed = [','.join(str(val) for val in key) for key in old if key not in new]
+    return tuple(delta_plan), added, changed, removed
+
+
 def run(protocol):
     ########## EDIT THESE RUN OPTIONS AS NEEDED ##########
 
@@ -17,6 +133,12 @@ def run(protocol):
     # number of plates (integar, max 9)
     num_plates = 3
 
+    # deck slot to load each piece of labware in (paste the slot_layout line printed by deck_layout.py here)
+    # keys are the standard slots (tubes 1, tips 2, plates 3-11), values are the deck slots to use instead.
+    # input_data keeps using the standard slots. ex: {1: 4, 4: 1} swaps the tubes and the 2nd plate
+    # leave empty ({}) to use the standard slots
+    slot_layout = {}
+
     # sample volume info
     # paste data from csv here (in between '''  ''')
     input_data = '''
@@ -47,6 +169,13 @@ def run(protocol):
     5,A6,B1,10
     '''
 
+    # re-run only what changed since an earlier run into the same tubes
+    # paste the input data that was already run here (in between '''  ''') and the new data above
+    # new rows are done in full, for rows with a higher volume only the extra dna is added
+    # leave empty for a normal run
+    previous_input_data = '''
+    '''
+
     ########## DO NOT EDIT BELOW THIS LINE ##########
 
     # turn on lights if not on already
@@ -55,57 +184,74 @@ def run(protocol):
     # checks
     if pipette_mount_20 is None:
         raise Exception("Must attach single channel p20")
+    # deck slot for each standard slot
+    deck = {slot: slot_layout.get(slot, slot) for slot in range(1, 12)}
+    slot_range = list(range(3, 3 + num_plates))
+    # standard slots that get labware in this run, no two of them can end up in the same deck slot
+    loaded = [1, 2] + slot_range
+    if any(slot not in range(1, 12) for slot in list(slot_layout) + list(slot_layout.values())) \
+            or len({deck[slot] for slot in loaded}) != len(loaded):
+        raise Exception("Invalid slot layout. Slots must be 1-11 and each deck slot can only be used once.")
+
+    # check the input data and build the plan before any labware is loaded or moved
+    plan = compile_plan(input_data, slot_range)
+    if previous_input_data.strip():
+        previous_plan = compile_plan(previous_input_data, slot_range)
+        plan, added, changed, removed = diff_plan(previous_plan, plan)
+        protocol.comment("Re-run: " + str(added) + " new rows and " + str(changed) + " changed rows to do.")
+        if removed:
+            protocol.comment("Rows no longer in the input data are left as they are: " + ', '.join(removed))
+        # the tubes already hold the earlier pool, so a tip that has been in a tube doesn't go back to a plate
+        if len(plan) > 96:
+            raise Exception("A re-run uses a new tip for every transfer, so it can't have more than 96 rows to do.")
 
     # Define hardware, pipettes/tips, plates
     # load tips
     tips20 = [protocol.load_labware(
-            'opentrons_96_tiprack_20ul', str(slot)) for slot in [
+            'opentrons_96_tiprack_20ul', str(deck[slot])) for slot in [
             2]]
 
     # specify pipette, mount location, and tips
     p20 = protocol.load_instrument("p20_single_gen2", mount=pipette_mount_20, tip_racks=tips20)
 
     # load reagent labware and specify reagents in each well/columns
-    tube_rack = protocol.load_labware('opentrons_24_aluminumblock_nest_1.5ml_snapcap', 1)
+    tube_slot = 1
+    protocol.load_labware('opentrons_24_aluminumblock_nest_1.5ml_snapcap', str(deck[tube_slot]))
 
     # load plates
-    slot_range = list(range(3, 3 + num_plates))
-    [protocol.load_labware('vwr_96_wellplate_200ul_greenplate', str(slot)) for slot in slot_range]
-
-    # parse input data
-    csv_data = [[val.strip() for val in line.split(',')]
-                for line in input_data.splitlines()
-                if line.split(',')[0].strip()][1:]
+    [protocol.load_labware('vwr_96_wellplate_200ul_greenplate', str(deck[slot])) for slot in slot_range]
 
     # set aspirate and dispense speeds
     p20.flow_rate.aspirate = 150
     p20.flow_rate.dispense = 150
 
+    # look up every well once, the loop below goes through this instead of the labware
+    wells = build_well_index({slot: protocol.loaded_labwares[deck[slot]] for slot in deck
+                              if deck[slot] in protocol.loaded_labwares})
 
-    p20.pick_up_tip()
+    # a re-run changes tips for every transfer, see the checks above
+    rerun = bool(previous_input_data.strip())
+    if not rerun:
+        p20.pick_up_tip()
     # set starting tube
     current_tube = 'A1'
     # add dna to tube
-    for row in csv_data:
-        source_well = protocol.loaded_labwares[int(row[0])].wells_by_name()[row[1]]
-        dest_tube = tube_rack.wells_by_name()[row[2]]
-        vol_dna = float(row[3])
-        vol_dna = round(vol_dna, 2)
+    for pool in plan:
+        source_well = wells[(pool.source_slot, pool.source_well)].well
+        dest_tube = wells[(tube_slot, pool.tube_well)].well
+        vol_dna = pool.vol_dna
         # if the new destination tube isnt the same as what the previous run, change tips
-        if row[2] != current_tube:
+        if pool.tube_well != current_tube and not rerun:
             p20.drop_tip()
             p20.pick_up_tip()
-        # check volume
-        if vol_dna < 1.0 or vol_dna > 20.0:
-            raise Exception("Invalid volume of dna. Must be between 1.0-20.0")
-        # round to 2 decimal places
-        vol_dna = round(vol_dna, 2)
         p20.transfer(vol_dna, source_well, dest_tube, blow_out=True,
-                         blowout_location='destination well', touch_tip=True, new_tip='never')
+                         blowout_location='destination well', touch_tip=True,
+                         new_tip='always' if rerun else 'never')
         # update current tube to compare on next round
-        current_tube = row[2]
+        current_tube = pool.tube_well
 
-    p20.drop_tip()
+    if not rerun:
+        p20.drop_tip()
 
     ### make sure the tube checking thing works ###
 
@@ -1,3 +1,9 @@
+import collections
+import math
+import time
+
+import numpy as np
+
 metadata = {
     'protocolName': 'Ligation prep',
     'author': 'AMB, last updated 5/6/22',
@@ -6,6 +12,224 @@ metadata = {
 }
 
 
+# one row of the pasted barcode csv once it has been checked
+Barcode = collections.namedtuple('Barcode', ['barcode_well', 'dest_slot', 'dest_well'])
+
+# a well and the locations used for it, looked up once instead of on every row
+WellRef = collections.namedtuple('WellRef', ['well', 'top'])
+
+# well names on a 96 well plate
+WELL_NAMES_96 = [row + str(col) for row in 'ABCDEFGH' for col in range(1, 13)]
+
+# volume (ul) each well can hold for each plate type
+WELL_CAPACITY = {'nest_100ul': 100, 'biorad_200ul': 200}
+
+# well names on a 96 well plate in each order the plate can be worked through
+# 'row' goes across the rows (A1, A2 ... A12, B1 ...), 'column' goes down the columns (A1, B1 ... H1, A2 ...) and
+# 'serpentine' goes across row A, back along row B and so on, so the pipette never jumps across the plate
+WELL_ORDERS = {
+    'row': WELL_NAMES_96,
+    'column': [row + str(col) for col in range(1, 13) for row in 'ABCDEFGH'],
+    'serpentine': [row + str(col) for num, row in enumerate('ABCDEFGH')
+                   for col in (range(1, 13) if num % 2 == 0 else range(12, 0, -1))],
+}
+
+# bit number of each well in a well mask (row order, which is also how sample counts are given)
+WELL_BITS = {well: bit for bit, well in enumerate(WELL_ORDERS['row'])}
+
+# labware for each sample plate type
+PLATE_LABWARE = {
+    'nest_100ul': 'nest_96_wellplate_100ul_pcr_full_skirt',
+    'biorad_200ul': 'biorad_96_wellplate_200ul_pcr',
+}
+
+
+def parse_table(text, columns):
+    # parse a pasted csv block (first line is the header) into a table of columns {name: numpy array}
+    # columns is a list of (name, type) in csv order, where type is int, float, or str
+    # returns the table, the rows as text (for messages) and a list of problems found
+    rows = [[val.strip() for val in line.split(',')]
+            for line in text.splitlines()
+            if line.split(',')[0].strip()][1:]
+    errors = []
+    values = {name: [] for name, kind in columns}
+    for row in rows:
+        if len(row) != len(columns):
+            errors.append("Row " + ','.join(row) + ": expected " + str(len(columns)) + " values")
+        for index, (name, kind) in enumerate(columns):
+            try:
+                values[name].append(kind(row[index]))
+            except (IndexError, ValueError):
+                errors.append("Row " + ','.join(row) + ": invalid " + name)
+                values[name].append(kind())
+    table = {name: np.array(values[name], dtype=kind) for name, kind in columns}
+    return table, [','.join(row) for row in rows], errors
+
+
+def compile_plan(barcode_data, plate_slots, well_capacity, P1_vol, mm_vol):
+    # check every row of the pasted barcode csv in one pass, before anything moves, and turn it into a fixed list
+    # plate_slots is the list of slots with sample plates loaded
+    table, rows, errors = parse_table(barcode_data, [('barcode_well', str), ('dest_slot', int), ('dest_well', str)])
+    # each sample well should only get one barcode
+    dest_keys = np.char.add(np.char.add(table['dest_slot'].astype(str), ':'), table['dest_well'])
+    unique_keys, key_index = np.unique(dest_keys, return_inverse=True)
+    barcode_counts = np.bincount(key_index.reshape(-1), minlength=len(unique_keys))[key_index.reshape(-1)]
+    checks = [
+        (~np.isin(table['barcode_well'], WELL_NAMES_96), "Invalid barcode well"),
+        (~np.isin(table['dest_slot'], plate_slots), "Invalid destination slot. Must be one of " + str(plate_slots)),
+        (~np.isin(table['dest_well'], WELL_NAMES_96), "Invalid destination well"),
+        (barcode_counts > 1, "Destination well gets more than one barcode"),
+        (barcode_counts * P1_vol + mm_vol > well_capacity, "Destination well would be overfilled"),
+    ]
+    for failed, message in checks:
+        errors += ["Row " + rows[index] + ": " + message for index in np.flatnonzero(failed)]
+    if errors:
+        raise Exception("Problems found in barcode data:\n" + '\n'.join(errors))
+    return tuple(Barcode(str(table['barcode_well'][index]), int(table['dest_slot'][index]),
+                         str(table['dest_well'][index])) for index in range(len(rows)))
+
+
+def well_mask(wells):
+    # bitset with a bit set for each well name, so checking a well is a bit test instead of a list scan
+    mask = 0
+    for well in wells:
+        if well not in WELL_BITS:
+            raise Exception("Invalid well name " + str(well))
+        mask |= 1 << WELL_BITS[well]
+    return mask
+
+
+# mask of each plate column, keyed by column number as text
+COLUMN_MASKS = {str(col): well_mask(row + str(col) for row in 'ABCDEFGH') for col in range(1, 13)}
+
+
+def sample_mask(num_samples, skip_wells):
+    # mask of the wells that have samples: the first num_samples wells in row order less the skipped wells
+    if num_samples < 0 or num_samples > 96:
+        raise Exception("Invalid number of samples. Must be 0-96")
+    return ((1 << num_samples) - 1) & ~well_mask(skip_wells)
+
+
+def wells_in_order(mask, well_order):
+    # names of the wells in a mask, in the chosen well order ('row', 'column' or 'serpentine')
+    if well_order not in WELL_ORDERS:
+        raise Exception("Invalid well order. Must be 'row', 'column', or 'serpentine'")
+    return [well for well in WELL_ORDERS[well_order] if mask >> WELL_BITS[well] & 1]
+
+
+def load_plates(protocol, plate_type, slots):
+    # load a sample plate of plate_type in each slot, in order
+    if plate_type not in PLATE_LABWARE:
+        raise Exception("Invalid sample plate type")
+    return [protocol.load_labware(PLATE_LABWARE[plate_type], str(slot), 'sample plate ' + str(num))
+            for num, slot in enumerate(slots, 1)]
+
+
+def well_area(well):
+    # cross section (mm2) of a round or rectangular well
+    if well.diameter is not None:
+        return math.pi * (well.diameter / 2) ** 2
+    return well.length * well.width
+
+
+def well_height(well, vol):
+    # height (mm) of vol (ul) of liquid above the bottom of a well
+    # the well is taken as a straight well with a cone at the bottom, with the cone sized so the well holds its rated
+    # volume at its full depth (from the labware definition)
+    if vol <= 0:
+        return 0.0
+    area = well_area(well)
+    cone_height = min(well.depth, max(0.0, 1.5 * (well.depth - well.max_volume / area)))
+    cone_vol = area * cone_height / 3
+    if vol < cone_vol:
+        return cone_height * (vol / cone_vol) ** (1 / 3)
+    return min(well.depth, cone_height + (vol - cone_vol) / area)
+
+
+class ReagentLedger:
+    # volume (ul) in every well used for one reagent, or for waste, in the order the wells are used
+    # reagent is drawn from the first well with enough left above its dead volume and waste goes into the first well
+    # with room left below its fill limit, so the run moves on to the next well by itself instead of running a well
+    # dry or over filling it. Aspirates are made from just under where the surface will be after the aspirate
+    def __init__(self, protocol, name, wells, start_vol, dead_vol=0, fill_limit=None, submerge=2):
+        self.protocol = protocol
+        self.name = name
+        self.wells = wells
+        self.start_vol = start_vol
+        self.vols = [start_vol for well in wells]
+        self.dead_vol = dead_vol
+        self.fill_limit = [fill_limit or well.max_volume for well in wells]
+        self.submerge = submerge
+        self.current = 0
+        for well, limit in zip(wells, self.fill_limit):
+            if start_vol < 0 or start_vol > limit:
+                raise Exception("Invalid " + name + " volume. Must be 0-" + str(limit) + " ul")
+
+    def check(self, draw_vol=0, add_vol=0):
+        # stop before the run starts if the wells can't supply draw_vol or hold add_vol (ul, all channels)
+        available = sum(max(0, vol - self.dead_vol) for vol in self.vols)
+        room = sum(limit - vol for vol, limit in zip(self.vols, self.fill_limit))
+        if draw_vol > available:
+            raise Exception("The run needs " + str(round(draw_vol)) + " ul of " + self.name + " but the "
+                            + str(len(self.wells)) + " well(s) only have " + str(round(available)) + " ul above "
+                            "the dead volume. Add another well or fill them higher.")
+        if add_vol > room:
+            raise Exception("The run puts " + str(round(add_vol)) + " ul into the " + self.name + " but the "
+                            + str(len(self.wells)) + " well(s) only have room for " + str(round(room))
+                            + " ul. Add another well or empty them.")
+
+    def switch(self, ok, msg):
+        # move on to the first well from the current one where ok(index) is true
+        # if there isn't one (check() wasn't used or the volumes were off) pause with msg for the wells to be reset
+        start = self.current
+        while self.current < len(self.wells) and not ok(self.current):
+            self.current += 1
+        if self.current == len(self.wells):
+            self.protocol.pause(msg)
+            self.vols = [self.start_vol for well in self.wells]
+            self.current = 0
+            return
+        if self.current != start:
+            self.protocol.comment("Switching " + self.name + " to well " + self.wells[self.current].well_name + ".")
+
+    def well_for(self, vol, channels=1):
+        # the well the next aspirate of vol (ul per channel) will come from
+        self.switch(lambda index: self.vols[index] - vol * channels >= self.dead_vol,
+                    "The " + self.name + " wells are almost empty. Refill them to " + str(self.start_vol)
+                    + " ul and resume.")
+        return self.wells[self.current]
+
+    def aspirate_from(self, vol, channels=1):
+        # where to aspirate vol (ul per channel) from
+        well = self.well_for(vol, channels)
+        self.vols[self.current] = max(0, self.vols[self.current] - vol * channels)
+        return well.bottom(max(1.0, well_height(well, self.vols[self.current]) - self.submerge))
+
+    def put_back(self, vol, channels=1):
+        # liquid blown back into the well it came from, returns where to blow it out
+        self.vols[self.current] = min(self.vols[self.current] + vol * channels, self.fill_limit[self.current])
+        return self.wells[self.current].top()
+
+    def dispense_to(self, vol, channels=1):
+        # where to dispense vol (ul per channel) of waste
+        self.switch(lambda index: self.vols[index] + vol * channels <= self.fill_limit[index],
+                    "The " + self.name + " wells are almost full. Empty them and resume.")
+        self.vols[self.current] += vol * channels
+        return self.wells[self.current].top()
+
+
+def build_well_index(labwares):
+    # map (slot, well name) to the well and its top location for every plate and tube rack in labwares
+    # ({slot: labware}, e.g. protocol.loaded_labwares). Build it once, after all labware is loaded
+    index = {}
+    for slot, labware in labwares.items():
+        if labware.is_tiprack:
+            continue
+        for well in labware.wells():
+            index[(slot, well.well_name)] = WellRef(well, well.top())
+    return index
+
+
 def run(protocol):
     ########## EDIT THESE RUN OPTIONS AS NEEDED ##########
 
@@ -15,6 +239,11 @@ def run(protocol):
     # number of sample plates (integar, max:2)
     sample_plates = 2
 
+    # order to go through the wells of each plate ('row', 'column', or 'serpentine', all lowercase and in single quotes)
+    # 'row' goes A1, A2 ... A12, B1 ..., 'column' goes A1, B1 ... H1, A2 ... and 'serpentine' goes across row A and back
+    # along row B so the pipette doesn't jump across the plate at the end of each row
+    well_order = 'row'
+
     # number of samples in each plate (list of integers, surrounded by brackets and separated by commas)
     # ex: [96, 12, 72]
     # (will go by rows, i.e. 12 would mean samples A1-A12, 30 would mean A1-C6)
@@ -38,6 +267,24 @@ def run(protocol):
     # volume (ul) of P1 adapter (barcodes) to add
     P1_vol = 2.0
 
+    # volume (ul) of master mix in the tube at the start
+    # used to follow the liquid level down the tube, the protocol pauses for a refill before the tube runs dry
+    mm_start_vol = 1000
+
+    # fill strip tubes from the master mix tube and add master mix to full plate columns with a p20 multichannel
+    # ('yes' or 'no', all lowercase and in single quotes)
+    # the strip tubes go in the last empty columns (12, then 11 ...) of the P1 adapter block, those columns can't have
+    # barcodes in them. Tips for the multichannel go in slot 11 (and 4 if more than 12 columns are stamped)
+    # columns with skipped or missing wells get master mix from the single channel as usual
+    strip_stamp = 'no'
+
+    # location of p20 multichannel ('left' or 'right', all lowercase and in single quotes)
+    # only used if strip_stamp = 'yes'
+    pipette_mount_multi = 'left'
+
+    # extra master mix (ul) put in each strip tube on top of what the columns need
+    strip_extra_vol = 5
+
     barcode_data = '''
     barcode_well, dest_slot, dest_well
     A1,5,A1
@@ -57,6 +304,15 @@ def run(protocol):
     # checks
     if len(num_samples_each_plate) != sample_plates:
         raise Exception("The number of sample plates does not match the number of samples for each plate.")
+    if mm_vol < 1 or mm_vol > 20 or P1_vol < 1 or P1_vol > 20:
+        raise Exception("Invalid volume of master mix or P1 adapter. Must be between 1-20 ul")
+    if plate_type not in WELL_CAPACITY:
+        raise Exception('Invalid destination plate type')
+    if well_order not in WELL_ORDERS:
+        raise Exception("Invalid well order. Must be 'row', 'column', or 'serpentine'")
+
+    # check the barcode data and build the plan before any labware is loaded or moved
+    plan = compile_plan(barcode_data, [5, 6][:sample_plates], WELL_CAPACITY[plate_type], P1_vol, mm_vol)
 
     # Define hardware
     # load tip racks
@@ -67,83 +323,129 @@ def run(protocol):
     p20 = protocol.load_instrument("p20_single_gen2", mount=pipette_mount_20, tip_racks=tips20)
 
     # load plates
-    plate_names = []
-    # add first sample plate
-    if plate_type == 'nest_100ul':
-        plate_1 = protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '5', 'sample plate 1')
-        plate_names.append(plate_1)
-    elif plate_type == 'biorad_200ul':
-        plate_1 = protocol.load_labware('biorad_96_wellplate_200ul_pcr', '5', 'sample plate 1')
-        plate_names.append(plate_1)
-    else:
-        raise Exception('Invalid destination plate type')
-    # add 2nd destination plate
-    if sample_plates == 2:
-        if plate_type == 'biorad_200ul':
-            plate_2 = protocol.load_labware('biorad_96_wellplate_200ul_pcr', '6', 'sample plate 2')
-            plate_names.append(plate_2)
-        elif plate_type == 'nest_100ul':
-            plate_2 = protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '6', 'sample plate 2')
-            plate_names.append(plate_2)
-        else:
-            raise Exception('Invalid destination plate type')
+    plate_names = load_plates(protocol, plate_type, [5, 6][:sample_plates])
 
     # load temperature module, tube rack, and mater mix
+    # the block starts cooling now, barcodes go in while it does and it is only waited on right before the first
+    # master mix aspirate
     temp_mod = protocol.load_module('temperature module gen2', '1')
-    temp_mod.set_temperature(4)  # set temp block temperature
+    temp_mod.start_set_temperature(4)  # set temp block temperature
     tube_rack = temp_mod.load_labware('opentrons_24_aluminumblock_nest_1.5ml_snapcap', 'master mix tube')
     mm_tube = tube_rack.wells_by_name()['A1']
+    mm_source = ReagentLedger(protocol, 'master mix', [mm_tube], mm_start_vol, dead_vol=20)
+    block_ready = False
+
+    def await_block():
+        # wait for the temperature module the first time master mix is about to be taken up, and log how long it took
+        nonlocal block_ready
+        if block_ready:
+            return
+        wait_start = time.monotonic()
+        temp_mod.await_temperature(4)
+        protocol.comment("Waited " + str(round(time.monotonic() - wait_start)) + " seconds for the temperature "
+                         "module to reach " + str(4) + " C.")
+        block_ready = True
 
     # load P1 adapters
-    adapter_plate = protocol.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', '2',
-                                         'P1 adapter strip tubes')
+    adapter_slot = 2
+    protocol.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', adapter_slot, 'P1 adapter strip tubes')
 
     # set aspirate and dispense speeds
     p20.flow_rate.aspirate = 150
     p20.flow_rate.dispense = 150
 
-    # parse input data
-    csv_data = [[val.strip() for val in line.split(',')]
-                for line in barcode_data.splitlines()
-                if line.split(',')[0].strip()][1:]
-
-    # list of possible wells
-    well_names = ['A1', 'A2', 'A3', 'A4', 'A5', 'A6', 'A7', 'A8', 'A9', 'A10', 'A11', 'A12',
-                  'B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B9', 'B10', 'B11', 'B12',
-                  'C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12',
-                  'D1', 'D2', 'D3', 'D4', 'D5', 'D6', 'D7', 'D8', 'D9', 'D10', 'D11', 'D12',
-                  'E1', 'E2', 'E3', 'E4', 'E5', 'E6', 'E7', 'E8', 'E9', 'E10', 'E11', 'E12',
-                  'F1', 'F2', 'F3', 'F4', 'F5', 'F6', 'F7', 'F8', 'F9', 'F10', 'F11', 'F12',
-                  'G1', 'G2', 'G3', 'G4', 'G5', 'G6', 'G7', 'G8', 'G9', 'G10', 'G11', 'G12',
-                  'H1', 'H2', 'H3', 'H4', 'H5', 'H6', 'H7', 'H8', 'H9', 'H10', 'H11', 'H12']
+    # list of wells to skip for each plate
+    wells_skip = [P1_skip, P2_skip]
+    # wells with samples on each plate
+    sample_masks = [sample_mask(num_samples_each_plate[num_plate], wells_skip[num_plate])
+                    for num_plate in range(0, len(plate_names))]
+
+    # plate columns that get master mix from the multichannel, as (plate slot, column)
+    # and the adapter block columns their master mix goes in
+    stamped = []
+    strip_groups = []
+    multi = None
+    if strip_stamp == 'yes':
+        for num_plate in range(0, len(plate_names)):
+            for col, col_mask in COLUMN_MASKS.items():
+                if sample_masks[num_plate] & col_mask == col_mask:
+                    stamped.append((5 + num_plate, col))
+        # each strip tube holds master mix for as many columns as fit, then the next strip column is used
+        cols_per_strip = int((200 - strip_extra_vol) // mm_vol)
+        groups = [stamped[start:start + cols_per_strip] for start in range(0, len(stamped), cols_per_strip)]
+        barcode_cols = {barcode.barcode_well[1:] for barcode in plan}
+        spare_cols = [str(col) for col in range(12, 0, -1) if str(col) not in barcode_cols]
+        if len(groups) > len(spare_cols):
+            raise Exception("Not enough empty columns in the P1 adapter block for the master mix strip tubes.")
+        strip_groups = list(zip(spare_cols, groups))
+        # a new tip for every column, 12 columns in each rack
+        tips_multi = [protocol.load_labware('opentrons_96_tiprack_20ul', str(slot))
+                      for slot in [11, 4][:(len(stamped) + 11) // 12]]
+        multi = protocol.load_instrument("p20_multi_gen2", mount=pipette_mount_multi, tip_racks=tips_multi)
+        multi.flow_rate.aspirate = 150
+        multi.flow_rate.dispense = 150
+        protocol.comment(str(len(stamped)) + " columns will get master mix from " + str(len(strip_groups))
+                         + " strip column(s) with the multichannel.")
+    elif strip_stamp != 'no':
+        raise Exception("Strip stamping not indicated. Must be 'yes' or 'no'.")
+    # wells left for the single channel on each plate
+    for plate_slot, col in stamped:
+        sample_masks[plate_slot - 5] &= ~COLUMN_MASKS[col]
+
+    # master mix needed from the tube, checked before anything moves
+    mm_needed = (sum(bin(mask).count('1') for mask in sample_masks) * mm_vol
+                 + 8 * sum(len(group) * mm_vol + strip_extra_vol for strip_col, group in strip_groups))
+    if mm_needed > mm_start_vol - mm_source.dead_vol:
+        protocol.comment("The master mix tube needs " + str(round(mm_needed + mm_source.dead_vol, 1))
+                         + " ul but starts with " + str(mm_start_vol) + " ul. The protocol will pause to refill it "
+                         "before it runs dry.")
+
+    # look up every well once, the loops below go through this instead of the labware
+    wells = build_well_index(protocol.loaded_labwares)
 
     # add barcodes
-    for row in csv_data:
-        source_well = adapter_plate.wells_by_name()[row[0]]
-        dest_well = protocol.loaded_labwares[int(row[1])].wells_by_name()[row[2]]
+    for barcode in plan:
+        source_well = wells[(adapter_slot, barcode.barcode_well)]
+        dest_well = wells[(barcode.dest_slot, barcode.dest_well)]
         p20.pick_up_tip()
-        p20.aspirate(P1_vol, source_well)
+        p20.aspirate(P1_vol, source_well.well)
         p20.touch_tip()
-        p20.dispense(P1_vol, dest_well.bottom())
-        p20.move_to(dest_well.top())
+        p20.dispense(P1_vol, dest_well.well.bottom())
+        p20.move_to(dest_well.top)
         p20.blow_out()
         p20.touch_tip()
         p20.drop_tip()
 
     # distribute master mix
-    # list of wells to skip for each plate
-    wells_skip = [P1_skip, P2_skip]
+    # fill the strip tubes with the single channel, same tip the whole time since it only touches master mix
+    if strip_groups:
+        p20.pick_up_tip()
+        await_block()
+        for strip_col, group in strip_groups:
+            for row in 'ABCDEFGH':
+                # split into equal trips if it's more than a tip full
+                strip_vol = len(group) * mm_vol + strip_extra_vol
+                trips = int(-(-strip_vol // p20.max_volume))
+                for trip in range(trips):
+                    p20.aspirate(strip_vol / trips, mm_source.aspirate_from(strip_vol / trips))
+                    p20.dispense(strip_vol / trips, wells[(adapter_slot, row + strip_col)].well)
+        p20.drop_tip()
+    # stamp each full column from its strip column
+    for strip_col, group in strip_groups:
+        for plate_slot, col in group:
+            multi.pick_up_tip()
+            multi.aspirate(mm_vol, wells[(adapter_slot, 'A' + strip_col)].well)
+            multi.dispense(mm_vol, wells[(plate_slot, 'A' + col)].top)
+            multi.blow_out()
+            multi.drop_tip()
 
     for num_plate in range(0, len(plate_names)):
-        for sample in range(0, num_samples_each_plate[num_plate]):
-            plate = plate_names[num_plate]
-            sample_name = well_names[sample]
-            # move on to next iteration of loop if sample name is in the skip list for this plate
-            if sample_name in wells_skip[num_plate]:
-                continue
+        plate_slot = 5 + num_plate
+        for sample_name in wells_in_order(sample_masks[num_plate], well_order):
             p20.pick_up_tip()
-            p20.aspirate(mm_vol, mm_tube)
-            p20.dispense(mm_vol, plate.wells_by_name()[sample_name].top())
+            await_block()
+            p20.aspirate(mm_vol, mm_source.aspirate_from(mm_vol))
+            p20.dispense(mm_vol, wells[(plate_slot, sample_name)].top)
             p20.blow_out()
             #p20.touch_tip()
             p20.drop_tip()
@@ -1,3 +1,5 @@
+import math
+
 metadata = {
     'protocolName': 'Distribute master mix into sample plates',
     'author': 'AMB, last updated 3/28/22',
@@ -5,6 +7,142 @@ metadata = {
     'apiLevel': '2.11'
 }
 
+# well names on a 96 well plate in each order the plate can be worked through
+# 'row' goes across the rows (A1, A2 ... A12, B1 ...), 'column' goes down the columns (A1, B1 ... H1, A2 ...) and
+# 'serpentine' goes across row A, back along row B and so on, so the pipette never jumps across the plate
+WELL_ORDERS = {
+    'row': [row + str(col) for row in 'ABCDEFGH' for col in range(1, 13)],
+    'column': [row + str(col) for col in range(1, 13) for row in 'ABCDEFGH'],
+    'serpentine': [row + str(col) for num, row in enumerate('ABCDEFGH')
+                   for col in (range(1, 13) if num % 2 == 0 else range(12, 0, -1))],
+}
+
+# bit number of each well in a well mask (row order, which is also how sample counts are given)
+WELL_BITS = {well: bit for bit, well in enumerate(WELL_ORDERS['row'])}
+
+# labware for each sample plate type
+PLATE_LABWARE = {
+    'nest_100ul': 'nest_96_wellplate_100ul_pcr_full_skirt',
+    'biorad_200ul': 'biorad_96_wellplate_200ul_pcr',
+}
+
+
+def well_mask(wells):
+    # bitset with a bit set for each well name, so checking a well is a bit test instead of a list scan
+    mask = 0
+    for well in wells:
+        if well not in WELL_BITS:
+            raise Exception("Invalid well name " + str(well))
+        mask |= 1 << WELL_BITS[well]
+    return mask
+
+
+def sample_mask(num_samples, skip_wells):
+    # mask of the wells that have samples: the first num_samples wells in row order less the skipped wells
+    if num_samples < 0 or num_samples > 96:
+        raise Exception("Invalid number of samples. Must be 0-96")
+    return ((1 << num_samples) - 1) & ~well_mask(skip_wells)
+
+
+def wells_in_order(mask, well_order):
+    # names of the wells in a mask, in the chosen well order ('row', 'column' or 'serpentine')
+    if well_order not in WELL_ORDERS:
+        raise Exception("Invalid well order. Must be 'row', 'column', or 'serpentine'")
+    return [well for well in WELL_ORDERS[well_order] if mask >> WELL_BITS[well] & 1]
+
+
+def well_area(well):
+    # cross section (mm2) of a round or rectangular well
+    if well.diameter is not None:
+        return math.pi * (well.diameter / 2) ** 2
+    return well.length * well.width
+
+
+def well_height(well, vol):
+    # height (mm) of vol (ul) of liquid above the bottom of a well
+    # the well is taken as a straight well with a cone at the bottom, with the cone sized so the well holds its rated
+    # volume at its full depth (from the labware definition)
+    if vol <= 0:
+        return 0.0
+    area = well_area(well)
+    cone_height = min(well.depth, max(0.0, 1.5 * (well.depth - well.max_volume / area)))
+    cone_vol = area * cone_height / 3
+    if vol < cone_vol:
+        return cone_height * (vol / cone_vol) ** (1 / 3)
+    return min(well.depth, cone_height + (vol - cone_vol) / area)
+
+
+class ReagentLedger:
+    # volume (ul) in every well used for one reagent, or for waste, in the order the wells are used
+    # reagent is drawn from the first well with enough left above its dead volume and waste goes into the first well
+    # with room left below its fill limit, so the run moves on to the next well by itself instead of running a well
+    # dry or over filling it. Aspirates are made from just under where the surface will be after the aspirate
+    def __init__(self, protocol, name, wells, start_vol, dead_vol=0, fill_limit=None, submerge=2):
+        self.protocol = protocol
+        self.name = name
+        self.wells = wells
+        self.start_vol = start_vol
+        self.vols = [start_vol for well in wells]
+        self.dead_vol = dead_vol
+        self.fill_limit = [fill_limit or well.max_volume for well in wells]
+        self.submerge = submerge
+        self.current = 0
+        for well, limit in zip(wells, self.fill_limit):
+            if start_vol < 0 or start_vol > limit:
+                raise Exception("Invalid " + name + " volume. Must be 0-" + str(limit) + " ul")
+
+    def check(self, draw_vol=0, add_vol=0):
+        # stop before the run starts if the wells can't supply draw_vol or hold add_vol (ul, all channels)
+        available = sum(max(0, vol - self.dead_vol) for vol in self.vols)
+        room = sum(limit - vol for vol, limit in zip(self.vols, self.fill_limit))
+        if draw_vol > available:
+            raise Exception("The run needs " + str(round(draw_vol)) + " ul of " + self.name + " but the "
+                            + str(len(self.wells)) + " well(s) only have " + str(round(available)) + " ul above "
+                            "the dead volume. Add another well or fill them higher.")
+        if add_vol > room:
+            raise Exception("The run puts " + str(round(add_vol)) + " ul into the " + self.name + " but the "
+                            + str(len(self.wells)) + " well(s) only have room for " + str(round(room))
+                            + " ul. Add another well or empty them.")
+
+    def switch(self, ok, msg):
+        # move on to the first well from the current one where ok(index) is true
+        # if there isn't one (check() wasn't used or the volumes were off) pause with msg for the wells to be reset
+        start = self.current
+        while self.current < len(self.wells) and not ok(self.current):
+            self.current += 1
+        if self.current == len(self.wells):
+            self.protocol.pause(msg)
+            self.vols = [self.start_vol for well in self.wells]
+            self.current = 0
+            return
+        if self.current != start:
+            self.protocol.comment("Switching " + self.name + " to well " + self.wells[self.current].well_name + ".")
+
+    def well_for(self, vol, channels=1):
+        # the well the next aspirate of vol (ul per channel) will come from
+        self.switch(lambda index: self.vols[index] - vol * channels >= self.dead_vol,
+                    "The " + self.name + " wells are almost empty. Refill them to " + str(self.start_vol)
+                    + " ul and resume.")
+        return self.wells[self.current]
+
+    def aspirate_from(self, vol, channels=1):
+        # where to aspirate vol (ul per channel) from
+        well = self.well_for(vol, channels)
+        self.vols[self.current] = max(0, self.vols[self.current] - vol * channels)
+        return well.bottom(max(1.0, well_height(well, self.vols[self.current]) - self.submerge))
+
+    def put_back(self, vol, channels=1):
+        # liquid blown back into the well it came from, returns where to blow it out
+        self.vols[self.current] = min(self.vols[self.current] + vol * channels, self.fill_limit[self.current])
+        return self.wells[self.current].top()
+
+    def dispense_to(self, vol, channels=1):
+        # where to dispense vol (ul per channel) of waste
+        self.switch(lambda index: self.vols[index] + vol * channels <= self.fill_limit[index],
+                    "The " + self.name + " wells are almost full. Empty them and resume.")
+        self.vols[self.current] += vol * channels
+        return self.wells[self.current].top()
+
 
 def run(protocol):
     ########## EDIT THESE RUN OPTIONS AS NEEDED ##########
@@ -24,6 +162,11 @@ def run(protocol):
     # if nothing than don't put anything between brackets
     well_skip = ['A1', 'A2']
 
+    # order to go through the wells ('row', 'column', or 'serpentine', all lowercase and in single quotes)
+    # 'row' goes A1, A2 ... A12, B1 ..., 'column' goes A1, B1 ... H1, A2 ... and 'serpentine' goes across row A and back
+    # along row B so the pipette doesn't jump across the plate at the end of each row
+    well_order = 'row'
+
     # sample plate type ('biorad_200ul' or 'nest_100ul', all lowercase and in single quotes)
     plate_type = 'biorad_200ul'
 
@@ -33,6 +176,10 @@ def run(protocol):
     # mix after pipetting master mix into sample ('yes' or 'no', all lowercase and in single quotes)
     mix_sample = 'no'
 
+    # volume (ul) of master mix in the tube at the start
+    # used to follow the liquid level down the tube, the protocol pauses for a refill before the tube runs dry
+    mm_start_vol = 1500
+
     barcode_data = '''
     barcode_well,sample_well
     A1,A1
@@ -49,20 +196,18 @@ def run(protocol):
     # Define hardware
     # load thermocycler module & sample plate
     thermo_mod = protocol.load_module('thermocycler module')
-    if plate_type == 'biorad_200ul':
-        thermo_plate = thermo_mod.load_labware('biorad_96_wellplate_200ul_pcr')
-    elif plate_type == 'nest_100ul':
-        thermo_plate = thermo_mod.load_labware('nest_96_wellplate_100ul_pcr_full_skirt')
-    else:
+    if plate_type not in PLATE_LABWARE:
         raise Exception("Invalid sample plate type")
+    thermo_plate = thermo_mod.load_labware(PLATE_LABWARE[plate_type])
 
     # load temperature module, tube rack, and mater mix
-    temp_mod = protocol.load_module('temperature module gen 2', '1')
+    temp_mod = protocol.load_module('temperature module gen2', '1')
     temp_tube_rack = temp_mod.load_labware('opentrons_24_aluminumblock_generic_2ml_screwcap')
     mm_tube = temp_tube_rack.wells_by_name()['A1']
+    mm_source = ReagentLedger(protocol, 'master mix', [mm_tube], mm_start_vol, dead_vol=20)
 
     # load P1 adapters
-    adapter_plate = protocol.load_module('opentrons_96_aluminumblock_generic_pcr_strip_200ul', '2',
+    adapter_plate = protocol.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', '2',
                                          'P1 adapter strip tubes')
 
 
@@ -78,35 +223,24 @@ def run(protocol):
 
 
 
-    # list of possible wells
-    well_names = ['A1', 'A2', 'A3', 'A4', 'A5', 'A6', 'A7', 'A8', 'A9', 'A10', 'A11', 'A12',
-                  'B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B9', 'B10', 'B11', 'B12',
-                  'C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12',
-                  'D1', 'D2', 'D3', 'D4', 'D5', 'D6', 'D7', 'D8', 'D9', 'D10', 'D11', 'D12',
-                  'E1', 'E2', 'E3', 'E4', 'E5', 'E6', 'E7', 'E8', 'E9', 'E10', 'E11', 'E12',
-                  'F1', 'F2', 'F3', 'F4', 'F5', 'F6', 'F7', 'F8', 'F9', 'F10', 'F11', 'F12',
-                  'G1', 'G2', 'G3', 'G4', 'G5', 'G6', 'G7', 'G8', 'G9', 'G10', 'G11', 'G12',
-                  'H1', 'H2', 'H3', 'H4', 'H5', 'H6', 'H7', 'H8', 'H9', 'H10', 'H11', 'H12']
-
-    # list of wells to skip for each plate
-    wells_skip = [P1_skip, P2_skip, P3_skip, P4_skip, P5_skip]
-
     # distribute master mix
-    for num_plate in range(0, len(plate_names)):
-        for sample in range(0, num_samples_each_plate[num_plate]):
-            plate = plate_names[num_plate]
-            sample_name = well_names[sample]
-            # move on to next iteration of loop if sample name is in the skip list for this plate
-            if sample_name in wells_skip[num_plate]:
-                continue
-            if mix_sample == 'yes':
-                p20.transfer(mm_vol, mm_tube, plate.wells_by_name()[sample_name], mix_after=(3, mm_vol),
-                             blow_out=True, blowout_location='destination well', touch_tip=True, new_tip='always')
-            elif mix_sample == 'no':
-                p20.transfer(mm_vol, mm_tube, plate.wells_by_name()[sample_name],
-                             blow_out=True, blowout_location='destination well', touch_tip=True, new_tip='always')
-            else:
-                raise Exception('Must indicate if sample should be mixed after adding master mix')
+    sample_wells = wells_in_order(sample_mask(num_samples, well_skip), well_order)
+    # master mix needed from the tube, checked before anything moves
+    mm_needed = len(sample_wells) * mm_vol
+    if mm_needed > mm_start_vol - mm_source.dead_vol:
+        protocol.comment("The master mix tube needs " + str(round(mm_needed + mm_source.dead_vol, 1))
+                         + " ul but starts with " + str(mm_start_vol) + " ul. The protocol will pause to refill it "
+                         "before it runs dry.")
+    for sample_name in sample_wells:
+        if mix_sample == 'yes':
+            p20.transfer(mm_vol, mm_source.aspirate_from(mm_vol), thermo_plate.wells_by_name()[sample_name],
+                         mix_after=(3, mm_vol), blow_out=True, blowout_location='destination well', touch_tip=True,
+                         new_tip='always')
+        elif mix_sample == 'no':
+            p20.transfer(mm_vol, mm_source.aspirate_from(mm_vol), thermo_plate.wells_by_name()[sample_name],
+                         blow_out=True, blowout_location='destination well', touch_tip=True, new_tip='always')
+        else:
+            raise Exception('Must indicate if sample should be mixed after adding master mix')
 
 
     # turn off lights when protocol compelte
@@ -1,3 +1,6 @@
+import math
+import time
+
 metadata = {
     'protocolName': 'Distribute master mix into sample plates',
     'author': 'AMB, last updated 5/3/22',
@@ -5,6 +8,155 @@ metadata = {
     'apiLevel': '2.11'
 }
 
+# well names on a 96 well plate in each order the plate can be worked through
+# 'row' goes across the rows (A1, A2 ... A12, B1 ...), 'column' goes down the columns (A1, B1 ... H1, A2 ...) and
+# 'serpentine' goes across row A, back along row B and so on, so the pipette never jumps across the plate
+WELL_ORDERS = {
+    'row': [row + str(col) for row in 'ABCDEFGH' for col in range(1, 13)],
+    'column': [row + str(col) for col in range(1, 13) for row in 'ABCDEFGH'],
+    'serpentine': [row + str(col) for num, row in enumerate('ABCDEFGH')
+                   for col in (range(1, 13) if num % 2 == 0 else range(12, 0, -1))],
+}
+
+# bit number of each well in a well mask (row order, which is also how sample counts are given)
+WELL_BITS = {well: bit for bit, well in enumerate(WELL_ORDERS['row'])}
+
+# labware for each sample plate type
+PLATE_LABWARE = {
+    'nest_100ul': 'nest_96_wellplate_100ul_pcr_full_skirt',
+    'biorad_200ul': 'biorad_96_wellplate_200ul_pcr',
+    'strip_tubes': 'opentrons_96_aluminumblock_generic_pcr_strip_200ul',
+}
+
+
+def well_mask(wells):
+    # bitset with a bit set for each well name, so checking a well is a bit test instead of a list scan
+    mask = 0
+    for well in wells:
+        if well not in WELL_BITS:
+            raise Exception("Invalid well name " + str(well))
+        mask |= 1 << WELL_BITS[well]
+    return mask
+
+
+# mask of each plate column, keyed by column number as text
+COLUMN_MASKS = {str(col): well_mask(row + str(col) for row in 'ABCDEFGH') for col in range(1, 13)}
+
+
+def sample_mask(num_samples, skip_wells):
+    # mask of the wells that have samples: the first num_samples wells in row order less the skipped wells
+    if num_samples < 0 or num_samples > 96:
+        raise Exception("Invalid number of samples. Must be 0-96")
+    return ((1 << num_samples) - 1) & ~well_mask(skip_wells)
+
+
+def wells_in_order(mask, well_order):
+    # names of the wells in a mask, in the chosen well order ('row', 'column' or 'serpentine')
+    if well_order not in WELL_ORDERS:
+        raise Exception("Invalid well order. Must be 'row', 'column', or 'serpentine'")
+    return [well for well in WELL_ORDERS[well_order] if mask >> WELL_BITS[well] & 1]
+
+
+def well_area(well):
+    # cross section (mm2) of a round or rectangular well
+    if well.diameter is not None:
+        return math.pi * (well.diameter / 2) ** 2
+    return well.length * well.width
+
+
+def well_height(well, vol):
+    # height (mm) of vol (ul) of liquid above the bottom of a well
+    # the well is taken as a straight well with a cone at the bottom, with the cone sized so the well holds its rated
+    # volume at its full depth (from the labware definition)
+    if vol <= 0:
+        return 0.0
+    area = well_area(well)
+    cone_height = min(well.depth, max(0.0, 1.5 * (well.depth - well.max_volume / area)))
+    cone_vol = area * cone_height / 3
+    if vol < cone_vol:
+        return cone_height * (vol / cone_vol) ** (1 / 3)
+    return min(well.depth, cone_height + (vol - cone_vol) / area)
+
+
+class ReagentLedger:
+    # volume (ul) in every well used for one reagent, or for waste, in the order the wells are used
+    # reagent is drawn from the first well with enough left above its dead volume and waste goes into the first well
+    # with room left below its fill limit, so the run moves on to the next well by itself instead of running a well
+    # dry or over filling it. Aspirates are made from just under where the surface will be after the aspirate
+    def __init__(self, protocol, name, wells, start_vol, dead_vol=0, fill_limit=None, submerge=2):
+        self.protocol = protocol
+        self.name = name
+        self.wells = wells
+        self.start_vol = start_vol
+        self.vols = [start_vol for well in wells]
+        self.dead_vol = dead_vol
+        self.fill_limit = [fill_limit or well.max_volume for well in wells]
+        self.submerge = submerge
+        self.current = 0
+        for well, limit in zip(wells, self.fill_limit):
+            if start_vol < 0 or start_vol > limit:
+                raise Exception("Invalid " + name + " volume. Must be 0-" + str(limit) + " ul")
+
+    def check(self, draw_vol=0, add_vol=0):
+        # stop before the run starts if the wells can't supply draw_vol or hold add_vol (ul, all channels)
+        available = sum(max(0, vol - self.dead_vol) for vol in self.vols)
+        room = sum(limit - vol for vol, limit in zip(self.vols, self.fill_limit))
+        if draw_vol > available:
+            raise Exception("The run needs " + str(round(draw_vol)) + " ul of " + self.name + " but the "
+                            + str(len(self.wells)) + " well(s) only have " + str(round(available)) + " ul above "
+                            "the dead volume. Add another well or fill them higher.")
+        if add_vol > room:
+            raise Exception("The run puts " + str(round(add_vol)) + " ul into the " + self.name + " but the "
+                            + str(len(self.wells)) + " well(s) only have room for " + str(round(room))
+                            + " ul. Add another well or empty them.")
+
+    def switch(self, ok, msg):
+        # move on to the first well from the current one where ok(index) is true
+        # if there isn't one (check() wasn't used or the volumes were off) pause with msg for the wells to be reset
+        start = self.current
+        while self.current < len(self.wells) and not ok(self.current):
+            self.current += 1
+        if self.current == len(self.wells):
+            self.protocol.pause(msg)
+            self.vols = [self.start_vol for well in self.wells]
+            self.current = 0
+            return
+        if self.current != start:
+            self.protocol.comment("Switching " + self.name + " to well " + self.wells[self.current].well_name + ".")
+
+    def well_for(self, vol, channels=1):
+        # the well the next aspirate of vol (ul per channel) will come from
+        self.switch(lambda index: self.vols[index] - vol * channels >= self.dead_vol,
+                    "The " + self.name + " wells are almost empty. Refill them to " + str(self.start_vol)
+                    + " ul and resume.")
+        return self.wells[self.current]
+
+    def aspirate_from(self, vol, channels=1):
+        # where to aspirate vol (ul per channel) from
+        well = self.well_for(vol, channels)
+        self.vols[self.current] = max(0, self.vols[self.current] - vol * channels)
+        return well.bottom(max(1.0, well_height(well, self.vols[self.current]) - self.submerge))
+
+    def put_back(self, vol, channels=1):
+        # liquid blown back into the well it came from, returns where to blow it out
+        self.vols[self.current] = min(self.vols[self.current] + vol * channels, self.fill_limit[self.current])
+        return self.wells[self.current].top()
+
+    def dispense_to(self, vol, channels=1):
+        # where to dispense vol (ul per channel) of waste
+        self.switch(lambda index: self.vols[index] + vol * channels <= self.fill_limit[index],
+                    "The " + self.name + " wells are almost full. Empty them and resume.")
+        self.vols[self.current] += vol * channels
+        return self.wells[self.current].top()
+
+
+def load_plates(protocol, plate_type, slots):
+    # load a sample plate of plate_type in each slot, in order
+    if plate_type not in PLATE_LABWARE:
+        raise Exception("Invalid sample plate type")
+    return [protocol.load_labware(PLATE_LABWARE[plate_type], str(slot), 'sample plate ' + str(num))
+            for num, slot in enumerate(slots, 1)]
+
 
 def run(protocol):
     ########## EDIT THESE RUN OPTIONS AS NEEDED ##########
@@ -37,9 +189,38 @@ def run(protocol):
     # if mixing sample after dispensing, should be 'yes'
     change_tip = 'no'
 
+    # how master mix is added ('single' or 'multi', all lowercase and in single quotes)
+    # 'single' goes back to the master mix tube for every well
+    # 'multi' fills the tip and dispenses into several wells in a row (only if change_tip = 'no' and mix_sample = 'no')
+    dispense_mode = 'single'
+
+    # extra master mix (ul) taken up with each multi-dispense and blown back into the tube at the end
+    # (only used if dispense_mode = 'multi')
+    disposal_vol = 2
+
+    # fill strip tubes from the master mix tube and add master mix to full plate columns with a p20 multichannel
+    # ('yes' or 'no', all lowercase and in single quotes)
+    # the strip tubes go in column 1 (then 2, 3 ... if more master mix is needed) of an aluminum block in the first
+    # empty plate slot, and a 20 ul tip rack for the multichannel in the first empty tip rack slot
+    # (max 4 plates and 4 racks)
+    # columns with skipped or missing wells get master mix from the single channel as usual
+    strip_stamp = 'no'
+
+    # location of p20 multichannel ('left' or 'right', all lowercase and in single quotes)
+    # only used if strip_stamp = 'yes'
+    pipette_mount_multi = 'left'
+
+    # extra master mix (ul) put in each strip tube on top of what the columns need
+    strip_extra_vol = 5
+
     # number of 20 ul tip racks loaded (integer, max: 5, should match the number of sample plates if changing tips between wells)
     num_racks = 1
 
+    # order to go through the wells of each plate ('row', 'column', or 'serpentine', all lowercase and in single quotes)
+    # 'row' goes A1, A2 ... A12, B1 ..., 'column' goes A1, B1 ... H1, A2 ... and 'serpentine' goes across row A and back
+    # along row B so the pipette doesn't jump across the plate at the end of each row
+    well_order = 'row'
+
     # number of samples in each plate (list of integers, surrounded by brackets and separated by commas)
     # ex: [96, 12, 72]
     # (will go by rows, i.e. 12 would mean samples A1-A12, 30 would mean A1-C6)
@@ -63,6 +244,16 @@ def run(protocol):
     # type of tube containing master mix ('1.5ml' or '2ml', all lowercase and in single quotes)
     mm_tube_type = '1.5ml'
 
+    # volume (ul) of master mix in the tube at the start
+    # used to follow the liquid level down the tube, the protocol pauses for a refill before the tube runs dry
+    mm_start_vol = 1000
+
+    # deck slot to load each piece of labware in (paste the slot_layout line printed by deck_layout.py here)
+    # keys are the standard slots (master mix 1, sample plates 2-6, tips 7-11), values are the deck slots to use
+    # instead. The temperature module can only go in 1, 3, 4, 6, 7, 9 or 10
+    # ex: {1: 4, 4: 1} swaps the master mix and sample plate 3. Leave empty ({}) to use the standard slots
+    slot_layout = {}
+
     ########## DO NOT EDIT BELOW THIS LINE ##########
 
     # turn on lights if not on already
@@ -71,83 +262,45 @@ def run(protocol):
     # checks
     if len(num_samples_each_plate) != sample_plates:
         raise Exception("The number of sample plates does not match the number of samples for each plate.")
+    if well_order not in WELL_ORDERS:
+        raise Exception("Invalid well order. Must be 'row', 'column', or 'serpentine'")
+    if dispense_mode not in ['single', 'multi']:
+        raise Exception("Dispense mode not indicated. Must be 'single' or 'multi'.")
+    if dispense_mode == 'multi':
+        if change_tip != 'no' or mix_sample != 'no':
+            raise Exception("Multi-dispense only works with change_tip = 'no' and mix_sample = 'no'")
+        if disposal_vol < 0 or mm_vol + disposal_vol > 20:
+            raise Exception("Invalid disposal volume. Master mix volume plus disposal volume must be 0-20 ul")
+    # deck slot for each standard slot
+    deck = {slot: slot_layout.get(slot, slot) for slot in range(1, 12)}
+    # standard slots that get labware in this run, no two of them can end up in the same deck slot
+    loaded = [1] + list(range(2, 2 + sample_plates)) + list(range(7, 7 + num_racks))
+    if strip_stamp == 'yes':
+        loaded += [2 + sample_plates, 7 + num_racks]
+    if any(slot not in range(1, 12) for slot in list(slot_layout) + list(slot_layout.values())) \
+            or len({deck[slot] for slot in loaded}) != len(loaded):
+        raise Exception("Invalid slot layout. Slots must be 1-11 and each deck slot can only be used once.")
+    if mm_block == 'yes' and deck[1] not in [1, 3, 4, 6, 7, 9, 10]:
+        raise Exception("Invalid slot layout. The temperature module must be in slot 1, 3, 4, 6, 7, 9 or 10.")
 
     # Define hardware
     # load designated number of tip racks
     slot_range = list(range(7, 7 + num_racks))
     tips20 = [protocol.load_labware(
-            'opentrons_96_tiprack_20ul', str(slot)) for slot in slot_range]
+            'opentrons_96_tiprack_20ul', str(deck[slot])) for slot in slot_range]
 
     # specify pipette, mount location, and tips
     p20 = protocol.load_instrument("p20_single_gen2", mount=pipette_mount_20, tip_racks=tips20)
 
     # load plates
-    plate_names = []
-    # add 1st plate
-    if plate_type == 'nest_100ul':
-        plate_1 = protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '2', 'sample plate 1')
-        plate_names.append(plate_1)
-    elif plate_type == 'biorad_200ul':
-        plate_1 = protocol.load_labware('biorad_96_wellplate_200ul_pcr', '2', 'sample plate 1')
-        plate_names.append(plate_1)
-    elif plate_type == "strip_tubes":
-        plate_1 = protocol.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', '2', 'sample plate 1')
-        plate_names.append(plate_1)
-    else:
-        raise Exception("Invalid source plate type")
-
-    # add 2nd plate
-    if sample_plates > 1:
-        if plate_type == 'nest_100ul':
-            plate_2 = protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '3', 'sample plate 2')
-            plate_names.append(plate_2)
-        elif plate_type == 'biorad_200ul':
-            plate_2 = protocol.load_labware('biorad_96_wellplate_200ul_pcr', '3', 'sample plate 2')
-            plate_names.append(plate_2)
-        elif plate_type == "strip_tubes":
-            plate_2 = protocol.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', '3', 'sample plate 2')
-            plate_names.append(plate_2)
-
-    # add 3rd plate
-    if sample_plates > 2:
-        if plate_type == 'nest_100ul':
-            plate_3 = protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '4', 'sample plate 3')
-            plate_names.append(plate_3)
-        elif plate_type == 'biorad_200ul':
-            plate_3 = protocol.load_labware('biorad_96_wellplate_200ul_pcr', '4', 'sample plate 3')
-            plate_names.append(plate_3)
-        elif plate_type == "strip_tubes":
-            plate_3 = protocol.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', '4', 'sample plate 3')
-            plate_names.append(plate_3)
-
-    # add 4th plate
-    if sample_plates > 3:
-        if plate_type == 'nest_100ul':
-            plate_4 = protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '5', 'sample plate 4')
-            plate_names.append(plate_4)
-        elif plate_type == 'biorad_200ul':
-            plate_4 = protocol.load_labware('biorad_96_wellplate_200ul_pcr', '5', 'sample plate 4')
-            plate_names.append(plate_4)
-        elif plate_type == "strip_tubes":
-            plate_4 = protocol.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', '5', 'sample plate 4')
-            plate_names.append(plate_4)
-
-    # add 5th plate
-    if sample_plates > 4:
-        if plate_type == 'nest_100ul':
-            plate_5 = protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '6', 'sample plate 5')
-            plate_names.append(plate_5)
-        elif plate_type == 'biorad_200ul':
-            plate_5 = protocol.load_labware('biorad_96_wellplate_200ul_pcr', '6', 'sample plate 5')
-            plate_names.append(plate_5)
-        elif plate_type == "strip_tubes":
-            plate_5 = protocol.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', '6', 'sample plate 5')
-            plate_names.append(plate_5)
+    plate_names = load_plates(protocol, plate_type, [deck[slot] for slot in range(2, 2 + sample_plates)])
 
     # add master mix tube/plate & temp block if specified
+    # the block starts cooling now and is only waited on right before the first master mix aspirate
+    temp_mod = None
     if mm_block == 'yes':
-        temp_mod = protocol.load_module('temperature module gen2', '1')
-        temp_mod.set_temperature(mm_temp) # set temp block temperature
+        temp_mod = protocol.load_module('temperature module gen2', str(deck[1]))
+        temp_mod.start_set_temperature(mm_temp) # set temp block temperature
         if mm_tube_type == '1.5ml':
             tube_rack = temp_mod.load_labware('opentrons_24_aluminumblock_nest_1.5ml_snapcap', 'master mix tube')
         elif mm_tube_type == '2ml':
@@ -156,60 +309,161 @@ def run(protocol):
             raise Exception('Invalid tube type for master mix.')
     elif mm_block == 'no':
         if mm_tube_type == '1.5ml':
-            tube_rack = protocol.load_labware('opentrons_24_aluminumblock_nest_1.5ml_snapcap', '1', 'master mix tube')
+            tube_rack = protocol.load_labware('opentrons_24_aluminumblock_nest_1.5ml_snapcap', str(deck[1]),
+                                              'master mix tube')
         elif mm_tube_type == '2ml':
-            tube_rack = protocol.load_labware('opentrons_24_tuberack_generic_2ml_screwcap', '1', 'master mix tube')
+            tube_rack = protocol.load_labware('opentrons_24_tuberack_generic_2ml_screwcap', str(deck[1]),
+                                              'master mix tube')
         else:
             raise Exception('Invalid tube type for master mix.')
     else:
         raise Exception("Did not specify if temperature block should be used. Should be 'yes' or 'no'")
 
     mm_tube = tube_rack.wells_by_name()['A1']
+    mm_source = ReagentLedger(protocol, 'master mix', [mm_tube], mm_start_vol, dead_vol=20)
+    block_ready = False
+
+    def await_block():
+        # wait for the temperature module the first time master mix is about to be taken up, and log how long it took
+        nonlocal block_ready
+        if temp_mod is None or block_ready:
+            return
+        wait_start = time.monotonic()
+        temp_mod.await_temperature(mm_temp)
+        protocol.comment("Waited " + str(round(time.monotonic() - wait_start)) + " seconds for the temperature "
+                         "module to reach " + str(mm_temp) + " C.")
+        block_ready = True
+
+    # load strip tubes and the multichannel for stamping full columns
+    multi = None
+    if strip_stamp == 'yes':
+        if sample_plates > 4 or num_racks > 4:
+            raise Exception("Strip stamping needs an empty plate slot and tip rack slot. Max 4 plates and 4 tip racks.")
+        strip_block = protocol.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul',
+                                            str(deck[2 + sample_plates]), 'master mix strip tubes')
+        tips_multi = [protocol.load_labware('opentrons_96_tiprack_20ul', str(deck[7 + num_racks]))]
+        multi = protocol.load_instrument("p20_multi_gen2", mount=pipette_mount_multi, tip_racks=tips_multi)
+    elif strip_stamp != 'no':
+        raise Exception("Strip stamping not indicated. Must be 'yes' or 'no'.")
 
     # set aspirate and dispense speeds
-    p20.flow_rate.aspirate = 150
-    p20.flow_rate.dispense = 150
-
-    # list of possible wells
-    well_names = ['A1', 'A2', 'A3', 'A4', 'A5', 'A6', 'A7', 'A8', 'A9', 'A10', 'A11', 'A12',
-                  'B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B9', 'B10', 'B11', 'B12',
-                  'C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12',
-                  'D1', 'D2', 'D3', 'D4', 'D5', 'D6', 'D7', 'D8', 'D9', 'D10', 'D11', 'D12',
-                  'E1', 'E2', 'E3', 'E4', 'E5', 'E6', 'E7', 'E8', 'E9', 'E10', 'E11', 'E12',
-                  'F1', 'F2', 'F3', 'F4', 'F5', 'F6', 'F7', 'F8', 'F9', 'F10', 'F11', 'F12',
-                  'G1', 'G2', 'G3', 'G4', 'G5', 'G6', 'G7', 'G8', 'G9', 'G10', 'G11', 'G12',
-                  'H1', 'H2', 'H3', 'H4', 'H5', 'H6', 'H7', 'H8', 'H9', 'H10', 'H11', 'H12']
+    for pipette in [p20, multi]:
+        if pipette is not None:
+            pipette.flow_rate.aspirate = 150
+            pipette.flow_rate.dispense = 150
 
     # list of wells to skip for each plate
     wells_skip = [P1_skip, P2_skip, P3_skip, P4_skip, P5_skip]
+    # wells with samples on each plate
+    sample_masks = [sample_mask(num_samples_each_plate[num_plate], wells_skip[num_plate])
+                    for num_plate in range(0, len(plate_names))]
+
+    # plate columns that get master mix from the multichannel, as (plate number, column)
+    stamped = []
+    strip_groups = []
+    if multi is not None:
+        for num_plate in range(0, len(plate_names)):
+            for col, col_mask in COLUMN_MASKS.items():
+                if sample_masks[num_plate] & col_mask == col_mask:
+                    stamped.append((num_plate, col))
+        if change_tip == 'yes' and len(stamped) > 12:
+            raise Exception("Not enough multichannel tips to change tips between " + str(len(stamped))
+                            + " columns. Max 12.")
+        # each strip tube holds master mix for as many columns as fit, then the next strip column is used
+        cols_per_strip = int((200 - strip_extra_vol) // mm_vol)
+        strip_groups = [stamped[start:start + cols_per_strip] for start in range(0, len(stamped), cols_per_strip)]
+        protocol.comment(str(len(stamped)) + " columns will get master mix from " + str(len(strip_groups))
+                         + " strip column(s) with the multichannel.")
+
+    # wells left for the single channel on each plate, in the chosen order
+    for num_plate, col in stamped:
+        sample_masks[num_plate] &= ~COLUMN_MASKS[col]
+    single_wells = [wells_in_order(mask, well_order) for mask in sample_masks]
+
+    # master mix needed from the tube, checked before anything moves
+    mm_needed = (sum(len(wells) for wells in single_wells) * mm_vol
+                 + 8 * sum(len(group) * mm_vol + strip_extra_vol for group in strip_groups))
+    if mm_needed > mm_start_vol - mm_source.dead_vol:
+        protocol.comment("The master mix tube needs " + str(round(mm_needed + mm_source.dead_vol, 1))
+                         + " ul but starts with " + str(mm_start_vol) + " ul. The protocol will pause to refill it "
+                         "before it runs dry.")
+
+    if stamped:
+        # fill the strip tubes with the single channel, same tip the whole time since it only touches master mix
+        p20.pick_up_tip()
+        await_block()
+        for strip_col, group in enumerate(strip_groups, 1):
+            for row in 'ABCDEFGH':
+                # split into equal trips if it's more than a tip full
+                strip_vol = len(group) * mm_vol + strip_extra_vol
+                trips = int(-(-strip_vol // p20.max_volume))
+                for trip in range(trips):
+                    p20.aspirate(strip_vol / trips, mm_source.aspirate_from(strip_vol / trips))
+                    p20.dispense(strip_vol / trips, strip_block.wells_by_name()[row + str(strip_col)])
+        p20.drop_tip()
 
-    # pick up tip that will be used the whole time if not changing in between
-    if change_tip == 'no':
+        # stamp each full column from its strip column
+        for strip_col, group in enumerate(strip_groups, 1):
+            strip = strip_block.wells_by_name()['A' + str(strip_col)]
+            for num_plate, col in group:
+                if not multi.has_tip:
+                    multi.pick_up_tip()
+                multi.aspirate(mm_vol, strip)
+                multi.dispense(mm_vol, plate_names[num_plate].wells_by_name()['A' + col].top())
+                if mix_sample == 'yes':
+                    multi.mix(5, mm_vol)
+                multi.blow_out()
+                if touch_tip == 'yes':
+                    multi.touch_tip()
+                if change_tip == 'yes':
+                    multi.drop_tip()
+        if multi.has_tip:
+            multi.drop_tip()
+
+    if dispense_mode == 'multi':
+        # wells to fill in order
+        mm_wells = [plate_names[num_plate].wells_by_name()[sample_name]
+                    for num_plate in range(0, len(plate_names)) for sample_name in single_wells[num_plate]]
+        # fill the tip with as many wells as fit along with the disposal volume
+        wells_per_fill = int((p20.max_volume - disposal_vol) // mm_vol)
         p20.pick_up_tip()
-    # distribute master mix
-    for num_plate in range(0, len(plate_names)):
-        for sample in range(0, num_samples_each_plate[num_plate]):
-            plate = plate_names[num_plate]
-            sample_name = well_names[sample]
-            # move on to next iteration of loop if sample name is in the skip list for this plate
-            if sample_name in wells_skip[num_plate]:
-                continue
-            # pick up tip if changing every time
-            if change_tip == 'yes':
-                p20.pick_up_tip()
-            p20.aspirate(mm_vol, mm_tube)
-            p20.dispense(mm_vol, plate.wells_by_name()[sample_name].top())
-            if mix_sample == 'yes':
-                p20.mix(5, mm_vol)
-            p20.blow_out()
-            if touch_tip == 'yes':
-                p20.touch_tip()
-            if change_tip == 'yes':
-                p20.drop_tip()
-
-    # drop tip at end if tip wasnt changed between samples
-    if change_tip == 'no':
+        for start in range(0, len(mm_wells), wells_per_fill):
+            fill = mm_wells[start:start + wells_per_fill]
+            await_block()
+            fill_vol = mm_vol * len(fill) + disposal_vol
+            p20.aspirate(fill_vol, mm_source.aspirate_from(fill_vol))
+            for dest_well in fill:
+                p20.dispense(mm_vol, dest_well.top())
+                if touch_tip == 'yes':
+                    p20.touch_tip()
+            # put the disposal volume back in the tube
+            p20.blow_out(mm_source.put_back(disposal_vol))
         p20.drop_tip()
+    elif dispense_mode == 'single':
+        # pick up tip that will be used the whole time if not changing in between
+        if change_tip == 'no':
+            p20.pick_up_tip()
+        # distribute master mix
+        for num_plate in range(0, len(plate_names)):
+            plate = plate_names[num_plate]
+            for sample_name in single_wells[num_plate]:
+                # pick up tip if changing every time
+                if change_tip == 'yes':
+                    p20.pick_up_tip()
+                await_block()
+                p20.aspirate(mm_vol, mm_source.aspirate_from(mm_vol))
+                p20.dispense(mm_vol, plate.wells_by_name()[sample_name].top())
+                if mix_sample == 'yes':
+                    p20.mix(5, mm_vol)
+                p20.blow_out()
+                if touch_tip == 'yes':
+                    p20.touch_tip()
+                if change_tip == 'yes':
+                    p20.drop_tip()
+
+        # drop tip at end if tip wasnt changed between samples
+        if change_tip == 'no':
+            p20.drop_tip()
 
     # turn off lights when protocol complete
     protocol.set_rail_lights(False)
\ No newline at end of file
@@ -0,0 +1,124 @@
+# Work out the vol_dna/vol_water columns for standardize.py from a concentration export
+# run on a computer, not the robot:
+#   python normalize_calc.py concentrations.csv --target 10 --final-volume 50 -o input_data.csv
+#
+# the concentration file needs source_slot, source_well and concentration (ng/ul) columns
+# dest_slot and dest_well columns are optional, if they are missing samples are laid out down the columns
+# of destination plates starting in slot 5 (A1, B1, C1 ... H12, then the next plate)
+# samples that can't be brought to the target by adding water alone are left out of the output and listed separately
+# (their destination wells are left empty so they can be added later)
+
+import argparse
+import csv
+import sys
+
+import numpy as np
+
+# volume limits (ul) standardize.py accepts for each transfer
+MIN_VOL = 1.0
+MAX_VOL = 200.0
+
+# destination wells in the order they get filled when the file doesn't give them
+WELL_ORDER = [row + str(col) for col in range(1, 13) for row in 'ABCDEFGH']
+FIRST_DEST_SLOT = 5
+
+OUTPUT_COLUMNS = ['source_slot', 'source_well', 'dest_slot', 'dest_well', 'vol_dna', 'vol_water']
+
+
+def read_concentrations(path):
+    # read the export into columns, header names are matched without caring about case or spaces
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = [row for row in csv.reader(f) if any(val.strip() for val in row)]
+    header = [name.strip().lower() for name in rows[0]]
+    if 'concentration' not in header and 'conc' in header:
+        header[header.index('conc')] = 'concentration'
+    for name in ['source_slot', 'source_well', 'concentration']:
+        if name not in header:
+            raise Exception("Concentration file is missing the " + name + " column")
+    columns = {name: [row[index].strip() if index < len(row) else '' for row in rows[1:]]
+               for index, name in enumerate(header)}
+    return columns
+
+
+def to_float(values):
+    # numbers that can't be read come back as nan so they get flagged instead of stopping everything
+    out = np.full(len(values), np.nan)
+    for index, val in enumerate(values):
+        try:
+            out[index] = float(val)
+        except ValueError:
+            pass
+    return out
+
+
+def calculate(concentration, target, final_volume):
+    # volumes of dna and water for every sample in one pass
+    # returns vol_dna, vol_water and a reason for every sample that needs a different dilution strategy ('' if fine)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vol_needed = target * final_volume / concentration
+    vol_dna = np.round(np.clip(vol_needed, MIN_VOL, min(final_volume, MAX_VOL)), 2)
+    vol_water = np.round(np.clip(final_volume - vol_dna, 0.0, MAX_VOL), 2)
+    reasons = np.full(len(concentration), '', dtype=object)
+    reasons[vol_needed > final_volume] = 'below target: use less water or a smaller final volume'
+    for index in np.flatnonzero(vol_needed < MIN_VOL):
+        reasons[index] = 'too concentrated: pre-dilute ' + str(int(np.ceil(MIN_VOL / vol_needed[index]))) + 'x first'
+    reasons[~np.isfinite(concentration) | (concentration <= 0)] = 'no usable concentration'
+    return vol_dna, vol_water, reasons
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Calculate standardize.py input data from DNA concentrations.')
+    parser.add_argument('concentrations', help='csv with source_slot, source_well and concentration (ng/ul) columns')
+    parser.add_argument('--target', type=float, required=True, help='target concentration (ng/ul)')
+    parser.add_argument('--final-volume', type=float, required=True, help='final volume in each well (ul)')
+    parser.add_argument('-o', '--output', help='where to write the input data (default: print it)')
+    parser.add_argument('--flagged', help='where to write the flagged samples (default: print them to stderr)')
+    args = parser.parse_args(argv)
+
+    if args.target <= 0:
+        raise Exception("Target concentration must be above 0")
+    if args.final_volume < MIN_VOL or args.final_volume > MAX_VOL:
+        raise Exception("Final volume must be between " + str(MIN_VOL) + "-" + str(MAX_VOL) + " ul")
+
+    columns = read_concentrations(args.concentrations)
+    concentration = to_float(columns['concentration'])
+    vol_dna, vol_water, reasons = calculate(concentration, args.target, args.final_volume)
+
+    num_samples = len(concentration)
+    if 'dest_slot' in columns and 'dest_well' in columns:
+        dest_slot = columns['dest_slot']
+        dest_well = columns['dest_well']
+    else:
+        # lay samples out down the columns of each destination plate, keeping the input order
+        positions = np.arange(num_samples)
+        dest_slot = [str(slot) for slot in FIRST_DEST_SLOT + positions // len(WELL_ORDER)]
+        dest_well = [WELL_ORDER[index] for index in positions % len(WELL_ORDER)]
+        if num_samples > 2 * len(WELL_ORDER):
+            sys.stderr.write("More than 2 destination plates: split the output into separate runs.\n")
+
+    ok = reasons == ''
+    lines = [','.join(OUTPUT_COLUMNS)]
+    lines += [','.join([columns['source_slot'][index], columns['source_well'][index], dest_slot[index],
+                        dest_well[index], '{:g}'.format(vol_dna[index]), '{:g}'.format(vol_water[index])])
+              for index in np.flatnonzero(ok)]
+    flagged = ['source_slot,source_well,concentration,reason']
+    flagged += [','.join([columns['source_slot'][index], columns['source_well'][index],
+                          columns['concentration'][index], reasons[index]])
+                for index in np.flatnonzero(~ok)]
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    else:
+        print('\n'.join(lines))
+    if len(flagged) > 1:
+        if args.flagged:
+            with open(args.flagged, 'w') as f:
+                f.write('\n'.join(flagged) + '\n')
+        else:
+            sys.stderr.write(str(len(flagged) - 1) + " samples need a different dilution strategy:\n")
+            sys.stderr.write('\n'.join(flagged) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+# Split a large normalization sheet into standardize.py runs spread over several robots
+# run on a computer, not the robot:
+#   python shard_sheet.py big_sheet.csv --robots 3 -o shards
+#
+# the sheet has the same columns as standardize.py input data, but source_slot and dest_slot are plate numbers
+# (any integers) instead of deck slots. Each run gets at most 3 source plates and 2 destination plates and has
+# to fit in the tip racks. Plates used by more than one run are kept on the same robot, and runs are spread over
+# the robots by estimated run time so they all finish at about the same time.
+# keeping shared plates together can put most runs on one robot. With --move-sources only destination plates are kept
+# together, and source plates that are used on more than one robot are listed so they can be moved between runs
+# each run is written to its own file with the plate -> slot mapping and a block to paste into input_data
+
+import argparse
+import csv
+import os
+
+SOURCE_SLOTS = [1, 2, 3]
+DEST_SLOTS = [5, 6]
+
+# tips in one rack
+RACK_SIZE = 96
+
+
+def read_sheet(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = [[val.strip() for val in row] for row in csv.reader(f) if row and row[0].strip()]
+    header = [name.lower() for name in rows[0]]
+    expected = ['source_slot', 'source_well', 'dest_slot', 'dest_well', 'vol_dna', 'vol_water']
+    if header[:6] != expected:
+        raise Exception("Sheet columns must be " + ','.join(expected))
+    return [(int(row[0]), row[1], int(row[2]), row[3], float(row[4]), float(row[5])) for row in rows[1:]]
+
+
+def estimate(rows, args):
+    # estimated run time (seconds) and tips used on each pipette for a set of rows
+    p20_tips = 0
+    p300_tips = 0
+    seconds = 0.0
+    water_20 = 0
+    for source, source_well, dest, dest_well, vol_dna, vol_water in rows:
+        if vol_dna <= 20:
+            p20_tips += 1
+        else:
+            p300_tips += 1
+        seconds += args.dna_seconds
+        if vol_water > 0:
+            seconds += args.water_seconds
+        # on used plates the p20 changes tip after every water dispense under 10 ul
+        if args.status == 'used' and 0 < vol_water < 10:
+            water_20 += 1
+    # one tip on each pipette for the water
+    return seconds, p20_tips + water_20 + 1, p300_tips + 1
+
+
+class Piece:
+    # rows going into one destination plate from up to 3 source plates
+    def __init__(self, dest, rows, args):
+        self.dest = dest
+        self.rows = rows
+        self.sources = {row[0] for row in rows}
+        self.seconds, self.p20_tips, self.p300_tips = estimate(rows, args)
+
+
+def split_dest_plate(dest, rows, args, tip_limit_20, tip_limit_300):
+    # a destination plate normally goes in one run, but if it draws from more than 3 source plates or needs more tips
+    # than the racks hold its rows are split by source plate over several runs (which then stay on the same robot)
+    piece = Piece(dest, rows, args)
+    if len(piece.sources) <= len(SOURCE_SLOTS) and piece.p20_tips <= tip_limit_20 \
+            and piece.p300_tips <= tip_limit_300:
+        return [piece]
+    by_source = {}
+    for row in rows:
+        by_source.setdefault(row[0], []).append(row)
+    pieces = []
+    current = []
+    for source in sorted(by_source):
+        trial = Piece(dest, current + by_source[source], args)
+        if current and (len(trial.sources) > len(SOURCE_SLOTS) or trial.p20_tips > tip_limit_20
+                        or trial.p300_tips > tip_limit_300):
+            pieces.append(Piece(dest, current, args))
+            current = []
+        current += by_source[source]
+    pieces.append(Piece(dest, current, args))
+    for piece in pieces:
+        if piece.p20_tips > tip_limit_20 or piece.p300_tips > tip_limit_300:
+            raise Exception("Rows from source plate " + str(sorted(piece.sources)) + " to destination plate "
+                            + str(dest) + " need more tips than one run has")
+    return pieces
+
+
+def pack_runs(pieces, tip_limit_20, tip_limit_300):
+    # first fit decreasing by time: add each piece to the first run it fits in (deck slots and tips)
+    runs = []
+    for piece in sorted(pieces, key=lambda piece: -piece.seconds):
+        for run in runs:
+            sources = set().union(*(other.sources for other in run)) | piece.sources
+            dests = {other.dest for other in run} | {piece.dest}
+            if len(sources) <= len(SOURCE_SLOTS) and len(dests) <= len(DEST_SLOTS) \
+                    and sum(other.p20_tips for other in run) + piece.p20_tips <= tip_limit_20 \
+                    and sum(other.p300_tips for other in run) + piece.p300_tips <= tip_limit_300 \
+                    and all(other.dest != piece.dest for other in run):
+                run.append(piece)
+                break
+        else:
+            runs.append([piece])
+    return runs
+
+
+def group_runs(runs, move_sources=False):
+    # runs that share a plate have to stay on one robot, find the connected groups
+    # with move_sources only destination plates count, source plates can go from one robot to another
+    parent = list(range(len(runs)))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    owner = {}
+    for index, run in enumerate(runs):
+        for piece in run:
+            plates = [('dest', piece.dest)]
+            if not move_sources:
+                plates += [('source', source) for source in piece.sources]
+            for plate in plates:
+                if plate in owner:
+                    parent[find(index)] = find(owner[plate])
+                else:
+                    owner[plate] = index
+    groups = {}
+    for index, run in enumerate(runs):
+        groups.setdefault(find(index), []).append(run)
+    return list(groups.values())
+
+
+def format_time(seconds):
+    minutes = int(round(seconds / 60))
+    return str(minutes // 60) + ' h ' + str(minutes % 60) + ' min'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Split a large standardize.py sheet into runs over several robots.')
+    parser.add_argument('sheet', help='csv with standardize.py columns, slots given as plate numbers')
+    parser.add_argument('--robots', type=int, default=1, help='number of robots (default 1)')
+    parser.add_argument('--extra-rack', choices=['20', '300', 'none'], default='none',
+                        help='extra_rack_type set in standardize.py (default none)')
+    parser.add_argument('--status', choices=['clean', 'used'], default='clean',
+                        help='destination_plate_status set in standardize.py (default clean)')
+    parser.add_argument('--dna-seconds', type=float, default=30, help='estimated time per dna transfer (default 30)')
+    parser.add_argument('--water-seconds', type=float, default=12,
+                        help='estimated time per water dispense (default 12)')
+    parser.add_argument('--setup-minutes', type=float, default=10,
+                        help='time to set up the deck for each run (default 10)')
+    parser.add_argument('--move-sources', action='store_true',
+                        help='let source plates be used on more than one robot (they are moved between runs)')
+    parser.add_argument('-o', '--output', default='shards', help='folder for the run files (default shards)')
+    args = parser.parse_args(argv)
+
+    tip_limit_20 = RACK_SIZE * (3 if args.extra_rack == '20' else 2)
+    tip_limit_300 = RACK_SIZE * (3 if args.extra_rack == '300' else 2)
+    setup_seconds = args.setup_minutes * 60
+
+    rows = read_sheet(args.sheet)
+    by_dest = {}
+    for row in rows:
+        by_dest.setdefault(row[2], []).append(row)
+    pieces = [piece for dest in sorted(by_dest)
+              for piece in split_dest_plate(dest, by_dest[dest], args, tip_limit_20, tip_limit_300)]
+
+    # pack the pieces into runs, then spread groups of runs that share plates over the robots, longest first
+    groups = []
+    for runs in group_runs(pack_runs(pieces, tip_limit_20, tip_limit_300), args.move_sources):
+        groups.append((sum(sum(piece.seconds for piece in run) + setup_seconds for run in runs), runs))
+    robots = [[0.0, []] for robot in range(args.robots)]
+    for seconds, runs in sorted(groups, key=lambda group: -group[0]):
+        robot = min(robots, key=lambda robot: robot[0])
+        robot[0] += seconds
+        robot[1] += runs
+
+    os.makedirs(args.output, exist_ok=True)
+    for robot_num, (robot_seconds, runs) in enumerate(robots, 1):
+        print("Robot " + str(robot_num) + ": " + str(len(runs)) + " runs, " + format_time(robot_seconds))
+        for run_num, run in enumerate(runs, 1):
+            sources = sorted(set().union(*(piece.sources for piece in run)))
+            dests = sorted({piece.dest for piece in run})
+            slots = dict(zip(sources, SOURCE_SLOTS))
+            dest_slots = dict(zip(dests, DEST_SLOTS))
+            run_rows = [row for piece in run for row in piece.rows]
+            seconds = sum(piece.seconds for piece in run)
+            mapping = ', '.join(['source plate ' + str(plate) + ' -> slot ' + str(slots[plate]) for plate in sources]
+                                + ['destination plate ' + str(plate) + ' -> slot ' + str(dest_slots[plate])
+                                   for plate in dests])
+            name = os.path.join(args.output, 'robot' + str(robot_num) + '_run' + str(run_num) + '.txt')
+            with open(name, 'w') as f:
+                f.write('# robot ' + str(robot_num) + ', run ' + str(run_num) + ', ' + str(len(run_rows))
+                        + ' rows, about ' + format_time(seconds) + '\n')
+                f.write('# ' + mapping + '\n')
+                f.write('# paste the lines below into input_data\n')
+                f.write('source_slot,source_well,dest_slot,dest_well,vol_dna,vol_water\n')
+                for source, source_well, dest, dest_well, vol_dna, vol_water in run_rows:
+                    f.write(','.join([str(slots[source]), source_well, str(dest_slots[dest]), dest_well,
+                                      '{:g}'.format(vol_dna), '{:g}'.format(vol_water)]) + '\n')
+            print("  run " + str(run_num) + ": " + str(len(run_rows)) + " rows, " + format_time(seconds)
+                  + " (" + mapping + ") -> " + name)
+    print("Expected makespan: " + format_time(max(robot[0] for robot in robots)))
+    idle = [str(robot_num) for robot_num, (robot_seconds, runs) in enumerate(robots, 1) if not runs]
+    if idle:
+        print("Warning: no runs for robot " + ', '.join(idle) + ", the runs share plates so they have to stay on "
+              + str(len(groups)) + " robot(s)." + ("" if args.move_sources else " Try --move-sources."))
+    # source plates that go to more than one robot, with the runs that use them
+    moves = {}
+    for robot_num, (robot_seconds, runs) in enumerate(robots, 1):
+        for run_num, run in enumerate(runs, 1):
+            for plate in sorted(set().union(*(piece.sources for piece in run))):
+                moves.setdefault(plate, []).append((robot_num, run_num))
+    for plate in sorted(moves):
+        if len({robot_num for robot_num, run_num in moves[plate]}) > 1:
+            print("Move source plate " + str(plate) + " between "
+                  + ', '.join('robot ' + str(robot_num) + ' run ' + str(run_num)
+                              for robot_num, run_num in moves[plate])
+                  + " (the makespan doesn't include waiting for it)")
+    print("Set the plate types and extra_rack_type in standardize.py to match each run before pasting.")
+
+
+if __name__ == '__main__':
+    main()
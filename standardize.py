@@ -1,3 +1,10 @@
+import collections
+import hashlib
+import math
+import os
+
+import numpy as np
+
 metadata = {
     'protocolName': 'Standardize DNA Concentrations',
     'author': 'AMB, last updated 5/6/22',
@@ -7,6 +14,363 @@ metadata = {
 }
 
 
+# one row of the pasted csv once it has been checked
+# (row is its position in the csv, used to keep track of progress)
+Transfer = collections.namedtuple('Transfer', ['row', 'source_slot', 'source_well', 'dest_slot', 'dest_well',
+                                               'vol_dna', 'vol_water'])
+
+# a well and the locations used for it, looked up once instead of on every row
+WellRef = collections.namedtuple('WellRef', ['well', 'top'])
+
+# well names on a 96 well plate
+WELL_NAMES_96 = [row + str(col) for row in 'ABCDEFGH' for col in range(1, 13)]
+
+# volume (ul) each well can hold for each plate type
+WELL_CAPACITY = {'nest_100ul': 100, 'biorad_200ul': 200}
+
+
+def parse_table(text, columns):
+    # parse a pasted csv block (first line is the header) into a table of columns {name: numpy array}
+    # columns is a list of (name, type) in csv order, where type is int, float, or str
+    # returns the table, the rows as text (for messages) and a list of problems found
+    rows = [[val.strip() for val in line.split(',')]
+            for line in text.splitlines()
+            if line.split(',')[0].strip()][1:]
+    errors = []
+    values = {name: [] for name, kind in columns}
+    for row in rows:
+        if len(row) != len(columns):
+            errors.append("Row " + ','.join(row) + ": expected " + str(len(columns)) + " values")
+        for index, (name, kind) in enumerate(columns):
+            try:
+                values[name].append(kind(row[index]))
+            except (IndexError, ValueError):
+                errors.append("Row " + ','.join(row) + ": invalid " + name)
+                values[name].append(kind())
+    table = {name: np.array(values[name], dtype=kind) for name, kind in columns}
+    return table, [','.join(row) for row in rows], errors
+
+
+def compile_plan(input_data, source_types, dest_types):
+    # check every row of the pasted csv in one pass, before anything moves, and turn it into a fixed list of transfers
+    # source_types and dest_types map slot number to plate type for the plates that are loaded
+    # all problems are reported together so a bad row near the end doesn't stop a run that is already going
+    table, rows, errors = parse_table(input_data, [('source_slot', int), ('source_well', str), ('dest_slot', int),
+                                                   ('dest_well', str), ('vol_dna', float), ('vol_water', float)])
+    vol_dna = np.round(table['vol_dna'], 2)
+    vol_water = np.round(table['vol_water'], 2)
+    # total volume going into each destination well against what that plate can hold
+    dest_keys = np.char.add(np.char.add(table['dest_slot'].astype(str), ':'), table['dest_well'])
+    unique_keys, key_index = np.unique(dest_keys, return_inverse=True)
+    well_totals = np.bincount(key_index.reshape(-1), weights=vol_dna + vol_water, minlength=len(unique_keys))
+    capacity = np.array([WELL_CAPACITY.get(dest_types.get(slot), np.inf) for slot in table['dest_slot']])
+    checks = [
+        (~np.isin(table['source_slot'], list(source_types)),
+         "Invalid source slot. Must be one of " + str(sorted(source_types))),
+        (~np.isin(table['source_well'], WELL_NAMES_96), "Invalid source well"),
+        (~np.isin(table['dest_slot'], list(dest_types)),
+         "Invalid destination slot. Must be one of " + str(sorted(dest_types))),
+        (~np.isin(table['dest_well'], WELL_NAMES_96), "Invalid destination well"),
+        ((vol_dna < 1.0) | (vol_dna > 200.0), "Invalid volume of dna. Must be between 1.0-200.0"),
+        ((vol_water < 0.0) | (vol_water > 200.0), "Invalid volume of water. Must be between 0.0-200.0"),
+        (well_totals[key_index.reshape(-1)] > capacity, "Destination well would be overfilled"),
+    ]
+    for failed, message in checks:
+        errors += ["Row " + rows[index] + ": " + message for index in np.flatnonzero(failed)]
+    if errors:
+        raise Exception("Problems found in input data:\n" + '\n'.join(errors))
+    return tuple(Transfer(index, int(table['source_slot'][index]), str(table['source_well'][index]),
+                          int(table['dest_slot'][index]), str(table['dest_well'][index]),
+                          float(vol_dna[index]), float(vol_water[index])) for index in range(len(rows)))
+
+
+def diff_plan(previous_plan, plan):
+    # compare the plan with one that has already been run and keep only what still has to be added
+    # rows are matched on source and destination well, volumes can only go up since nothing can be taken back out
+    # returns the new plan, the number of added and changed rows, and the rows that are no longer in the input
+    def totals(transfers):
+        sums = {}
+        for transfer in transfers:
+            key = (transfer.source_slot, transfer.source_well, transfer.dest_slot, transfer.dest_well)
+            if key in sums:
+                sums[key] = sums[key]._replace(vol_dna=round(sums[key].vol_dna + transfer.vol_dna, 2),
+                                               vol_water=round(sums[key].vol_water + transfer.vol_water, 2))
+            else:
+                sums[key] = transfer
+        return sums
+
+    old = totals(previous_plan)
+    new = totals(plan)
+    old_dests = {(key[2], key[3]) for key in old}
+    errors = []
+    delta_plan = []
+    added = 0
+    changed = 0
+    for key, transfer in new.items():
+        name = ','.join(str(val) for val in key)
+        if key not in old:
+            if (key[2], key[3]) in old_dests:
+                errors.append("Row " + name + ": destination well already has dna from a different source")
+                continue
+            delta_plan.append(transfer)
+            added += 1
+            continue
+        extra_dna = round(transfer.vol_dna - old[key].vol_dna, 2)
+        extra_water = round(transfer.vol_water - old[key].vol_water, 2)
+        if extra_dna < 0 or extra_water < 0:
+            errors.append("Row " + name + ": volume is lower than what was already added")
+        elif 0 < extra_dna < 1.0:
+            errors.append("Row " + name + ": extra dna (" + str(extra_dna) + " ul) is too small to pipette")
+        elif extra_dna > 0 or extra_water > 0:
+            delta_plan.append(transfer._replace(vol_dna=extra_dna, vol_water=extra_water))
+            changed += 1
+    if errors:
+        raise Exception("Problems found comparing with the previous input data:\n" + '\n'.join(errors))
+    removed = [','.join(str(val) for val in key) for key in old if key not in new]
+    return tuple(delta_plan), added, changed, removed
+
+
+def plan_water_fills(wells, max_vol, disposal_vol, break_after_touch):
+    # split (well, volume, row) entries into groups that fit in one tip along with the disposal volume
+    # a well that is too big to share a tip gets its own fill
+    # if break_after_touch is True a fill ends at any well <10 ul, since the tip is touched to that well
+    fills = []
+    fill = []
+    fill_vol = 0
+    for dest_well, vol_water, row in wells:
+        if fill and fill_vol + vol_water + disposal_vol > max_vol:
+            fills.append(fill)
+            fill = []
+            fill_vol = 0
+        fill.append((dest_well, vol_water, row))
+        fill_vol += vol_water
+        if break_after_touch and vol_water < 10:
+            fills.append(fill)
+            fill = []
+            fill_vol = 0
+    if fill:
+        fills.append(fill)
+    return fills
+
+
+def well_area(well):
+    # cross section (mm2) of a round or rectangular well
+    if well.diameter is not None:
+        return math.pi * (well.diameter / 2) ** 2
+    return well.length * well.width
+
+
+def well_height(well, vol):
+    # height (mm) of vol (ul) of liquid above the bottom of a well
+    # the well is taken as a straight well with a cone at the bottom, with the cone sized so the well holds its rated
+    # volume at its full depth (from the labware definition)
+    if vol <= 0:
+        return 0.0
+    area = well_area(well)
+    cone_height = min(well.depth, max(0.0, 1.5 * (well.depth - well.max_volume / area)))
+    cone_vol = area * cone_height / 3
+    if vol < cone_vol:
+        return cone_height * (vol / cone_vol) ** (1 / 3)
+    return min(well.depth, cone_height + (vol - cone_vol) / area)
+
+
+class ReagentLedger:
+    # volume (ul) in every well used for one reagent, or for waste, in the order the wells are used
+    # reagent is drawn from the first well with enough left above its dead volume and waste goes into the first well
+    # with room left below its fill limit, so the run moves on to the next well by itself instead of running a well
+    # dry or over filling it. Aspirates are made from just under where the surface will be after the aspirate
+    def __init__(self, protocol, name, wells, start_vol, dead_vol=0, fill_limit=None, submerge=2):
+        self.protocol = protocol
+        self.name = name
+        self.wells = wells
+        self.start_vol = start_vol
+        self.vols = [start_vol for well in wells]
+        self.dead_vol = dead_vol
+        self.fill_limit = [fill_limit or well.max_volume for well in wells]
+        self.submerge = submerge
+        self.current = 0
+        for well, limit in zip(wells, self.fill_limit):
+            if start_vol < 0 or start_vol > limit:
+                raise Exception("Invalid " + name + " volume. Must be 0-" + str(limit) + " ul")
+
+    def check(self, draw_vol=0, add_vol=0):
+        # stop before the run starts if the wells can't supply draw_vol or hold add_vol (ul, all channels)
+        available = sum(max(0, vol - self.dead_vol) for vol in self.vols)
+        room = sum(limit - vol for vol, limit in zip(self.vols, self.fill_limit))
+        if draw_vol > available:
+            raise Exception("The run needs " + str(round(draw_vol)) + " ul of " + self.name + " but the "
+                            + str(len(self.wells)) + " well(s) only have " + str(round(available)) + " ul above "
+                            "the dead volume. Add another well or fill them higher.")
+        if add_vol > room:
+            raise Exception("The run puts " + str(round(add_vol)) + " ul into the " + self.name + " but the "
+                            + str(len(self.wells)) + " well(s) only have room for " + str(round(room))
+                            + " ul. Add another well or empty them.")
+
+    def switch(self, ok, msg):
+        # move on to the first well from the current one where ok(index) is true
+        # if there isn't one (check() wasn't used or the volumes were off) pause with msg for the wells to be reset
+        start = self.current
+        while self.current < len(self.wells) and not ok(self.current):
+            self.current += 1
+        if self.current == len(self.wells):
+            self.protocol.pause(msg)
+            self.vols = [self.start_vol for well in self.wells]
+            self.current = 0
+            return
+        if self.current != start:
+            self.protocol.comment("Switching " + self.name + " to well " + self.wells[self.current].well_name + ".")
+
+    def well_for(self, vol, channels=1):
+        # the well the next aspirate of vol (ul per channel) will come from
+        self.switch(lambda index: self.vols[index] - vol * channels >= self.dead_vol,
+                    "The " + self.name + " wells are almost empty. Refill them to " + str(self.start_vol)
+                    + " ul and resume.")
+        return self.wells[self.current]
+
+    def aspirate_from(self, vol, channels=1):
+        # where to aspirate vol (ul per channel) from
+        well = self.well_for(vol, channels)
+        self.vols[self.current] = max(0, self.vols[self.current] - vol * channels)
+        return well.bottom(max(1.0, well_height(well, self.vols[self.current]) - self.submerge))
+
+    def put_back(self, vol, channels=1):
+        # liquid blown back into the well it came from, returns where to blow it out
+        self.vols[self.current] = min(self.vols[self.current] + vol * channels, self.fill_limit[self.current])
+        return self.wells[self.current].top()
+
+    def dispense_to(self, vol, channels=1):
+        # where to dispense vol (ul per channel) of waste
+        self.switch(lambda index: self.vols[index] + vol * channels <= self.fill_limit[index],
+                    "The " + self.name + " wells are almost full. Empty them and resume.")
+        self.vols[self.current] += vol * channels
+        return self.wells[self.current].top()
+
+
+def build_well_index(labwares):
+    # map (slot, well name) to the well and its top location for every plate and reservoir in labwares
+    # ({slot: labware}, e.g. protocol.loaded_labwares). Build it once, after all labware is loaded
+    index = {}
+    for slot, labware in labwares.items():
+        if labware.is_tiprack:
+            continue
+        for well in labware.wells():
+            index[(slot, well.well_name)] = WellRef(well, well.top())
+    return index
+
+
+def well_xy(locations):
+    # deck x/y coordinates (mm) of each location
+    return np.array([[loc.point.x, loc.point.y] for loc in locations], dtype=float).reshape(-1, 2)
+
+
+def order_by_travel(starts, ends, origin=None):
+    # find a low-travel order for a list of moves, where move i starts at starts[i] and ends at ends[i]
+    # (for water both are the destination well, for DNA it's the source and destination well)
+    # nearest-neighbour gives a starting path and 2-opt segment reversals improve it until nothing helps
+    # returns the order and the estimated gantry travel (mm) before and after
+    n = len(starts)
+    if n == 0:
+        return [], 0.0, 0.0
+    # cost[i, j] is the distance from the end of move i to the start of move j
+    cost = np.linalg.norm(ends[:, None, :] - starts[None, :, :], axis=2)
+    if origin is None:
+        start_cost = np.zeros(n)
+    else:
+        start_cost = np.linalg.norm(starts - origin, axis=1)
+    fixed = np.linalg.norm(ends - starts, axis=1).sum()
+
+    def path_length(order):
+        return fixed + start_cost[order[0]] + cost[order[:-1], order[1:]].sum()
+
+    # nearest neighbour
+    order = [int(np.argmin(start_cost))]
+    unvisited = np.ones(n, dtype=bool)
+    unvisited[order[0]] = False
+    for step in range(n - 1):
+        dist = np.where(unvisited, cost[order[-1]], np.inf)
+        order.append(int(np.argmin(dist)))
+        unvisited[order[-1]] = False
+    order = np.array(order)
+
+    # 2-opt: reverse order[i:j + 1] for the (i, j) that saves the most, all pairs scored at once
+    # moves aren't symmetric (source -> destination) so the reversed segment is re-costed backwards
+    idx = np.arange(n)
+    pairs = idx[:, None] < idx[None, :]
+    for attempt in range(n * n):
+        m = cost[np.ix_(order, order)]
+        fwd = np.diag(m, 1)
+        bwd = np.diag(m, -1)
+        cum_fwd = np.concatenate(([0.0], np.cumsum(fwd)))
+        cum_bwd = np.concatenate(([0.0], np.cumsum(bwd)))
+        old_in = np.concatenate(([start_cost[order[0]]], fwd))
+        old_out = np.concatenate((fwd, [0.0]))
+        new_in = np.vstack((start_cost[order][None, :], m[:-1, :]))
+        new_out = np.hstack((m[:, 1:], np.zeros((n, 1))))
+        delta = (new_in + new_out - old_in[:, None] - old_out[None, :]
+                 + (cum_bwd[None, :] - cum_bwd[:, None]) - (cum_fwd[None, :] - cum_fwd[:, None]))
+        delta = np.where(pairs, delta, np.inf)
+        i, j = np.unravel_index(np.argmin(delta), delta.shape)
+        if delta[i, j] > -1e-6:
+            break
+        order[i:j + 1] = order[i:j + 1][::-1].copy()
+
+    # keep the csv order if the search didn't beat it
+    before = path_length(np.arange(n))
+    if path_length(order) >= before:
+        return list(range(n)), before, before
+    return [int(i) for i in order], before, path_length(order)
+
+
+def assign_by_travel(slots, items):
+    # find an order for items, where item order[k] is reached from slots[k], with a low total distance
+    # starts from the given order and makes the pair swap that saves the most until none helps, all pairs scored at
+    # once, so the result is never longer than the given order
+    # returns the order and the distance (mm) before and after
+    n = len(items)
+    if n == 0:
+        return [], 0.0, 0.0
+    # cost[k, i] is the distance from slot k to item i
+    cost = np.linalg.norm(slots[:, None, :] - items[None, :, :], axis=2)
+    idx = np.arange(n)
+    order = idx.copy()
+    for attempt in range(n * n):
+        # m[a, b] is the cost of slot a taking the item now at slot b
+        m = cost[idx[:, None], order[None, :]]
+        current = np.diag(m)
+        delta = m + m.T - current[:, None] - current[None, :]
+        a, b = np.unravel_index(np.argmin(delta), delta.shape)
+        if delta[a, b] > -1e-6:
+            break
+        order[a], order[b] = order[b], order[a]
+    return [int(i) for i in order], float(cost[idx, idx].sum()), float(cost[idx, order].sum())
+
+
+def find_column_stamps(plan, low_vol, high_vol):
+    # find groups of 8 transfers that move all of A-H in one source column to the same rows of one destination column
+    # with the same dna and water volumes, in the multichannel's volume range (low_vol < vol <= high_vol, water can
+    # be 0)
+    # returns (source slot, source column, destination slot, destination column, dna vol, water vol) for each group
+    # and the transfers that are left over for the single channels
+    groups = {}
+    for index, transfer in enumerate(plan):
+        if transfer.source_well[0] != transfer.dest_well[0]:
+            continue
+        key = (transfer.source_slot, transfer.source_well[1:], transfer.dest_slot, transfer.dest_well[1:],
+               transfer.vol_dna, transfer.vol_water)
+        groups.setdefault(key, {}).setdefault(transfer.source_well[0], index)
+    stamps = []
+    stamped = set()
+    for key, rows in groups.items():
+        vol_dna, vol_water = key[4], key[5]
+        if sorted(rows) != list('ABCDEFGH'):
+            continue
+        if not low_vol < vol_dna <= high_vol or not (vol_water == 0 or low_vol < vol_water <= high_vol):
+            continue
+        stamps.append(key)
+        stamped.update(rows.values())
+    return stamps, [transfer for index, transfer in enumerate(plan) if index not in stamped]
+
+
 def run(protocol):
     ########## EDIT THESE RUN OPTIONS AS NEEDED ##########
 
@@ -34,9 +398,59 @@ def run(protocol):
     # pre-used or fresh destination plate ('used' or 'clean', all lowercase and in single quotes)
     destination_plate_status = 'clean'
 
+    # put transfers in a low-travel order ('yes' or 'no', all lowercase and in single quotes)
+    # reorders the water wells if water_mode = 'multi', and the DNA transfers so each source is close to the tip it is
+    # picked up with (every DNA transfer goes tip rack, source, destination, trash, so that is all the order changes)
+    # the csv order is kept if the new order isn't shorter
+    order_transfers = 'no'
+
+    # move whole columns with a multichannel pipette ('none', 'p20', or 'p300', all lowercase and in single quotes)
+    # the chosen single channel is replaced by the matching multichannel (p20_multi_gen2 or p300_multi_gen2) on the
+    # same mount
+    # 8 rows that move a full source column (A-H) to the same rows of one destination column, with the same dna and
+    # water volumes, are done in one go with the multichannel. Every other row goes through the single channel that is
+    # left, so those rows have to be in its volume range (p20: 0-20 ul, p300: over 20 ul)
+    column_stamp = 'none'
+
+    # how water is added ('single' or 'multi', all lowercase and in single quotes)
+    # 'single' goes back to the water reservoir for every well
+    # 'multi' fills the tip once and dispenses into several wells in a row (all p20 wells first, then all p300 wells)
+    water_mode = 'single'
+
+    # extra water (ul) taken up with each multi-dispense and blown back into the reservoir at the end
+    # (only used if water_mode = 'multi')
+    disposal_vol_20 = 2
+    disposal_vol_300 = 20
+
+    # water reservoir wells (slot 4), in the order they are used (well names in single quotes and in brackets,
+    # ex: ['A1', 'A2']). When a well runs low the next one is used, and the protocol stops before starting if the
+    # wells can't hold enough water for the run
+    water_wells = ['A1']
+
+    # volume (ul) of water in each water well at the start (fill them back up to this before resuming a run)
+    water_start_vol = 15000
+
     # 3rd tip rack type ('20','300', or 'none',  in single quotes)
     extra_rack_type = 'none'
 
+    # deck slot to load each piece of labware in (paste the slot_layout line printed by deck_layout.py here)
+    # keys are the standard slots (sources 1-3, water 4, destinations 5-6, tips 7-11), values are the deck slots to
+    # use instead. input_data keeps using the standard slots. ex: {1: 2, 2: 1} swaps source plates 1 and 2
+    # leave empty ({}) to use the standard slots
+    slot_layout = {}
+
+    # keep a progress file on the robot so a run that stops part way (tip pickup failure, e-stop, power loss)
+    # can be restarted without repeating wells ('yes' or 'no', all lowercase and in single quotes)
+    track_progress = 'no'
+
+    # restart a run that stopped part way using the progress file ('yes' or 'no', all lowercase and in single quotes)
+    # input data and options must be the same as the run that stopped. Take any tips off the pipettes first,
+    # the run starts on the tip after the last one each pipette picked up
+    resume_run = 'no'
+
+    # where the progress file is kept on the robot
+    progress_file = '/data/standardize_progress.csv'
+
     # sample standardization info
     # paste data from csv here (in between '''  ''')
     input_data = '''
@@ -55,6 +469,13 @@ def run(protocol):
     3,A5,6,D1,54.1,34.8
     '''
 
+    # re-run only what changed since an earlier run on the same destination plates
+    # paste the input data that was already run here (in between '''  ''') and the new data above
+    # new rows are done in full, for rows with higher volumes only the extra dna and water is added
+    # leave empty for a normal run
+    previous_input_data = '''
+    '''
+
     ########## DO NOT EDIT BELOW THIS LINE ##########
 
     # turn on lights if not on already
@@ -68,61 +489,97 @@ def run(protocol):
     if pipette_mount_20 is None:
         raise Exception("Must attach single channel p20")
 
+    # check the input data and build the plan before any labware is loaded or moved
+    # deck slot for each standard slot
+    deck = {slot: slot_layout.get(slot, slot) for slot in range(1, 12)}
+    source_types = {slot: plate for slot, plate in [(1, source_p1), (2, source_p2), (3, source_p3)] if plate != 'none'}
+    dest_types = {slot: plate for slot, plate in [(5, destination_p1), (6, destination_p2)] if plate != 'none'}
+    # standard slots that get labware in this run, no two of them can end up in the same deck slot
+    loaded = list(source_types) + [4] + list(dest_types) + ([7] if extra_rack_type != 'none' else []) + [8, 9, 10, 11]
+    if any(slot not in range(1, 12) for slot in list(slot_layout) + list(slot_layout.values())) \
+            or len({deck[slot] for slot in loaded}) != len(loaded):
+        raise Exception("Invalid slot layout. Slots must be 1-11 and each deck slot can only be used once.")
+
+    plan = compile_plan(input_data, source_types, dest_types)
+    if previous_input_data.strip():
+        # the destination wells already hold dna, so the p20 has to change tips after touching them
+        if destination_plate_status != 'used':
+            raise Exception("A re-run adds to wells that already have dna, so destination_plate_status must be 'used'.")
+        previous_plan = compile_plan(previous_input_data, source_types, dest_types)
+        plan, added, changed, removed = diff_plan(previous_plan, plan)
+        protocol.comment("Re-run: " + str(added) + " new rows and " + str(changed) + " changed rows to do.")
+        if removed:
+            protocol.comment("Rows no longer in the input data are left as they are: " + ', '.join(removed))
+
     # Define hardware, pipettes/tips, plates
     # load tips
     if extra_rack_type == '300':
         tips300 = [protocol.load_labware(
-            'opentrons_96_tiprack_300ul', str(slot)) for slot in [
+            'opentrons_96_tiprack_300ul', str(deck[slot])) for slot in [
             7, 10, 11]]
         tips20 = [protocol.load_labware(
-            'opentrons_96_tiprack_20ul', str(slot)) for slot in [
+            'opentrons_96_tiprack_20ul', str(deck[slot])) for slot in [
             8, 9]]
     elif extra_rack_type == '20':
         tips300 = [protocol.load_labware(
-            'opentrons_96_tiprack_300ul', str(slot)) for slot in [
+            'opentrons_96_tiprack_300ul', str(deck[slot])) for slot in [
             10, 11]]
         tips20 = [protocol.load_labware(
-            'opentrons_96_tiprack_20ul', str(slot)) for slot in [
+            'opentrons_96_tiprack_20ul', str(deck[slot])) for slot in [
             7, 8, 9]]
     elif extra_rack_type == 'none':
         tips300 = [protocol.load_labware(
-            'opentrons_96_tiprack_300ul', str(slot)) for slot in [
+            'opentrons_96_tiprack_300ul', str(deck[slot])) for slot in [
             10, 11]]
         tips20 = [protocol.load_labware(
-            'opentrons_96_tiprack_20ul', str(slot)) for slot in [
+            'opentrons_96_tiprack_20ul', str(deck[slot])) for slot in [
             8, 9]]
     else:
         raise Exception("Extra tip rack type not specified. Must be '20', '300', or 'none'")
 
     # specify pipette, mount location, and tips
-    p300 = protocol.load_instrument("p300_single_gen2", mount=pipette_mount_300, tip_racks=tips300)
-    p20 = protocol.load_instrument("p20_single_gen2", mount=pipette_mount_20, tip_racks=tips20)
+    # in column stamp mode the multichannel goes on the mount of the single channel it replaces
+    p300 = None
+    p20 = None
+    multi = None
+    if column_stamp == 'p300':
+        multi = protocol.load_instrument("p300_multi_gen2", mount=pipette_mount_300, tip_racks=tips300)
+        p20 = protocol.load_instrument("p20_single_gen2", mount=pipette_mount_20, tip_racks=tips20)
+    elif column_stamp == 'p20':
+        p300 = protocol.load_instrument("p300_single_gen2", mount=pipette_mount_300, tip_racks=tips300)
+        multi = protocol.load_instrument("p20_multi_gen2", mount=pipette_mount_20, tip_racks=tips20)
+    elif column_stamp == 'none':
+        p300 = protocol.load_instrument("p300_single_gen2", mount=pipette_mount_300, tip_racks=tips300)
+        p20 = protocol.load_instrument("p20_single_gen2", mount=pipette_mount_20, tip_racks=tips20)
+    else:
+        raise Exception("Column stamp mode not indicated. Must be 'none', 'p20', or 'p300'.")
+    singles = [pipette for pipette in [p20, p300] if pipette is not None]
 
     # load reagent labware and specify reagents in each well/columns
-    water_reservoir = protocol.load_labware('nest_12_reservoir_15ml', '4')
+    water_reservoir = protocol.load_labware('nest_12_reservoir_15ml', str(deck[4]))
 
     # load plates
     # add first source DNA plate
     if source_p1 == 'nest_100ul':
-        protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '1', 'DNA source plate 1')
+        protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', str(deck[1]), 'DNA source plate 1')
     elif source_p1 == 'biorad_200ul':
-        protocol.load_labware('biorad_96_wellplate_200ul_pcr', '1', 'DNA source plate 1')
+        protocol.load_labware('biorad_96_wellplate_200ul_pcr', str(deck[1]), 'DNA source plate 1')
     else:
         raise Exception("Invalid source plate type")
     # add 2nd source plate
     if source_p2 == 'nest_100ul':
-        protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '2', 'DNA source plate 2')
+        protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', str(deck[2]), 'DNA source plate 2')
     elif source_p2 == 'biorad_200ul':
-        protocol.load_labware('biorad_96_wellplate_200ul_pcr', '2', 'DNA source plate 2')
+        protocol.load_labware('biorad_96_wellplate_200ul_pcr', str(deck[2]), 'DNA source plate 2')
     elif source_p2 == 'none':
         pass
     else:
         raise Exception('Invalid source plate type')
     # add 3rd source plate
     if source_p3 == 'nest_100ul':
-        protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '3', 'DNA source plate 3')
+        protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', str(deck[3]), 'DNA source plate 3')
     elif source_p3 == 'biorad_200ul':
-        protocol.load_labware('biorad_96_wellplate_200ul_pcr', '3', 'DNA source plate 3')
+        protocol.load_labware('biorad_96_wellplate_200ul_pcr', str(deck[3]), 'DNA source plate 3')
     elif source_p3 == 'none':
         pass
     else:
@@ -130,123 +587,363 @@ def run(protocol):
 
     # add first DNA destination plate
     if destination_p1 == 'nest_100ul':
-        protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '5', 'DNA destination plate 1')
+        protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', str(deck[5]), 'DNA destination plate 1')
     elif destination_p1 == 'biorad_200ul':
-        protocol.load_labware('biorad_96_wellplate_200ul_pcr', '5', 'DNA destination plate 1')
+        protocol.load_labware('biorad_96_wellplate_200ul_pcr', str(deck[5]), 'DNA destination plate 1')
     else:
         raise Exception('Invalid destination plate type')
     # add 2nd destination plate
     if destination_p2 == 'biorad_200ul':
-        protocol.load_labware('biorad_96_wellplate_200ul_pcr', '6', 'DNA destination plate 2')
+        protocol.load_labware('biorad_96_wellplate_200ul_pcr', str(deck[6]), 'DNA destination plate 2')
     elif destination_p2 == 'nest_100ul':
-        protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '6', 'DNA destination plate 2')
+        protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', str(deck[6]), 'DNA destination plate 2')
     elif destination_p2 == 'none':
         pass
     else:
         raise Exception('Invalid destination plate type')
 
-    # parse input data
-    csv_data = [[val.strip() for val in line.split(',')]
-                for line in input_data.splitlines()
-                if line.split(',')[0].strip()][1:]
+    # look up every well once, the loops below go through this instead of the labware
+    wells = build_well_index({slot: protocol.loaded_labwares[deck[slot]] for slot in deck
+                              if deck[slot] in protocol.loaded_labwares})
+
+    # pick out full columns for the multichannel, everything else goes through the single channels
+    stamps = []
+    single_rows = plan
+    if column_stamp == 'p20':
+        stamps, single_rows = find_column_stamps(plan, 0, 20)
+    elif column_stamp == 'p300':
+        stamps, single_rows = find_column_stamps(plan, 20, 200)
+    for transfer in single_rows:
+        vols = [transfer.vol_dna, transfer.vol_water]
+        if p20 is None and any(0 < vol <= 20 for vol in vols):
+            raise Exception("Row " + str(transfer) + " needs the p20 single channel, which is replaced by the "
+                            "multichannel in column stamp mode")
+        if p300 is None and any(vol > 20 for vol in vols):
+            raise Exception("Row " + str(transfer) + " needs the p300 single channel, which is replaced by the "
+                            "multichannel in column stamp mode")
+    if column_stamp != 'none':
+        protocol.comment(str(len(stamps)) + " columns will be moved with the multichannel and " + str(len(single_rows))
+                         + " rows with the single channel.")
+
+    if order_transfers not in ['yes', 'no']:
+        raise Exception("Transfer ordering not indicated. Must be 'yes' or 'no'.")
+    dna_rows = single_rows
+
+    # progress file, so a run that stops part way can be restarted without redoing wells
+    # each line is either a finished well ('water' or 'dna' and its csv row, 'water_column' or 'dna_column' and the
+    # stamp number) or a tip that was picked up ('tip', mount, tip rack slot, tip well)
+    done = {'water': set(), 'dna': set(), 'water_column': set(), 'dna_column': set()}
+    last_tips = {}
+    run_id = hashlib.sha1(repr((plan, stamps, water_mode, column_stamp, destination_plate_status, extra_rack_type,
+                                pipette_mount_20, pipette_mount_300, sorted(deck.items()))).encode()).hexdigest()[:16]
+    if resume_run == 'yes':
+        if os.path.exists(progress_file):
+            with open(progress_file) as f:
+                lines = f.read().splitlines()
+            if not lines or lines[0] != 'run,' + run_id:
+                raise Exception("Progress file is from a different run. Input data and options must match the run "
+                                "that stopped.")
+            # a line cut short by a power loss is ignored
+            for line in lines[1:]:
+                fields = line.split(',')
+                if fields[0] == 'tip' and len(fields) == 4:
+                    last_tips[fields[1]] = (fields[2], fields[3])
+                elif fields[0] in done and len(fields) == 2 and fields[1].isdigit():
+                    done[fields[0]].add(int(fields[1]))
+            protocol.comment("Resuming run: " + str(len(done['water']) + len(done['water_column'])) + " water and "
+                             + str(len(done['dna']) + len(done['dna_column'])) + " dna transfers already done.")
+        elif protocol.is_simulating():
+            protocol.comment("No progress file found, simulating the whole run.")
+        else:
+            raise Exception("No progress file found at " + progress_file)
+    elif resume_run != 'no':
+        raise Exception("Resume run not indicated. Must be 'yes' or 'no'.")
+
+    # each pipette starts on the tip after the last one it picked up before the restart
+    start_tips = {}
+    for pipette in protocol.loaded_instruments.values():
+        if pipette.mount in last_tips:
+            tips = [tip for rack in pipette.tip_racks for tip in rack.wells()]
+            tip_names = [(str(tip.parent.parent), tip.well_name) for tip in tips]
+            next_index = tip_names.index(last_tips[pipette.mount]) + pipette.channels
+            if next_index >= len(tips):
+                raise Exception("No tips left on the " + pipette.mount + " pipette's tip racks to resume with.")
+            start_tips[pipette.mount] = tips[next_index]
+
+    progress_log = None
+    if track_progress == 'yes':
+        # nothing is written while the protocol is being simulated
+        if not protocol.is_simulating():
+            progress_log = open(progress_file, 'a' if resume_run == 'yes' else 'w')
+            if resume_run != 'yes':
+                progress_log.write('run,' + run_id + '\n')
+    elif track_progress != 'no':
+        raise Exception("Track progress not indicated. Must be 'yes' or 'no'.")
+
+    def log_progress(*fields):
+        # one short line per event, pushed to disk straight away so it survives a power loss
+        if progress_log is not None:
+            progress_log.write(','.join(str(field) for field in fields) + '\n')
+            progress_log.flush()
+            os.fsync(progress_log.fileno())
+
+    def pick_up(pipette):
+        # pick up the next tip (after the last one used before a restart) and log which one it was
+        start = start_tips.get(pipette.mount)
+        racks = pipette.tip_racks
+        if start is not None:
+            racks = racks[racks.index(start.parent):]
+        for rack in racks:
+            tip = rack.next_tip(pipette.channels, start if start is not None and start.parent == rack else None)
+            if tip is not None:
+                break
+        else:
+            raise Exception("Out of tips for the " + pipette.mount + " pipette.")
+        pipette.pick_up_tip(tip)
+        log_progress('tip', pipette.mount, tip.parent.parent, tip.well_name)
+
+    def next_tips(pipette, count):
+        # the next count tips pick_up() will give the pipette, in order
+        start = start_tips.get(pipette.mount)
+        tips = [tip for rack in pipette.tip_racks for tip in rack.wells()]
+        if start is not None:
+            tips = tips[tips.index(start):]
+        tips = [tip for tip in tips if tip.has_tip][:count]
+        if len(tips) < count:
+            raise Exception("Out of tips for the " + pipette.mount + " pipette.")
+        return tips
+
+    def dna_pipette(transfer):
+        # the single channel that moves a row's DNA
+        return p20 if transfer.vol_dna <= 20 else p300
+
+    # leave out anything that was finished before a restart
+    water_rows = [transfer for transfer in single_rows if transfer.row not in done['water']]
+    dna_rows = [transfer for transfer in dna_rows if transfer.row not in done['dna']]
 
     # set aspirate and dispense speeds
-    p20.flow_rate.aspirate = 150
-    p20.flow_rate.dispense = 150
-    p300.flow_rate.aspirate = 150
-    p300.flow_rate.dispense = 150
+    for pipette in protocol.loaded_instruments.values():
+        pipette.flow_rate.aspirate = 150
+        pipette.flow_rate.dispense = 150
 
     # add water to destination wells
-    # if clean p300 and p20  will use the same tip for all wells
-    # if not,p20 will change tip in between each sample if dispensed vol is <10 ul
-    if destination_plate_status == "clean":
-        # pick up tips that will be used the whole time
-        p20.pick_up_tip()
-        p300.pick_up_tip()
-        # loop through wells and add water
-        for row in csv_data:
-            dest_well = protocol.loaded_labwares[int(row[2])].wells_by_name()[row[3]]
-            vol_water = float(row[5])
-            # check volume
-            if vol_water < 0.0 or vol_water > 200.0:
-                raise Exception("Invalid volume of water. Must be between 0.0-200.0")
-            # round to 2 decimal places
-            vol_water = round(vol_water, 2)
-            # use p20 if between 1-20
-            # water tends to cling to tip at vol <10 so a touch-tip step is included
+    # volume (ul) left in the bottom of a reservoir well that the pipette can't reach
+    reservoir_dead_vol = 500
+    water_source = ReagentLedger(protocol, 'water', [water_reservoir.wells_by_name()[well] for well in water_wells],
+                                 water_start_vol, reservoir_dead_vol)
+    water_source.check(draw_vol=sum(transfer.vol_water for transfer in water_rows)
+                       + sum(8 * stamp[5] for index, stamp in enumerate(stamps) if index not in done['water_column']))
+    if water_mode == 'multi':
+        if destination_plate_status not in ['clean', 'used']:
+            raise Exception("Destination plate status not indicated. Must be 'clean' or 'used'.")
+        # sort wells by pipette so the gantry isn't switching between mounts on every row
+        water_20 = []
+        water_300 = []
+        for transfer in water_rows:
+            dest_well = wells[(transfer.dest_slot, transfer.dest_well)]
+            vol_water = transfer.vol_water
             if 0 < vol_water <= 20:
-                p20.aspirate(vol_water, water_reservoir.wells()[0])
-                p20.dispense(vol_water, dest_well.top())
-                p20.blow_out()
-                if vol_water < 10:
-                    p20.touch_tip()
+                water_20.append((dest_well, vol_water, transfer.row))
             if vol_water > 20:
-                p300.aspirate(vol_water, water_reservoir.wells()[0])
-                p300.dispense(vol_water, dest_well.top())
-                p300.blow_out()
-        p20.drop_tip()
-        p300.drop_tip()
-    elif destination_plate_status == "used":
-        # pick up tips
-        p20.pick_up_tip()
-        p300.pick_up_tip()
-        # loop through wells and add water
-        for row in csv_data:
-            dest_well = protocol.loaded_labwares[int(row[2])].wells_by_name()[row[3]]
-            vol_water = float(row[5])
-            # check volume
-            if vol_water < 0.0 or vol_water > 200.0:
-                raise Exception("Invalid volume of water. Must be between 0.0-200.0")
-            # round to 2 decimal places
-            vol_water = round(vol_water, 2)
-            # use p20 if between 1-20
-            # water tends to cling to tip at vol <10 so a touch-tip step is included
-            if 0 < vol_water <= 20:
-                p20.aspirate(vol_water, water_reservoir.wells()[0])
-                p20.dispense(vol_water, dest_well.top())
-                p20.blow_out()
-                if vol_water < 10:
-                    p20.touch_tip()
-                    p20.drop_tip()
-                    p20.pick_up_tip()
-            if vol_water > 20:
-                p300.aspirate(vol_water,  water_reservoir.wells()[0])
-                p300.dispense(vol_water, dest_well.top())
-                p300.blow_out()
-        p20.drop_tip()
-        p300.drop_tip()
+                water_300.append((dest_well, vol_water, transfer.row))
+        # visit the wells of each pipette in a low-travel order starting from the reservoir
+        if order_transfers == 'yes':
+            before = 0
+            after = 0
+            reservoir_xy = well_xy([water_source.wells[0].top()])[0]
+            for pip_water in [water_20, water_300]:
+                dest_xy = well_xy([dest_well.top for dest_well, vol_water, row in pip_water])
+                order, wells_before, wells_after = order_by_travel(dest_xy, dest_xy, reservoir_xy)
+                pip_water[:] = [pip_water[i] for i in order]
+                before += wells_before
+                after += wells_after
+            protocol.comment("Estimated gantry travel for water wells: " + str(round(before)) + " mm in CSV order, "
+                             + str(round(after)) + " mm after ordering.")
+        # on used plates the p20 touches the well after dispensing <10 ul, so that tip can't go back to the reservoir
+        change_tip_20 = destination_plate_status == 'used'
+        for pipette, pip_water, disposal_vol, change_tip in [(p20, water_20, disposal_vol_20, change_tip_20),
+                                                             (p300, water_300, disposal_vol_300, False)]:
+            if pipette is None:
+                continue
+            for fill in plan_water_fills(pip_water, pipette.max_volume, disposal_vol, change_tip):
+                if not pipette.has_tip:
+                    pick_up(pipette)
+                fill_vol = sum(vol_water for dest_well, vol_water, row in fill)
+                take_vol = fill_vol + min(disposal_vol, pipette.max_volume - fill_vol)
+                pipette.aspirate(take_vol, water_source.aspirate_from(take_vol))
+                touched = False
+                for dest_well, vol_water, row in fill:
+                    pipette.dispense(vol_water, dest_well.top)
+                    log_progress('water', row)
+                    # water tends to cling to tip at vol <10 so a touch-tip step is included
+                    if pipette == p20 and vol_water < 10:
+                        pipette.touch_tip()
+                        touched = True
+                # get rid of the disposal volume, in the trash if the tip touched a used well
+                if touched and change_tip:
+                    pipette.blow_out(protocol.fixed_trash['A1'])
+                    pipette.drop_tip()
+                else:
+                    pipette.blow_out(water_source.put_back(take_vol - fill_vol))
+            if pipette.has_tip:
+                pipette.drop_tip()
+    elif water_mode == 'single':
+        # if clean p300 and p20  will use the same tip for all wells
+        # if not,p20 will change tip in between each sample if dispensed vol is <10 ul
+        # only pipettes with water left to add pick up a tip (after a restart there may be nothing left for one)
+        water_singles = [pipette for pipette in singles if any(
+            (0 < transfer.vol_water <= 20) if pipette == p20 else (transfer.vol_water > 20) for transfer in water_rows)]
+        if destination_plate_status == "clean":
+            # pick up tips that will be used the whole time
+            for pipette in water_singles:
+                pick_up(pipette)
+            # loop through wells and add water
+            for transfer in water_rows:
+                dest_well = wells[(transfer.dest_slot, transfer.dest_well)]
+                vol_water = transfer.vol_water
+                # use p20 if between 1-20
+                # water tends to cling to tip at vol <10 so a touch-tip step is included
+                if 0 < vol_water <= 20:
+                    p20.aspirate(vol_water, water_source.aspirate_from(vol_water))
+                    p20.dispense(vol_water, dest_well.top)
+                    log_progress('water', transfer.row)
+                    p20.blow_out()
+                    if vol_water < 10:
+                        p20.touch_tip()
+                if vol_water > 20:
+                    p300.aspirate(vol_water, water_source.aspirate_from(vol_water))
+                    p300.dispense(vol_water, dest_well.top)
+                    log_progress('water', transfer.row)
+                    p300.blow_out()
+            for pipette in water_singles:
+                pipette.drop_tip()
+        elif destination_plate_status == "used":
+            # pick up tips
+            for pipette in water_singles:
+                pick_up(pipette)
+            # loop through wells and add water
+            for transfer in water_rows:
+                dest_well = wells[(transfer.dest_slot, transfer.dest_well)]
+                vol_water = transfer.vol_water
+                # use p20 if between 1-20
+                # water tends to cling to tip at vol <10 so a touch-tip step is included
+                if 0 < vol_water <= 20:
+                    p20.aspirate(vol_water, water_source.aspirate_from(vol_water))
+                    p20.dispense(vol_water, dest_well.top)
+                    log_progress('water', transfer.row)
+                    p20.blow_out()
+                    if vol_water < 10:
+                        p20.touch_tip()
+                        p20.drop_tip()
+                        pick_up(p20)
+                if vol_water > 20:
+                    p300.aspirate(vol_water, water_source.aspirate_from(vol_water))
+                    p300.dispense(vol_water, dest_well.top)
+                    log_progress('water', transfer.row)
+                    p300.blow_out()
+            for pipette in water_singles:
+                pipette.drop_tip()
+        else:
+            raise Exception("Destination plate status not indicated. Must be 'clean' or 'used'.")
     else:
-        raise Exception("Destination plate status not indicated. Must be 'clean' or 'used'.")
+        raise Exception("Water mode not indicated. Must be 'single' or 'multi'.")
+
+    # add water to the stamped columns, keeping the tips unless the plate is used and the tip was touched to the wells
+    for index, (src_slot, src_col, dest_slot, dest_col, vol_dna, vol_water) in enumerate(stamps):
+        if vol_water == 0 or index in done['water_column']:
+            continue
+        dest_column = wells[(dest_slot, 'A' + dest_col)]
+        if not multi.has_tip:
+            pick_up(multi)
+        multi.aspirate(vol_water, water_source.aspirate_from(vol_water, multi.channels))
+        multi.dispense(vol_water, dest_column.top)
+        log_progress('water_column', index)
+        multi.blow_out()
+        if column_stamp == 'p20' and vol_water < 10:
+            multi.touch_tip()
+            if destination_plate_status == 'used':
+                multi.drop_tip()
+    if multi is not None and multi.has_tip:
+        multi.drop_tip()
 
+    # add dna to the stamped columns
+    for index, (src_slot, src_col, dest_slot, dest_col, vol_dna, vol_water) in enumerate(stamps):
+        if index in done['dna_column']:
+            continue
+        source_column = wells[(src_slot, 'A' + src_col)]
+        dest_column = wells[(dest_slot, 'A' + dest_col)]
+        pick_up(multi)
+        multi.aspirate(vol_dna, source_column.well)
+        multi.touch_tip()
+        multi.dispense(vol_dna, dest_column.well)
+        log_progress('dna_column', index)
+        multi.blow_out()
+        multi.touch_tip()
+        multi.drop_tip()
+
+    # order the DNA transfers for low travel
+    # each one goes tip rack -> source -> destination -> trash with a new tip, so the only leg the order can change is
+    # from each tip to its source: the tips are used in rack order, and each pipette's transfers are swapped between
+    # its places in the run so each source is close to the tip it is reached from
+    if order_transfers == 'yes' and dna_rows:
+        trash_xy = well_xy([protocol.fixed_trash['A1'].top()])[0]
+
+        def dna_path(rows):
+            # gantry travel (mm) for the DNA transfers in this order, all legs
+            tips = {pipette: iter(next_tips(pipette, len(rows))) for pipette in singles}
+            tip_xy = well_xy([next(tips[dna_pipette(transfer)]).top() for transfer in rows])
+            src_xy = well_xy([wells[(transfer.source_slot, transfer.source_well)].top for transfer in rows])
+            dest_xy = well_xy([wells[(transfer.dest_slot, transfer.dest_well)].top for transfer in rows])
+            legs = (np.linalg.norm(tip_xy - src_xy, axis=1) + np.linalg.norm(src_xy - dest_xy, axis=1)
+                    + np.linalg.norm(dest_xy - trash_xy, axis=1))
+            return legs.sum() + np.linalg.norm(tip_xy[1:] - trash_xy, axis=1).sum()
+
+        before = dna_path(dna_rows)
+        ordered = list(dna_rows)
+        for pipette in singles:
+            places = [index for index, transfer in enumerate(dna_rows) if dna_pipette(transfer) == pipette]
+            tip_xy = well_xy([tip.top() for tip in next_tips(pipette, len(places))])
+            src_xy = well_xy([wells[(dna_rows[index].source_slot, dna_rows[index].source_well)].top
+                              for index in places])
+            order, tips_before, tips_after = assign_by_travel(tip_xy, src_xy)
+            for place, i in zip(places, order):
+                ordered[place] = dna_rows[places[i]]
+        after = dna_path(ordered)
+        if after < before:
+            dna_rows = ordered
+        else:
+            after = before
+        protocol.comment("Estimated gantry travel for DNA transfers: " + str(round(before)) + " mm in CSV order, "
+                         + str(round(after)) + " mm after ordering.")
 
     # add dna to each well
-    for row in csv_data:
-        source_well = protocol.loaded_labwares[int(row[0])].wells_by_name()[row[1]]
-        dest_well = protocol.loaded_labwares[int(row[2])].wells_by_name()[row[3]]
-        vol_dna = float(row[4])
-        # check volume
-        if vol_dna < 1.0 or vol_dna > 200.0:
-            raise Exception("Invalid volume of dna. Must be between 1.0-200.0")
-        # round to 2 decimal places
-        vol_dna = round(vol_dna, 2)
+    for transfer in dna_rows:
+        source_well = wells[(transfer.source_slot, transfer.source_well)]
+        dest_well = wells[(transfer.dest_slot, transfer.dest_well)]
+        vol_dna = transfer.vol_dna
         # use p20 if appropriate volume
         if 0 < vol_dna <= 20:
-            p20.pick_up_tip()
-            p20.aspirate(vol_dna, source_well)
+            pick_up(p20)
+            p20.aspirate(vol_dna, source_well.well)
             p20.touch_tip()
-            p20.dispense(vol_dna, dest_well)
+            p20.dispense(vol_dna, dest_well.well)
+            log_progress('dna', transfer.row)
             p20.blow_out()
             p20.touch_tip()
             p20.drop_tip()
         # use p300 if appropriate volume
         if vol_dna > 20:
-            p300.pick_up_tip()
-            p300.aspirate(vol_dna, source_well)
+            pick_up(p300)
+            p300.aspirate(vol_dna, source_well.well)
             p300.touch_tip()
-            p300.dispense(vol_dna, dest_well)
+            p300.dispense(vol_dna, dest_well.well)
+            log_progress('dna', transfer.row)
             p300.blow_out()
             p300.touch_tip()
             p300.drop_tip()
 
+    if progress_log is not None:
+        progress_log.close()
+
     # turn off lights
     protocol.set_rail_lights(False)